@@ -0,0 +1,443 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+
+from engine import ENGINES, raise_fd_limit
+from protocol import (FRAME_JSON, DEFAULT_ROOM, DEFAULT_CHUNK_SIZE, CODECS, Codec, FrameParser,
+                      encode_message, encode_data, decode_message)
+from transfer import CHUNK_SIZE, hash_chunk, compute_file_id
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+# 被测服务器默认监听的端口，避免与正在运行的聊天服务器冲突
+DEFAULT_BENCH_PORT = 5600
+
+# 同时进行的连接与登录数，避免超过服务器的 listen 队列
+CONNECT_CONCURRENCY = 100
+
+# 每次从套接字读取的大小
+RECV_SIZE = 256 * 1024
+
+# 基准测试发出的聊天消息以此开头，后面是发送时刻，用于计算端到端延迟
+MARKER = 'bench'
+
+# 发送结束后等待消息送达的最长时间（秒），收到的数量不再增长时提前结束
+DRAIN_TIMEOUT = 5
+DRAIN_IDLE = 0.5
+
+# 采样服务器内存占用的间隔（秒）
+SAMPLE_INTERVAL = 0.2
+
+# 与基准结果对比时列出的指标
+COMPARE_KEYS = (
+    ('chat', 'delivered_per_sec'),
+    ('chat', 'latency_ms', 'p50'),
+    ('chat', 'latency_ms', 'p99'),
+    ('files', 'mb_per_sec'),
+    ('login', 'per_sec'),
+    ('server', 'cpu_percent'),
+    ('server', 'rss_peak_bytes'),
+)
+
+
+class ServerProcess:
+    """在子进程中运行的被测服务器，CPU 时间和内存占用从 /proc 读取（其他系统上为 None）"""
+
+    def __init__(self, port, engine, extra_args=()):
+        self.port = port
+        self.engine = engine
+        self.extra_args = list(extra_args)
+        self.process = None
+        self.work_dir = None
+
+    def start(self):
+        self.work_dir = tempfile.mkdtemp(prefix='chat-bench-')
+        command = [sys.executable, SERVER_SCRIPT, '--host', '127.0.0.1', '--port', str(self.port),
+                   '--engine', self.engine,
+                   '--history-dir', os.path.join(self.work_dir, 'history'),
+                   '--store-dir', os.path.join(self.work_dir, 'file_store'),
+                   '--discovery-port', '0'] + self.extra_args
+        # 服务器为每个连接打印一行日志，基准测试时丢弃
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("被测服务器启动失败")
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("等待被测服务器启动超时")
+
+    def cpu_seconds(self):
+        try:
+            with open(f'/proc/{self.process.pid}/stat') as f:
+                # 第二个字段（进程名）可能含空格，从右括号之后开始数
+                fields = f.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def rss_bytes(self):
+        try:
+            with open(f'/proc/{self.process.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.work_dir is not None:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+class Stats:
+    """所有模拟客户端共享的统计"""
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.latencies = []  # 观察者客户端收到消息的端到端延迟（秒）
+
+
+class BenchClient:
+    """无界面的模拟客户端：完成登录握手，读取并统计广播，可以发送聊天消息和上传文件"""
+
+    def __init__(self, name, stats, observer=False):
+        self.name = name
+        self.stats = stats
+        self.observer = observer  # 是否记录延迟，只取一部分客户端，避免统计本身成为瓶颈
+        self.parser = FrameParser(RECV_SIZE)
+        self.codec = None
+        self.reader = None
+        self.writer = None
+        self.waiters = {}  # 等待服务器回复的上传 {(消息类型, 通道号): future}
+        self.task = None
+
+    async def connect(self, host, port, compression):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(encode_message({'type': 'login', 'username': self.name,
+                                          'compression': list(compression), 'rooms': []}))
+        while True:
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                raise ConnectionError("服务器关闭了连接")
+            frames = self.parser.feed(data)
+            for i, frame in enumerate(frames):
+                if frame.type != FRAME_JSON:
+                    continue
+                message = decode_message(frame.payload, frame.flags)
+                if message['type'] != 'login_result':
+                    continue
+                if message['status'] != 'USERNAME_ACCEPTED':
+                    raise ConnectionError(f"登录失败: {message['status']}")
+                negotiated = message.get('compression')
+                if negotiated:
+                    self.codec = Codec(negotiated['codec'], negotiated['level'])
+                for rest in frames[i + 1:]:
+                    self.handle(rest)
+                self.task = asyncio.ensure_future(self.read_loop())
+                return
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    break
+                for frame in self.parser.feed(data):
+                    self.handle(frame)
+        except (OSError, ValueError) as e:
+            print(f"{self.name} 接收出错: {e}", file=sys.stderr)
+
+    def handle(self, frame):
+        if frame.type != FRAME_JSON:
+            return
+        received = time.perf_counter()
+        message = decode_message(frame.payload, frame.flags)
+        kind = message['type']
+        if kind == 'text':
+            content = message.get('content', '')
+            if not content.startswith(MARKER):
+                return
+            self.stats.received += 1
+            if self.observer:
+                self.stats.latencies.append(received - float(content[len(MARKER) + 1:]))
+        elif kind in ('upload_ready', 'upload_result'):
+            future = self.waiters.pop((kind, message['channel']), None)
+            if future is not None and not future.done():
+                future.set_result(message)
+        elif kind == 'ping':
+            self.send({'type': 'pong'})
+
+    def send(self, message):
+        self.writer.write(encode_message(message, codec=self.codec))
+
+    def send_text(self):
+        self.send({'type': 'text', 'room': DEFAULT_ROOM,
+                   'content': f"{MARKER} {time.perf_counter():.6f}",
+                   'time': datetime.datetime.now().strftime("%H:%M:%S")})
+        self.stats.sent += 1
+
+    def expect(self, kind, channel):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[(kind, channel)] = future
+        return future
+
+    async def upload(self, data, channel=1):
+        """上传一段内存中的数据，返回是否成功"""
+        chunk_hashes = [hash_chunk(data[i:i + CHUNK_SIZE]) for i in range(0, len(data), CHUNK_SIZE)]
+        ready = self.expect('upload_ready', channel)
+        result = self.expect('upload_result', channel)
+        self.send({'type': 'file', 'file_id': compute_file_id(chunk_hashes),
+                   'filename': f"{self.name}.bin", 'filesize': len(data),
+                   'chunk_hashes': chunk_hashes, 'channel': channel, 'room': DEFAULT_ROOM,
+                   'time': datetime.datetime.now().strftime("%H:%M:%S")})
+        message = await ready
+        if message.get('exists'):
+            return True
+        view = memoryview(data)
+        for offset in range(message.get('offset', 0), len(data), DEFAULT_CHUNK_SIZE):
+            self.writer.write(encode_data(channel, view[offset:offset + DEFAULT_CHUNK_SIZE]))
+            await self.writer.drain()
+        return (await result)['status'] == 'ok'
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+async def sample_rss(server, peak):
+    while True:
+        rss = server.rss_bytes()
+        if rss is not None:
+            peak[0] = max(peak[0] or 0, rss)
+        await asyncio.sleep(SAMPLE_INTERVAL)
+
+
+async def login_phase(args, stats):
+    """所有模拟客户端并发连接并完成登录握手"""
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    compression = CODECS if args.compression else ()
+    clients = [BenchClient(f"bench{i}", stats, observer=i < args.observers)
+               for i in range(args.clients)]
+
+    async def connect(client):
+        async with semaphore:
+            await client.connect('127.0.0.1', args.port, compression)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connect(client) for client in clients))
+    elapsed = time.perf_counter() - start
+    return clients, {'clients': len(clients), 'seconds': round(elapsed, 3),
+                     'per_sec': round(len(clients) / elapsed, 1)}
+
+
+async def wait_delivery(stats, expected):
+    """等待已发送的消息送达，全部收到或一段时间没有新消息时返回"""
+    deadline = time.perf_counter() + DRAIN_TIMEOUT
+    last, last_change = stats.received, time.perf_counter()
+    while stats.received < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+        if stats.received != last:
+            last, last_change = stats.received, time.perf_counter()
+        elif time.perf_counter() - last_change > DRAIN_IDLE:
+            break
+
+
+async def chat_phase(args, clients, stats):
+    """前 senders 个客户端按固定速率发送聊天消息，持续 duration 秒"""
+    senders = clients[:args.senders]
+    interval = 1.0 / args.rate
+    start = time.perf_counter()
+    end = start + args.duration
+
+    async def run(client, delay):
+        next_send = start + delay
+        while next_send < end:
+            now = time.perf_counter()
+            if next_send > now:
+                await asyncio.sleep(next_send - now)
+            client.send_text()
+            next_send += interval
+
+    # 各发送者错开发送时刻，避免所有消息同时到达
+    await asyncio.gather(*(run(client, interval * i / len(senders))
+                           for i, client in enumerate(senders)))
+    expected = stats.sent * len(clients)  # 发送者自己也会收到广播
+    await wait_delivery(stats, expected)
+    elapsed = time.perf_counter() - start
+    latencies = sorted(stats.latencies)
+    return {
+        'senders': len(senders),
+        'sent': stats.sent,
+        'delivered': stats.received,
+        'expected': expected,
+        'delivery_ratio': round(stats.received / expected, 4) if expected else None,
+        'seconds': round(elapsed, 3),
+        'sent_per_sec': round(stats.sent / args.duration, 1),
+        'delivered_per_sec': round(stats.received / elapsed, 1),
+        'latency_ms': {
+            'samples': len(latencies),
+            'p50': round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+            'p99': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+            'max': round(latencies[-1] * 1000, 3) if latencies else None,
+        }
+    }
+
+
+async def file_phase(args, clients):
+    """多个客户端同时上传内容各不相同的文件"""
+    uploaders = clients[-args.uploaders:] if args.uploaders else []
+    if not uploaders or args.file_size <= 0:
+        return None
+    payloads = [os.urandom(args.file_size) for _ in uploaders]
+    start = time.perf_counter()
+    results = await asyncio.gather(*(client.upload(data) for client, data in zip(uploaders, payloads)))
+    elapsed = time.perf_counter() - start
+    total = sum(len(data) for data in payloads)
+    return {
+        'uploads': len(uploaders),
+        'succeeded': sum(1 for ok in results if ok),
+        'bytes': total,
+        'seconds': round(elapsed, 3),
+        'mb_per_sec': round(total / elapsed / 1048576, 2)
+    }
+
+
+async def run_benchmark(args, server):
+    stats = Stats()
+    peak = [None]
+    sampler = asyncio.ensure_future(sample_rss(server, peak))
+    clients = []
+    try:
+        cpu_start, wall_start = server.cpu_seconds(), time.perf_counter()
+        print(f"连接并登录 {args.clients} 个客户端...", file=sys.stderr)
+        clients, login = await login_phase(args, stats)
+        print(f"发送聊天消息 {args.duration} 秒...", file=sys.stderr)
+        chat = await chat_phase(args, clients, stats)
+        print("上传文件...", file=sys.stderr)
+        files = await file_phase(args, clients)
+        cpu_end, wall_end = server.cpu_seconds(), time.perf_counter()
+    finally:
+        sampler.cancel()
+        for client in clients:
+            client.close()
+
+    cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+    return {
+        'login': login,
+        'chat': chat,
+        'files': files,
+        'server': {
+            'cpu_seconds': round(cpu, 3) if cpu is not None else None,
+            'cpu_percent': round(cpu / (wall_end - wall_start) * 100, 1) if cpu is not None else None,
+            'rss_peak_bytes': peak[0],
+            'rss_bytes': server.rss_bytes()
+        }
+    }
+
+
+def lookup(results, path):
+    for key in path:
+        if not isinstance(results, dict):
+            return None
+        results = results.get(key)
+    return results
+
+
+def compare(report, baseline):
+    """与基准结果逐项对比，返回可读的文本"""
+    lines = [f"{'指标':<28}{'基准':>14}{'本次':>14}{'变化':>10}"]
+    for path in COMPARE_KEYS:
+        old = lookup(baseline['results'], path)
+        new = lookup(report['results'], path)
+        change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else '-'
+        lines.append(f"{'.'.join(path):<28}{str(old):>14}{str(new):>14}{change:>10}")
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="聊天服务器基准测试：启动服务器并用无界面的模拟客户端施加负载")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='thread', help="被测服务器的连接引擎")
+    parser.add_argument('--port', type=int, default=DEFAULT_BENCH_PORT, help="被测服务器的端口")
+    parser.add_argument('--clients', type=int, default=200, help="模拟客户端数量")
+    parser.add_argument('--senders', type=int, default=20, help="其中发送聊天消息的客户端数量")
+    parser.add_argument('--rate', type=float, default=5, help="每个发送者每秒发送的消息数")
+    parser.add_argument('--duration', type=float, default=10, help="发送聊天消息的时长（秒）")
+    parser.add_argument('--observers', type=int, default=20, help="记录端到端延迟的客户端数量")
+    parser.add_argument('--uploaders', type=int, default=4, help="同时上传文件的客户端数量")
+    parser.add_argument('--file-size', type=int, default=8 * 1024 * 1024, help="每个上传文件的大小（字节）")
+    parser.add_argument('--compression', action='store_true', help="与服务器协商压缩")
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help="传给被测服务器的额外参数，例如 --server-arg=--coalesce-delay=0")
+    parser.add_argument('--output', help="把 JSON 结果另外写入该文件")
+    parser.add_argument('--compare', help="与之前保存的 JSON 结果对比，对比表输出到标准错误")
+    args = parser.parse_args(argv)
+    args.senders = min(args.senders, args.clients)
+    args.observers = min(args.observers, args.clients)
+    args.uploaders = min(args.uploaders, args.clients)
+    if args.rate <= 0 or args.clients <= 0 or args.senders <= 0:
+        parser.error("--clients、--senders 和 --rate 必须大于 0")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    raise_fd_limit()
+    server = ServerProcess(args.port, args.engine, args.server_arg)
+    server.start()
+    try:
+        results = asyncio.run(run_benchmark(args, server))
+    finally:
+        server.stop()
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': results,
+        'meta': {
+            'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        }
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            print(compare(report, json.load(f)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
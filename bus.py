@@ -0,0 +1,260 @@
+import os
+import hmac
+import json
+import time
+import socket
+import datetime
+import itertools
+import threading
+
+from protocol import FRAME_JSON, FrameParser, ProtocolError, encode_frame, encode_message, decode_message
+from outbound import OutboundQueue
+from heartbeat import HEARTBEAT_TICK
+from registry import SessionTable, DEFAULT_SESSION_GRACE
+
+# 在线状态变化的类型
+PRESENCE_ADD = 'add'
+PRESENCE_REMOVE = 'remove'
+
+
+class BusHub:
+    """多进程模式下的本地消息总线，运行在主进程中
+
+    各工作进程通过 Unix 套接字连接到总线。总线为广播消息统一分配序号、写入聊天记录，
+    再按相同顺序转发给所有工作进程，所以不同进程上的用户看到的是同一个聊天室；
+    用户名也在这里登记，不同进程上不会出现同名用户；意外断线用户的用户名也在这里保留，
+    重新连接时可能被分配到另一个工作进程。
+    所有消息在一把锁内逐条处理，处理期间的转发也在锁内放入各工作进程的发送队列，每个工作进程收到的顺序一致；
+    实际写入由每个工作进程的写线程完成，锁内不会因为某个工作进程暂时不读而阻塞。
+    """
+
+    def __init__(self, path, history, session_grace=DEFAULT_SESSION_GRACE):
+        self.path = path
+        self.history = history  # 聊天记录只由总线写入
+        self.lock = threading.Lock()
+        self.workers = []  # 已连接的工作进程
+        self.outbound = {}  # {工作进程: 发送队列}
+        self.names = {}  # {用户名: (工作进程, 用户信息, 会话令牌)}
+        self.sessions = SessionTable(session_grace)  # 断线后保留的用户名
+        self.server_socket = None
+
+    def listen(self):
+        """绑定总线地址，之后启动的工作进程即可连接（在 serve 之前排队等待）"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(self.path)
+        self.server_socket.listen()
+
+    def serve(self):
+        """接受工作进程的连接，每个工作进程一个读线程"""
+        threading.Thread(target=self._expire_loop, daemon=True).start()
+        while True:
+            sock, _ = self.server_socket.accept()
+            threading.Thread(target=self._serve_worker, args=(sock,), daemon=True).start()
+
+    def _expire_loop(self):
+        """宽限期已过的断线用户此时才通知离开"""
+        while True:
+            time.sleep(HEARTBEAT_TICK)
+            with self.lock:
+                for username in self.sessions.expire():
+                    self.announce_leave(username)
+
+    def _serve_worker(self, sock):
+        parser = FrameParser()
+        outbound = OutboundQueue()
+        threading.Thread(target=self._write_loop, args=(sock, outbound), daemon=True).start()
+        with self.lock:
+            self.workers.append(sock)
+            self.outbound[sock] = outbound
+            # 新的工作进程先同步当前在线的用户
+            for username, (_, info, _) in self.names.items():
+                self._send(sock, encode_message({'type': 'presence', 'action': PRESENCE_ADD,
+                                                 'username': username, 'info': info}))
+        try:
+            while True:
+                frames = parser.read_from(sock)
+                if frames is None:
+                    break
+                for frame in frames:
+                    message = decode_message(frame.payload, frame.flags)
+                    with self.lock:
+                        self.handle(sock, message)
+        except (OSError, ProtocolError) as e:
+            print(f"工作进程的总线连接出错: {e}")
+        finally:
+            with self.lock:
+                self.workers.remove(sock)
+                del self.outbound[sock]
+                # 工作进程退出，它上面的用户全部离开
+                for username in [name for name, entry in self.names.items() if entry[0] is sock]:
+                    self.release(sock, username)
+            outbound.close()
+            sock.close()
+
+    def _write_loop(self, sock, outbound):
+        """写线程：把发送队列中的数据写给一个工作进程"""
+        while outbound.wait():
+            try:
+                outbound.write_to(sock)
+            except OSError:
+                # 连接已断开，由它的读线程清理
+                return
+
+    def handle(self, worker, message):
+        """处理工作进程发来的一条消息（持有 self.lock）"""
+        if message['type'] == 'publish':
+            self.publish(message['message'], message.get('exclude'), message.get('record', True))
+        elif message['type'] == 'claim':
+            self.claim(worker, message)
+        elif message['type'] == 'release':
+            self.release(worker, message['username'], message.get('session'))
+        elif message['type'] == 'history':
+            self.reply_history(worker, message['request'], message.get('since'))
+        elif message['type'] == 'direct':
+            self.direct(worker, message['message'])
+
+    def publish(self, message, exclude=None, record=True):
+        """（需要时记录后）把消息转发给所有工作进程，exclude 为不接收该消息的用户名"""
+        if record:
+            message = self.history.append(message)
+        self._send_all(encode_message({'type': 'deliver', 'message': message, 'exclude': exclude}))
+
+    def direct(self, worker, message):
+        """私聊消息只转发给接收人所在的工作进程，接收人不在线时通知发送方的工作进程"""
+        entry = self.names.get(message['to'])
+        if entry is None:
+            self._send(worker, encode_message({'type': 'direct_failed', 'message': message}))
+        else:
+            self._send(entry[0], encode_message({'type': 'direct', 'message': message}))
+
+    def claim(self, worker, message):
+        """登记用户名，成功时随回复补发聊天记录，然后通知所有工作进程"""
+        username = message['username']
+        token = message.get('resume')
+        entry = self.names.get(username)
+        if (entry is not None and entry[2] and isinstance(token, str)
+                and hmac.compare_digest(entry[2], token)):
+            # 旧连接还没有被心跳断开（可能在另一个工作进程上）：通知它所在的进程关闭旧连接，
+            # 用户名直接交给新连接，旧连接随后的 release 不再属于它所在的进程，会被忽略
+            del self.names[username]
+            self._send(entry[0], encode_message({'type': 'take_over', 'username': username,
+                                                 'session': token}))
+            resumed = True
+        else:
+            resumed = self.sessions.resume(username, token)
+        if username in self.names or (not resumed and username in self.sessions):
+            self._send(worker, encode_message({'type': 'reply', 'request': message['request'],
+                                               'ok': False}))
+            return
+        self.names[username] = (worker, message.get('info'), message.get('session'))
+        # 补发记录与之后的广播按顺序发给同一个工作进程，不重复也不遗漏
+        self.reply_history(worker, message['request'], message.get('since'), resumed)
+        if resumed:
+            return  # 其他人看来该用户一直在线
+        self._send_all(encode_message({'type': 'presence', 'action': PRESENCE_ADD,
+                                       'username': username, 'info': message.get('info')}))
+        self.system(f"{username} 加入了聊天室")
+
+    def release(self, worker, username, session=None):
+        """用户断开，带会话令牌（意外断线）时先保留用户名"""
+        entry = self.names.get(username)
+        if entry is None or entry[0] is not worker:
+            return
+        del self.names[username]
+        if not self.sessions.reserve(username, session):
+            self.announce_leave(username)
+
+    def announce_leave(self, username):
+        self.system(f"{username} 离开了聊天室")
+        self._send_all(encode_message({'type': 'presence', 'action': PRESENCE_REMOVE,
+                                       'username': username, 'info': None}))
+
+    def system(self, content):
+        self.publish({
+            'type': 'system',
+            'content': content,
+            'time': datetime.datetime.now().strftime("%H:%M:%S")
+        })
+
+    def reply_history(self, worker, request, since, resumed=False):
+        """回复序号大于 since 的聊天记录"""
+        if not isinstance(since, int) or isinstance(since, bool):
+            since = None
+        records, truncated = self.history.since(since)
+        # 记录已经是编码好的 JSON，直接拼接
+        payload = ('{"type": "reply", "request": %d, "ok": true, "resumed": %s, "truncated": %s, '
+                   '"messages": [%s]}' % (request, json.dumps(resumed), json.dumps(truncated),
+                                          ', '.join(records)))
+        self._send(worker, encode_frame(FRAME_JSON, payload.encode('utf-8')))
+
+    def _send_all(self, data):
+        for worker in self.workers:
+            self._send(worker, data)
+
+    def _send(self, worker, data):
+        """放入工作进程的发送队列，立即返回（持有 self.lock）"""
+        outbound = self.outbound.get(worker)
+        if outbound is not None:
+            outbound.put(data, force=True)
+
+
+class BusClient:
+    """工作进程一侧的总线连接
+
+    handler(message) 在总线读线程中处理总线转发来的消息；request() 的回调同样在读线程中调用，
+    两者都不能阻塞（服务器把实际处理交给引擎线程）。
+    与总线断开时调用 on_close()。
+    """
+
+    def __init__(self, path, handler, on_close=None):
+        self.path = path
+        self.handler = handler
+        self.on_close = on_close
+        self.sock = None
+        self.lock = threading.Lock()
+        self.requests = {}  # 等待回复的请求 {请求号: 回调}
+        self._ids = itertools.count(1)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def send(self, message):
+        data = encode_message(message)
+        with self.lock:
+            try:
+                self.sock.sendall(data)
+            except OSError as e:
+                # 总线已断开，读线程随后调用 on_close
+                print(f"发送到消息总线失败: {e}")
+
+    def request(self, message, callback):
+        """发送请求，收到回复时调用 callback(reply)"""
+        with self.lock:
+            request_id = next(self._ids)
+            self.requests[request_id] = callback
+            self.sock.sendall(encode_message(dict(message, request=request_id)))
+
+    def _read_loop(self):
+        parser = FrameParser()
+        try:
+            while True:
+                frames = parser.read_from(self.sock)
+                if frames is None:
+                    break
+                for frame in frames:
+                    message = decode_message(frame.payload, frame.flags)
+                    if message['type'] == 'reply':
+                        with self.lock:
+                            callback = self.requests.pop(message['request'], None)
+                        if callback is not None:
+                            callback(message)
+                    else:
+                        self.handler(message)
+        except (OSError, ProtocolError) as e:
+            print(f"消息总线连接出错: {e}")
+        if self.on_close:
+            self.on_close()
@@ -0,0 +1,1200 @@
+import hmac
+import json
+import time
+import queue
+import random
+import socket
+import asyncio
+import datetime
+import itertools
+import threading
+import os
+from concurrent.futures import Future, ThreadPoolExecutor, InvalidStateError
+from protocol import (FRAME_JSON, FRAME_DATA, MAX_CHANNEL, DEFAULT_CHUNK_SIZE, CODECS, Codec,
+                      DEFAULT_ROOM,
+                      FrameParser, ProtocolError, encode_message, decode_message,
+                      decompress_payload)
+from outbound import OutboundQueue, FileStream, tune_socket
+from heartbeat import HEARTBEAT_TICK
+from transfer import (CHUNK_SIZE, ChunkVerifier, ChecksumError, hash_file_chunks, resume_offset,
+                      is_compressible, validate_manifest)
+
+# 服务器默认端口，地址中没有写端口时使用
+DEFAULT_PORT = 5000
+
+# 接收缓冲区大小，一次读取可包含多个帧，文件数据帧更大时自动扩大
+RECV_BUFFER_SIZE = 256 * 1024
+
+# 发送文件时每个数据帧的大小
+FILE_CHUNK_SIZE = DEFAULT_CHUNK_SIZE
+
+# 计算文件哈希、准备下载等后台任务的线程数
+TRANSFER_WORKERS = 2
+
+# 未完成下载的记录，用于重新连接后续传
+DOWNLOAD_STATE_FILE = os.path.join(os.path.expanduser('~'), '.lan_chatroom', 'downloads.json')
+PART_SUFFIX = '.part'
+
+# 分块校验失败时重新请求的最大次数
+MAX_DOWNLOAD_RETRIES = 3
+
+# 直连传输时接收方等待发送者连接的时间，发送者连接接收方的超时（秒），超时后改由服务器中转
+P2P_ACCEPT_TIMEOUT = 10
+P2P_CONNECT_TIMEOUT = 5
+
+# 连接和等待登录响应的超时（秒），自动重连时服务器没有响应不会一直卡住
+CONNECT_TIMEOUT = 5
+
+# 自动重连的退避：第 n 次重试前等待 0 到 min(最大值, 基数 * 2^n) 之间的随机时间（秒）
+RECONNECT_BASE_DELAY = 0.05
+RECONNECT_MAX_DELAY = 10
+
+# 主动断开时等待服务器确认退出的时间（秒）
+LOGOUT_TIMEOUT = 1
+
+# 服务器发来、原样作为事件交给使用者的消息类型
+CHAT_EVENTS = ('text', 'system', 'direct', 'file_notification')
+
+
+def now():
+    return datetime.datetime.now().strftime("%H:%M:%S")
+
+
+class LoginError(Exception):
+    """登录失败（用户名已被占用或服务器的响应无法识别）"""
+
+    def __init__(self, status):
+        super().__init__(f"登录失败: {status}")
+        self.status = status
+
+
+class TransferError(Exception):
+    """文件传输失败"""
+
+
+class Transfer:
+    """一次文件传输：上传（upload）、下载（download）或直连发送（p2p_send）
+
+    进度由 position 随时读取；结果通过 future 取得，也可以直接 await。
+    上传成功的结果为 'ok'、'exists'（服务器已有相同文件）或 'p2p'（等待接收方直连下载），
+    下载成功的结果为保存路径；失败时抛出 TransferError，取消后抛出 CancelledError。
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, kind, filename, total):
+        self.id = next(Transfer._ids)
+        self.kind = kind
+        self.filename = filename
+        self.total = total
+        self.future = Future()
+        self._position = lambda: 0
+        self._cancel = None  # 传输开始后由会话设置
+
+    @property
+    def position(self):
+        """已完成的字节数"""
+        return self._position()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        """阻塞等待传输结束"""
+        return self.future.result(timeout)
+
+    def cancel(self):
+        """取消传输，可以在任何线程中调用"""
+        if self._cancel is not None:
+            self._cancel()
+        else:
+            self.future.cancel()
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+    def _finish(self, result):
+        try:
+            self.future.set_result(result)
+        except InvalidStateError:
+            pass
+
+    def _fail(self, reason):
+        try:
+            self.future.set_exception(TransferError(reason))
+        except InvalidStateError:
+            pass
+
+
+class ChatSession:
+    """不依赖界面的客户端核心：连接、登录、收发消息和文件传输
+
+    发送的消息和文件数据都放入发送队列后立即返回，由发送线程按顺序写出，
+    调用方不需要等待上一条发完（流水线发送）。收到的消息和传输状态变化作为事件
+    （带 'type' 的字典）交给 handler；没有 handler 时放入内部队列，由 next_event 取出。
+    handler 在网络线程中调用，不能阻塞。
+
+    事件类型：服务器消息 text / system / direct / file_notification / room_result / direct_failed，
+    补发的 history（只含未显示过的记录），以及 notice（提示文字 text）、error（错误文字 text）、
+    transfer_started / transfer_finished（transfer 为 Transfer）、reconnecting（attempt 为第几次尝试，
+    delay 为等待秒数）、reconnected（resumed 表示会话已恢复）和 disconnected。
+
+    连接意外断开时按带随机抖动的指数退避自动重连，凭登录时得到的会话令牌恢复原来的会话，
+    断线期间错过的消息由服务器补发；无法重连或调用 close 后产生 disconnected。
+    """
+
+    def __init__(self, handler=None, state_file=DOWNLOAD_STATE_FILE, auto_reconnect=True):
+        self.handler = handler
+        self.auto_reconnect = auto_reconnect
+        self.events = queue.Queue()
+        self.state_file = state_file
+        self.username = None
+        self.address = None
+        self.session_token = None  # 服务器签发的会话令牌，重新连接时凭它恢复会话
+        self.resumed = False  # 最近一次登录是否恢复了原来的会话
+        self.client_socket = None
+        self.parser = FrameParser(RECV_BUFFER_SIZE)
+        self.pending_frames = []  # 登录响应之后已收到但尚未处理的帧
+        self.incoming_files = {}  # 正在接收的文件 {通道号: 接收状态}
+        self.pending_uploads = {}  # 正在上传的文件 {通道号: 上传状态}
+        self.shared_files = {}  # 以直连方式分享、由本机提供下载的文件 {文件ID: 文件信息}
+        self.download_state = self.load_download_state()  # 未完成的下载 {保存路径: 文件信息}
+        self.last_channel = 0
+        self.channel_lock = threading.Lock()
+        self.outbound = OutboundQueue()  # 由发送线程统一发送，帧不会交错
+        self.last_seq = None  # 已收到的最后一条聊天记录的序号
+        self.history_since = None  # 登录时请求补发的起点
+        self.live_seqs = None  # 登录后、补发的记录到达前实时收到的序号
+        self.codec = None  # 登录时与服务器协商的压缩算法
+        self.heartbeat = None  # 服务器告知的心跳间隔 {'interval': 秒, 'timeout': 秒}
+        self.last_seen = time.monotonic()  # 最后一次收到服务器数据的时间
+        self.stopped = threading.Event()  # 当前连接断开时设置
+        self.closing = threading.Event()  # 调用 close 后设置，不再自动重连
+        self.running = False  # 是否已登录并在收发
+        self.rooms = [DEFAULT_ROOM]  # 已加入的房间，重新登录时恢复
+        # 计算哈希、准备下载等耗时任务在线程池中进行，调用方不会被阻塞
+        self.executor = ThreadPoolExecutor(max_workers=TRANSFER_WORKERS)
+        self.transfer_lock = threading.RLock()  # 保护正在传输的文件，取消与写入不会同时进行
+        self.state_lock = threading.RLock()  # 保护未完成下载的记录
+
+    def emit(self, event):
+        """交出一个事件，可以在任何线程中调用"""
+        if self.handler is not None:
+            self.handler(event)
+        else:
+            self.events.put(event)
+
+    def next_event(self, timeout=None):
+        """没有 handler 时取出下一个事件，超时返回 None"""
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def notice(self, text):
+        self.emit({'type': 'notice', 'text': f"[{now()}] {text}"})
+
+    def connect(self, address):
+        """连接到服务器，address 为 (host, port)"""
+        self.closing.clear()
+        self.open_socket(address)
+
+    def open_socket(self, address):
+        self.address = address
+        # 登录完成前使用超时，服务器没有响应时不会一直等待
+        self.client_socket = socket.create_connection(address, timeout=CONNECT_TIMEOUT)
+        tune_socket(self.client_socket)
+        self.parser = FrameParser(RECV_BUFFER_SIZE)
+        self.pending_frames = []
+        self.codec = None
+
+    def login(self, username):
+        """发送用户名并等待验证，用户名已被占用时返回 False，可以换一个用户名再次调用"""
+        # since 告诉服务器从哪条记录之后开始补发，resume 为上次的会话令牌
+        resume = self.session_token if username == self.username else None
+        self.history_since = self.last_seq
+        self.live_seqs = set()
+        self.client_socket.sendall(encode_message({'type': 'login', 'username': username,
+                                                   'since': self.last_seq,
+                                                   'compression': list(CODECS),
+                                                   'rooms': self.rooms,
+                                                   'resume': resume}))
+        message = self.read_login_result()
+        status = message['status']
+        if status == "USERNAME_ACCEPTED":
+            self.username = username
+            self.session_token = message.get('session')
+            self.resumed = bool(message.get('resumed'))
+            return True
+        if status == "USERNAME_TAKEN":
+            return False
+        raise LoginError(status)
+
+    def read_login_result(self):
+        """读取服务器对登录请求的响应"""
+        while True:
+            frames = self.parser.read_from(self.client_socket)
+            if frames is None:
+                raise ConnectionError("服务器关闭了连接")
+            for i, frame in enumerate(frames):
+                if frame.type != FRAME_JSON:
+                    continue
+                message = decode_message(frame.payload, frame.flags)
+                if message['type'] == 'login_result':
+                    # 登录响应之后的帧交给接收线程处理
+                    self.pending_frames = frames[i + 1:]
+                    compression = message.get('compression')
+                    if compression:
+                        self.codec = Codec(compression['codec'], compression['level'])
+                    self.heartbeat = message.get('heartbeat')
+                    return message
+
+    def start(self):
+        """登录成功后开启发送线程和接收线程"""
+        # 所有消息和文件数据都经由发送队列
+        self.outbound = OutboundQueue()
+        self.start_io()
+        threading.Thread(target=self.receive_messages, daemon=True).start()
+
+    def start_io(self):
+        """为刚登录的连接开启发送线程和心跳线程"""
+        sock = self.client_socket
+        sock.settimeout(None)
+        self.stopped = threading.Event()
+        self.last_seen = time.monotonic()
+        self.running = True
+        threading.Thread(target=self.write_messages, args=(self.outbound, sock), daemon=True).start()
+        if self.heartbeat:
+            threading.Thread(target=self.keep_alive, args=(sock, self.stopped), daemon=True).start()
+
+    def open(self, address, username):
+        """连接、登录并开始收发，用户名已被占用时抛出 LoginError"""
+        self.connect(address)
+        try:
+            if not self.login(username):
+                raise LoginError("USERNAME_TAKEN")
+        except Exception:
+            self.close()
+            raise
+        self.start()
+
+    def close(self):
+        """断开连接并不再重连，接收线程结束时产生 disconnected 事件"""
+        self.closing.set()
+        sock = self.client_socket
+        if sock is None:
+            return
+        if self.running:
+            # 告诉服务器这是主动退出，不必保留用户名；等服务器关闭连接，排队的消息不会丢失
+            self.send_message({'type': 'logout'})
+            self.stopped.wait(LOGOUT_TIMEOUT)
+        self.close_socket(sock)
+
+    def close_socket(self, sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def send_frame(self, data):
+        """把一个完整的帧交给发送线程"""
+        self.outbound.put(data, force=True)
+
+    def send_message(self, message):
+        """编码并放入发送队列，立即返回"""
+        self.send_frame(encode_message(message, codec=self.codec))
+        return message
+
+    def send_text(self, content, room=DEFAULT_ROOM):
+        """向房间发送文本消息，返回发出的消息"""
+        return self.send_message({'type': 'text', 'room': room, 'content': content, 'time': now()})
+
+    def send_direct(self, to, content):
+        """发送私聊消息（服务器不会发回给自己），返回发出的消息"""
+        return self.send_message({'type': 'direct', 'to': to, 'content': content, 'time': now()})
+
+    def join_room(self, room):
+        """请求加入房间，结果为 room_result 事件"""
+        self.send_message({'type': 'join_room', 'room': room})
+
+    def leave_room(self, room):
+        """请求离开房间，结果为 room_result 事件"""
+        self.send_message({'type': 'leave_room', 'room': room})
+
+    def write_messages(self, outbound, sock):
+        """发送线程：聊天消息优先，多个文件传输按数据帧轮流发送"""
+        while outbound.wait():
+            try:
+                outbound.write_to(sock)
+            except OSError:
+                break
+
+    def next_channel(self):
+        """分配一个本客户端使用的文件传输通道号"""
+        with self.channel_lock:
+            self.last_channel = self.last_channel % MAX_CHANNEL + 1
+            return self.last_channel
+
+    def receive_messages(self):
+        """接收线程：连接意外断开时自动重连，无法重连或主动断开时产生 disconnected"""
+        try:
+            while True:
+                self.read_messages()
+                self.connection_lost()
+                if not self.auto_reconnect or not self.session_token or self.closing.is_set():
+                    break
+                # 重连期间发送的消息先在新的队列中排队，登录后按顺序发出
+                self.outbound = OutboundQueue()
+                if not self.reconnect():
+                    self.outbound.close()
+                    break
+        except Exception as e:
+            # 处理消息的代码出错，不是连接的问题，重连后还会再出错：断开连接，把异常抛出
+            self.closing.set()
+            self.close_socket(self.client_socket)
+            self.connection_lost()
+            self.emit({'type': 'error', 'text': f"处理服务器消息时出错: {e!r}"})
+            raise
+        finally:
+            self.emit({'type': 'disconnected'})
+
+    def connection_lost(self):
+        """当前连接已断开：停止发送和心跳，中止进行中的传输"""
+        self.running = False
+        self.stopped.set()
+        self.outbound.close()
+        self.abort_uploads()
+        self.abort_incoming_files()
+
+    def reconnect(self):
+        """按带随机抖动的指数退避重新连接并恢复会话，成功时返回 True
+
+        等待时间在 0 和上限之间完全随机，服务器重启后大量客户端不会同时涌入。
+        """
+        attempt = 0
+        while True:
+            delay = random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt))
+            attempt += 1
+            self.emit({'type': 'reconnecting', 'attempt': attempt, 'delay': delay})
+            if self.closing.wait(delay):
+                return False
+            try:
+                self.open_socket(self.address)
+                accepted = self.login(self.username)
+            except (OSError, ProtocolError, LoginError) as e:
+                print(f"重新连接失败: {e}")
+                if self.client_socket is not None:
+                    self.close_socket(self.client_socket)
+                continue
+            if not accepted:
+                # 会话已过期，用户名被别人用了
+                self.close_socket(self.client_socket)
+                self.emit({'type': 'error', 'text': f"用户名 {self.username} 已被使用，无法重新连接"})
+                return False
+            if self.closing.is_set():
+                self.close_socket(self.client_socket)
+                return False
+            self.start_io()
+            self.emit({'type': 'reconnected', 'resumed': self.resumed})
+            return True
+
+    def read_messages(self):
+        """处理当前连接收到的帧，直到连接断开"""
+        frames = self.pending_frames
+        self.pending_frames = []
+        self.resume_downloads()
+        while True:
+            # 处理帧时的异常交给 receive_messages，只有读取出错才算连接断开
+            for frame in frames:
+                self.handle_frame(frame)
+
+            try:
+                frames = self.parser.read_from(self.client_socket)
+            except ProtocolError as e:
+                print(f"协议错误: {e}")
+                break
+            except OSError:
+                break
+            if frames is None:
+                break
+            self.last_seen = time.monotonic()
+
+    def keep_alive(self, sock, stopped):
+        """心跳线程：一段时间没有收到服务器的任何数据时发送 ping，仍没有回应则断开
+
+        上传大文件时服务器可能一直不发数据，所以由客户端自己发 ping，而不是只等服务器的 ping。
+        """
+        interval = self.heartbeat['interval']
+        timeout = self.heartbeat['timeout']
+        ping_time = None
+        while not stopped.wait(HEARTBEAT_TICK):
+            now = time.monotonic()
+            if ping_time is not None and self.last_seen > ping_time:
+                ping_time = None
+            if ping_time is None:
+                if now - self.last_seen >= interval:
+                    ping_time = now
+                    self.send_message({'type': 'ping'})
+            elif now - ping_time >= timeout:
+                print(f"服务器超过 {interval + timeout} 秒没有响应，断开连接")
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
+
+    def handle_frame(self, frame):
+        """处理一个完整的帧"""
+        if frame.type == FRAME_DATA:
+            self.handle_file_data(frame.channel, decompress_payload(frame.payload, frame.flags))
+            return
+        if frame.type != FRAME_JSON:
+            return
+
+        message = decode_message(frame.payload, frame.flags)
+        if message['type'] == 'ping':
+            self.send_message({'type': 'pong'})
+            return
+        if 'seq' in message:
+            # 带序号的聊天记录，跳过已经收到过的
+            if self.last_seq is not None and message['seq'] <= self.last_seq:
+                return
+            self.last_seq = message['seq']
+            if self.live_seqs is not None:
+                # 服务器先开始转发实时消息再补发记录，记下序号以便去掉补发中重复的
+                self.live_seqs.add(message['seq'])
+
+        if message['type'] in CHAT_EVENTS:
+            self.emit(message)
+        elif message['type'] == 'direct_failed':
+            if message.get('request') in ('p2p_connect', 'p2p_relay'):
+                self.handle_p2p_failed(message)
+                return
+            self.emit(message)
+        elif message['type'] == 'history':
+            self.handle_history(message)
+        elif message['type'] == 'file_meta':
+            self.handle_file_meta(message)
+        elif message['type'] == 'file_aborted':
+            self.handle_file_aborted(message['channel'], message.get('reason', ''))
+        elif message['type'] == 'upload_ready':
+            self.handle_upload_ready(message)
+        elif message['type'] == 'upload_result':
+            self.handle_upload_result(message)
+        elif message['type'] == 'room_result':
+            self.handle_room_result(message)
+        elif message['type'] == 'p2p_token':
+            self.handle_p2p_token(message)
+        elif message['type'] == 'p2p_connect':
+            threading.Thread(target=self.serve_p2p, args=(message,), daemon=True).start()
+        elif message['type'] == 'p2p_relay':
+            self.handle_p2p_relay(message)
+        elif message['type'] == 'p2p_relay_ready':
+            self.handle_p2p_relay_ready(message)
+
+    def handle_history(self, message):
+        """登录时补发的聊天记录，只交出还没有收到过的部分"""
+        live = self.live_seqs or ()
+        self.live_seqs = None
+        records = [m for m in message['messages']
+                   if (self.history_since is None or m['seq'] > self.history_since)
+                   and m['seq'] not in live]
+        if not records:
+            return
+        self.last_seq = max(self.last_seq or 0, records[-1]['seq'])
+        self.emit(dict(message, messages=records))
+
+    def handle_room_result(self, message):
+        """服务器对加入或离开房间的回复，更新已加入的房间"""
+        room = message['room']
+        if message['status'] == 'joined' and room not in self.rooms:
+            self.rooms.append(room)
+        elif message['status'] == 'left' and room in self.rooms:
+            self.rooms.remove(room)
+        self.emit(message)
+
+    def start_transfer(self, transfer, get_position, cancel):
+        """传输开始，使用者可以据此显示进度"""
+        transfer._position = get_position
+        transfer._cancel = cancel
+        self.emit({'type': 'transfer_started', 'transfer': transfer})
+
+    def end_transfer(self, transfer, result=None, error=None):
+        """传输结束（成功、失败或取消）"""
+        if error is not None:
+            transfer._fail(error)
+        elif result is not None:
+            transfer._finish(result)
+        else:
+            transfer.future.cancel()
+        self.emit({'type': 'transfer_finished', 'transfer': transfer})
+
+    def send_file(self, path, room=DEFAULT_ROOM, to=None, p2p=False):
+        """发送文件，立即返回 Transfer；计算哈希和发送都在后台进行，发送期间仍可以聊天
+
+        指定 to 时只通知该用户。p2p 为 True 时不上传，服务器直接发出通知，
+        接收方同意后从本机直连下载。
+        """
+        transfer = Transfer('upload', os.path.basename(path), os.path.getsize(path))
+        self.executor.submit(self.offer_file, transfer, path, room, to, p2p)
+        return transfer
+
+    def offer_file(self, transfer, path, room=DEFAULT_ROOM, to=None, p2p=False, relay_for=None):
+        """计算文件哈希并向服务器发起上传，上传完成后通知 room 中的成员（指定 to 时只通知该用户）
+
+        relay_for 为直连失败的接收方，此时只上传不通知，服务器收到后告诉该接收方。
+        """
+        filename = transfer.filename
+        try:
+            # 服务器按内容哈希存储文件，相同内容无需重复上传
+            file_id, chunk_hashes = hash_file_chunks(path)
+            # 已经压缩过的文件不再压缩传输
+            compressible = is_compressible(path)
+        except OSError as e:
+            self.notice(f"读取文件 {filename} 失败: {e}")
+            self.end_transfer(transfer, error=str(e))
+            return
+        if transfer.future.cancelled():
+            return
+
+        if p2p:
+            self.shared_files[file_id] = {
+                'path': path,
+                'filename': filename,
+                'filesize': transfer.total,
+                'chunk_hashes': chunk_hashes
+            }
+        channel = self.next_channel()
+        with self.transfer_lock:
+            self.pending_uploads[channel] = {
+                'path': path,
+                'filename': filename,
+                'filesize': transfer.total,
+                'stream': None,  # 服务器同意后创建
+                'compressible': compressible,
+                'task': transfer
+            }
+        transfer._cancel = lambda: self.cancel_upload(channel)
+        self.send_message({
+            'type': 'file',
+            'file_id': file_id,
+            'filename': filename,
+            'filesize': transfer.total,
+            'chunk_hashes': chunk_hashes,
+            'channel': channel,
+            'room': room,
+            'to': to,
+            'p2p': p2p,
+            'relay_for': relay_for,
+            'time': now()
+        })
+
+    def handle_upload_ready(self, message):
+        """服务器准备好接收：把文件流交给发送线程，与其他传输和聊天消息交替发送"""
+        channel = message['channel']
+        with self.transfer_lock:
+            upload = self.pending_uploads.get(channel)
+            if upload is None:
+                return
+            if message['exists']:
+                del self.pending_uploads[channel]
+                self.notice(f"文件 {upload['filename']} 发送成功（服务器已有相同文件）")
+                self.end_transfer(upload['task'], 'exists')
+                return
+
+            # 之前中断过的上传从服务器告知的位置继续
+            offset = message.get('offset', 0)
+            codec = self.codec if upload['compressible'] else None
+            stream = FileStream(upload['path'], channel, upload['filesize'] - offset, offset,
+                                FILE_CHUNK_SIZE, codec)
+            upload['stream'] = stream
+            self.outbound.put_stream(stream)
+        # 发送完成后仍在进行中，服务器校验通过后由接收线程结束
+        self.start_transfer(upload['task'], lambda: stream.position,
+                            lambda: self.cancel_upload(channel))
+
+    def cancel_upload(self, channel):
+        """取消上传，服务器保留已收到的部分供下次续传"""
+        with self.transfer_lock:
+            upload = self.pending_uploads.pop(channel, None)
+        if upload is None:
+            return
+        self.outbound.cancel_stream(channel)
+        self.send_message({'type': 'file_cancel', 'channel': channel})
+        self.notice(f"已取消发送文件 {upload['filename']}")
+        self.end_transfer(upload['task'])
+
+    def handle_upload_result(self, message):
+        """服务器对上传文件的校验结果"""
+        with self.transfer_lock:
+            upload = self.pending_uploads.pop(message['channel'], None)
+        if upload is None:
+            return
+        if message.get('p2p'):
+            self.notice(f"文件 {upload['filename']} 已分享，接收方将直接从本机下载")
+            self.end_transfer(upload['task'], 'p2p')
+        elif message['status'] == 'ok':
+            self.notice(f"文件 {upload['filename']} 发送成功")
+            self.end_transfer(upload['task'], 'ok')
+        else:
+            if upload['stream'] is not None:
+                self.outbound.cancel_stream(message['channel'])
+            reason = message.get('reason', '')
+            self.notice(f"文件 {upload['filename']} 发送失败: {reason}")
+            self.end_transfer(upload['task'], error=reason)
+
+    def abort_uploads(self):
+        """连接断开时结束所有上传，服务器保留已收到的部分供下次续传"""
+        with self.transfer_lock:
+            uploads = list(self.pending_uploads.values())
+            self.pending_uploads.clear()
+        for upload in uploads:
+            self.end_transfer(upload['task'], error="与服务器的连接已断开")
+
+    def download(self, message, save_path):
+        """接收一个文件通知中的文件并保存到 save_path，立即返回 Transfer"""
+        transfer = Transfer('download', message['filename'], message['filesize'])
+        self.executor.submit(self.start_download, transfer, message, save_path)
+        return transfer
+
+    def start_download(self, task, message, save_path):
+        """在线程池中开始下载，出错时给出提示"""
+        try:
+            self.receive_file_data(task, message, save_path)
+        except Exception as e:
+            self.notice(f"接收文件 {message['filename']} 失败: {e}")
+            self.end_transfer(task, error=str(e))
+
+    def receive_file_data(self, task, message, save_path):
+        """向服务器请求下载文件，数据帧到达后由 handle_file_data 写入
+
+        数据先写入 .part 文件，如果之前下载过同一文件的一部分，从最后校验通过的位置继续。
+        """
+        file_id = message['file_id']
+        filename = message['filename']
+        filesize = message['filesize']
+        part_path = save_path + PART_SUFFIX
+
+        offset = 0
+        entry = self.download_state.get(save_path)
+        if (entry and entry['file_id'] == file_id and entry.get('chunk_hashes')
+                and os.path.exists(part_path)):
+            offset = resume_offset(part_path, entry['chunk_hashes'])
+        else:
+            entry = {
+                'file_id': file_id,
+                'filename': filename,
+                'filesize': filesize,
+                'sender': message['sender'],
+                'p2p': message.get('p2p', False)
+            }
+            self.update_download_state(save_path, entry)
+
+        if task.future.cancelled():
+            return
+        f = open(part_path, 'r+b' if offset else 'wb')
+        f.seek(offset)
+        channel = self.next_channel()
+        transfer = {
+            'task': task,
+            'channel': channel,
+            'file': f,
+            'file_id': file_id,
+            'save_path': save_path,
+            'part_path': part_path,
+            'filename': filename,
+            'filesize': filesize,
+            'received': offset,
+            'verifier': None,  # 收到分块清单后创建
+            'retries': 0,
+            'sender': message['sender'],
+            'p2p': None,  # 直连下载的状态，改由服务器中转后为 None
+            'relay_wait': False  # 是否在等待发送者把文件补传到服务器
+        }
+        self.incoming_files[channel] = transfer
+        self.start_transfer(task, lambda: transfer['received'],
+                            lambda: self.cancel_incoming_file(transfer))
+        if filesize <= 0 or offset >= filesize:
+            # 空文件，或者 .part 文件已经全部校验通过，不需要再请求数据
+            with self.transfer_lock:
+                self.finish_file_data(channel)
+            return
+        if message.get('p2p'):
+            self.request_p2p(transfer, offset)
+        else:
+            self.request_file_range(channel, offset)
+
+    def request_file_range(self, channel, offset):
+        """请求从 offset 开始的文件内容"""
+        transfer = self.incoming_files[channel]
+        self.send_message({
+            'type': 'file_request',
+            'file_id': transfer['file_id'],
+            'channel': channel,
+            'offset': offset
+        })
+
+    def handle_file_meta(self, message):
+        """收到文件的分块清单，之后的数据按清单逐块校验"""
+        with self.transfer_lock:
+            transfer = self.incoming_files.get(message['channel'])
+            if transfer is None:
+                return
+            transfer['verifier'] = ChunkVerifier(message['chunk_hashes'], message['filesize'],
+                                                 message['offset'])
+            entry = self.download_state.get(transfer['save_path'])
+            if entry is not None and 'chunk_hashes' not in entry:
+                self.update_download_state(transfer['save_path'],
+                                           dict(entry, chunk_hashes=message['chunk_hashes']))
+            if transfer['verifier'].complete:
+                # 续传位置已经是文件末尾，服务器不会再发送数据
+                self.finish_file_data(message['channel'])
+
+    def handle_file_data(self, channel, chunk):
+        """写入收到的文件数据帧，进度由使用者通过 Transfer.position 读取"""
+        with self.transfer_lock:
+            transfer = self.incoming_files.get(channel)
+            if transfer is None or transfer['verifier'] is None:
+                return
+
+            try:
+                transfer['file'].write(chunk)
+            except Exception as e:
+                self.emit({'type': 'error', 'text': f"接收文件失败: {str(e)}"})
+                del self.incoming_files[channel]
+                self.cancel_download(channel)
+                self.remove_partial_file(transfer)
+                self.end_transfer(transfer['task'], error=str(e))
+                return
+
+            try:
+                transfer['verifier'].update(chunk)
+            except (ChecksumError, ValueError) as e:
+                self.retry_download(channel, e)
+                return
+            transfer['received'] = transfer['verifier'].position
+
+            if transfer['verifier'].complete:
+                self.finish_file_data(channel)
+
+    def cancel_incoming_file(self, transfer):
+        """取消下载，删除未完成的文件"""
+        with self.transfer_lock:
+            channel = transfer['channel']
+            if self.incoming_files.get(channel) is not transfer:
+                return
+            del self.incoming_files[channel]
+            self.close_p2p(transfer)
+            self.cancel_download(channel)
+            self.remove_partial_file(transfer)
+        self.notice(f"已取消接收文件 {transfer['filename']}")
+        self.end_transfer(transfer['task'])
+
+    def retry_download(self, channel, error):
+        """分块校验失败：丢弃该分块，从最后校验通过的位置重新请求"""
+        transfer = self.incoming_files.pop(channel)
+        self.cancel_download(channel)
+        self.close_p2p(transfer)
+        verified = transfer['verifier'].verified
+        transfer['file'].truncate(verified)
+        transfer['file'].seek(verified)
+
+        if transfer['retries'] >= MAX_DOWNLOAD_RETRIES:
+            transfer['file'].close()
+            self.notice(f"文件 {transfer['filename']} 接收失败: {error}")
+            self.end_transfer(transfer['task'], error=str(error))
+            return
+
+        self.notice(f"文件 {transfer['filename']} {error}，重新请求")
+        transfer['retries'] += 1
+        transfer['verifier'] = None
+        new_channel = self.next_channel()
+        transfer['channel'] = new_channel
+        self.incoming_files[new_channel] = transfer
+        if transfer['p2p'] is not None:
+            # 直连收到的数据有误，改由服务器中转
+            transfer['p2p'] = None
+            transfer['received'] = verified
+            self.request_relay(transfer)
+        else:
+            self.request_file_range(new_channel, verified)
+
+    def cancel_download(self, channel):
+        """通知服务器停止发送该通道的数据"""
+        try:
+            self.send_message({'type': 'file_cancel', 'channel': channel})
+        except OSError:
+            pass
+
+    def finish_file_data(self, channel):
+        """文件接收完成"""
+        transfer = self.incoming_files.pop(channel)
+        self.close_p2p(transfer)
+        transfer['file'].close()
+        os.replace(transfer['part_path'], transfer['save_path'])
+        self.update_download_state(transfer['save_path'], None)
+        self.notice(f"文件 {transfer['filename']} 接收完成")
+        self.end_transfer(transfer['task'], transfer['save_path'])
+
+    def handle_file_aborted(self, channel, reason):
+        """服务器中止了该通道上的文件传输"""
+        with self.transfer_lock:
+            transfer = self.incoming_files.pop(channel, None)
+            if transfer is None:
+                return
+            self.close_p2p(transfer)
+            self.remove_partial_file(transfer)
+        self.notice(f"文件 {transfer['filename']} 接收中断: {reason}")
+        self.end_transfer(transfer['task'], error=reason)
+
+    def abort_incoming_files(self):
+        """连接断开时保留未完成的文件，下次连接后继续下载"""
+        with self.transfer_lock:
+            transfers = list(self.incoming_files.values())
+            self.incoming_files.clear()
+        for transfer in transfers:
+            self.close_p2p(transfer)
+            try:
+                transfer['file'].close()
+            except:
+                pass
+            self.end_transfer(transfer['task'], error="与服务器的连接已断开")
+
+    def request_p2p(self, transfer, offset):
+        """临时监听一个端口，请服务器把地址和一次性令牌转给发送者，由发送者直接连过来"""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('', 0))
+            listener.listen(1)
+        except OSError:
+            listener.close()
+            self.request_relay(transfer)
+            return
+        listener.settimeout(P2P_ACCEPT_TIMEOUT)
+        transfer['p2p'] = {
+            'listener': listener,
+            'sock': None,
+            'token': None,  # 服务器回复 p2p_token 后设置
+            'token_ready': threading.Event()
+        }
+        threading.Thread(target=self.accept_p2p, args=(transfer, transfer['channel']),
+                         daemon=True).start()
+        self.send_message({
+            'type': 'p2p_request',
+            'to': transfer['sender'],
+            'file_id': transfer['file_id'],
+            'channel': transfer['channel'],
+            'offset': offset,
+            'port': listener.getsockname()[1]
+        })
+
+    def accept_p2p(self, transfer, channel):
+        """直连接收线程：等待出示正确令牌的连接，然后像从服务器下载一样接收分块清单和数据帧"""
+        p2p = transfer['p2p']
+        try:
+            while True:
+                sock, _ = p2p['listener'].accept()
+                sock.settimeout(P2P_ACCEPT_TIMEOUT)
+                parser = FrameParser(RECV_BUFFER_SIZE)
+                frames = []
+                while frames == []:
+                    frames = parser.read_from(sock)
+                hello = None
+                if frames and frames[0].type == FRAME_JSON:
+                    hello = decode_message(frames[0].payload, frames[0].flags)
+                if (hello is not None and hello.get('type') == 'p2p_hello'
+                        and p2p['token_ready'].wait(P2P_ACCEPT_TIMEOUT)
+                        and hmac.compare_digest(str(hello.get('token')), p2p['token'])):
+                    break
+                # 令牌不对的连接直接关闭，继续等待
+                sock.close()
+            # 令牌只能使用一次
+            p2p['listener'].close()
+            p2p['sock'] = sock
+            sock.settimeout(None)
+            frames = frames[1:]
+            while frames is not None:
+                for frame in frames:
+                    if self.incoming_files.get(channel) is not transfer:
+                        return
+                    if frame.type == FRAME_DATA:
+                        self.handle_file_data(channel, decompress_payload(frame.payload, frame.flags))
+                    elif frame.type == FRAME_JSON:
+                        message = decode_message(frame.payload, frame.flags)
+                        if message['type'] == 'file_meta':
+                            # 清单来自对方客户端，先确认与文件ID一致
+                            validate_manifest(transfer['file_id'], transfer['filesize'],
+                                              message['chunk_hashes'])
+                            self.handle_file_meta(message)
+                frames = parser.read_from(sock)
+        except (OSError, ProtocolError, ValueError):
+            pass
+        # 连接失败或中途断开，从最后校验通过的位置改由服务器中转
+        with self.transfer_lock:
+            if self.incoming_files.get(channel) is not transfer or transfer['p2p'] is not p2p:
+                return
+            self.close_p2p(transfer)
+            transfer['p2p'] = None
+            verified = transfer['verifier'].verified if transfer['verifier'] else transfer['received']
+            transfer['verifier'] = None
+            transfer['file'].truncate(verified)
+            transfer['file'].seek(verified)
+            transfer['received'] = verified
+            self.notice(f"无法直连 {transfer['sender']}，文件 {transfer['filename']} 改由服务器中转")
+            self.request_relay(transfer)
+
+    def handle_p2p_token(self, message):
+        """服务器为直连下载生成的一次性令牌，发送者连接时必须出示"""
+        transfer = self.incoming_files.get(message['channel'])
+        if transfer is None or transfer['p2p'] is None:
+            return
+        transfer['p2p']['token'] = message['token']
+        transfer['p2p']['token_ready'].set()
+
+    def close_p2p(self, transfer):
+        """关闭直连下载的监听端口和连接，接收线程随之结束"""
+        p2p = transfer.get('p2p')
+        if p2p is None:
+            return
+        for sock in (p2p['listener'], p2p['sock']):
+            if sock is None:
+                continue
+            # 先 shutdown 唤醒阻塞在 accept/recv 中的接收线程
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def request_relay(self, transfer):
+        """请服务器中转：服务器没有该文件时由发送者补传，准备好后收到 p2p_relay_ready"""
+        transfer['relay_wait'] = True
+        self.send_message({
+            'type': 'p2p_relay',
+            'to': transfer['sender'],
+            'file_id': transfer['file_id']
+        })
+
+    def handle_p2p_relay_ready(self, message):
+        """文件已在服务器上，等待中转的下载从已接收的位置开始向服务器请求"""
+        with self.transfer_lock:
+            for channel, transfer in list(self.incoming_files.items()):
+                if transfer['file_id'] == message['file_id'] and transfer['relay_wait']:
+                    transfer['relay_wait'] = False
+                    self.request_file_range(channel, transfer['received'])
+
+    def handle_p2p_failed(self, message):
+        """直连请求或中转请求送达前发送者已经离线"""
+        if message['request'] == 'p2p_connect':
+            # 关闭监听端口，接收线程随即改由服务器中转（服务器上可能已有该文件）
+            for transfer in list(self.incoming_files.values()):
+                if transfer['file_id'] == message['file_id'] and transfer['p2p'] is not None:
+                    self.close_p2p(transfer)
+            return
+        for channel, transfer in list(self.incoming_files.items()):
+            if transfer['file_id'] == message['file_id'] and transfer['relay_wait']:
+                self.handle_file_aborted(channel, message.get('reason', ''))
+
+    def serve_p2p(self, message):
+        """发送方：连接接收方临时监听的地址，出示令牌后发送分块清单和文件数据"""
+        shared = self.shared_files.get(message['file_id'])
+        offset = message.get('offset', 0)
+        if shared is None or not 0 <= offset <= shared['filesize']:
+            return
+        receiver = message['sender']
+        try:
+            sock = socket.create_connection(tuple(message['address']), timeout=P2P_CONNECT_TIMEOUT)
+        except (OSError, ValueError, TypeError) as e:
+            # 接收方等待超时后会请本机把文件补传到服务器
+            self.notice(f"无法直连 {receiver}: {e}")
+            return
+        sock.settimeout(None)
+        tune_socket(sock)
+
+        channel = message['channel']
+        length = shared['filesize'] - offset
+        outbound = OutboundQueue()
+        outbound.put(encode_message({'type': 'p2p_hello', 'token': message['token']}))
+        outbound.put(encode_message({
+            'type': 'file_meta',
+            'channel': channel,
+            'file_id': message['file_id'],
+            'filesize': shared['filesize'],
+            'chunk_size': CHUNK_SIZE,
+            'chunk_hashes': shared['chunk_hashes'],
+            'offset': offset,
+            'length': length
+        }))
+        # 局域网内直连不压缩，数据用 sendfile 直接发送
+        stream = FileStream(shared['path'], channel, length, offset, FILE_CHUNK_SIZE)
+        outbound.put_stream(stream)
+
+        def cancel():
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        task = Transfer('p2p_send', shared['filename'], shared['filesize'])
+        self.start_transfer(task, lambda: stream.position, cancel)
+        try:
+            outbound.write_to(sock)
+            # 等接收方收完后关闭连接
+            sock.shutdown(socket.SHUT_WR)
+            while sock.recv(4096):
+                pass
+            done = stream.done
+        except OSError:
+            done = False
+        finally:
+            outbound.close()
+            sock.close()
+        if done:
+            self.notice(f"文件 {shared['filename']} 已直接发送给 {receiver}")
+            self.end_transfer(task, 'ok')
+        else:
+            self.notice(f"直连发送文件 {shared['filename']} 给 {receiver} 中断")
+            self.end_transfer(task, error="直连中断")
+
+    def handle_p2p_relay(self, message):
+        """直连失败的接收方请本机把文件上传到服务器中转"""
+        shared = self.shared_files.get(message['file_id'])
+        if shared is None:
+            return
+        task = Transfer('upload', shared['filename'], shared['filesize'])
+        self.executor.submit(self.offer_file, task, shared['path'], relay_for=message['sender'])
+
+    def remove_partial_file(self, transfer):
+        """关闭并删除未完成的文件"""
+        try:
+            transfer['file'].close()
+            os.remove(transfer['part_path'])
+        except:
+            pass
+        self.update_download_state(transfer['save_path'], None)
+
+    def resume_downloads(self):
+        """登录后在后台继续上次未完成的下载"""
+        for save_path, entry in list(self.download_state.items()):
+            if not os.path.exists(save_path + PART_SUFFIX):
+                self.update_download_state(save_path, None)
+                continue
+            self.notice(f"继续下载文件 {entry['filename']}")
+            self.download(entry, save_path)
+
+    def update_download_state(self, save_path, entry):
+        """记录（entry 为 None 时删除）一个未完成的下载并保存，可以在任何线程中调用"""
+        with self.state_lock:
+            if entry is None:
+                self.download_state.pop(save_path, None)
+            else:
+                self.download_state[save_path] = entry
+            self.save_download_state()
+
+    def load_download_state(self):
+        """读取未完成下载的记录"""
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_download_state(self):
+        """保存未完成下载的记录"""
+        with self.state_lock:
+            try:
+                os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+                with open(self.state_file, 'w', encoding='utf-8') as f:
+                    json.dump(self.download_state, f, ensure_ascii=False)
+            except OSError as e:
+                print(f"保存下载记录失败: {e}")
+
+
+class AsyncChatClient:
+    """ChatSession 的 asyncio 接口
+
+    发送方法不是协程：放入发送队列后立即返回，连续调用即流水线发送。
+    收到的事件通过 async for 逐个取出，收到 disconnected 事件后迭代结束。
+    send_file 和 download 返回的 Transfer 可以直接 await。
+
+        async with AsyncChatClient() as client:
+            await client.connect(('192.168.1.5', 5000), 'alice')
+            client.send_text('大家好')
+            async for event in client:
+                ...
+    """
+
+    def __init__(self, state_file=DOWNLOAD_STATE_FILE, auto_reconnect=True):
+        self.session = ChatSession(self._on_event, state_file, auto_reconnect)
+        self._loop = None
+        self._events = None
+        self._finished = False
+
+    def _on_event(self, event):
+        # 在网络线程中调用，转交给事件循环
+        try:
+            self._loop.call_soon_threadsafe(self._events.put_nowait, event)
+        except RuntimeError:
+            pass  # 事件循环已经关闭
+
+    async def connect(self, address, username):
+        """连接并登录，用户名已被占用时抛出 LoginError"""
+        self._loop = asyncio.get_running_loop()
+        self._events = asyncio.Queue()
+        self._finished = False
+        await self._loop.run_in_executor(None, self.session.open, address, username)
+
+    @property
+    def username(self):
+        return self.session.username
+
+    @property
+    def rooms(self):
+        return self.session.rooms
+
+    def send_text(self, content, room=DEFAULT_ROOM):
+        return self.session.send_text(content, room)
+
+    def send_direct(self, to, content):
+        return self.session.send_direct(to, content)
+
+    def join_room(self, room):
+        self.session.join_room(room)
+
+    def leave_room(self, room):
+        self.session.leave_room(room)
+
+    def send_file(self, path, room=DEFAULT_ROOM, to=None, p2p=False):
+        return self.session.send_file(path, room, to, p2p)
+
+    def download(self, message, save_path):
+        return self.session.download(message, save_path)
+
+    async def next_event(self):
+        """等待下一个事件，连接已断开并且事件都已取出时返回 None"""
+        if self._finished:
+            return None
+        event = await self._events.get()
+        if event['type'] == 'disconnected':
+            self._finished = True
+        return event
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.next_event()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    async def close(self):
+        # close 会短暂等待服务器确认退出，放到线程池中执行
+        await asyncio.get_running_loop().run_in_executor(None, self.session.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
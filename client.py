@@ -1,11 +1,93 @@
-import socket
+import time
+import queue
 import threading
-import json
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, simpledialog
 import os
-import time
 import datetime
+from protocol import DEFAULT_ROOM
+from discovery import discover, parse_address
+from chat_core import ChatSession, DEFAULT_PORT
+
+# 传输进度刷新间隔（毫秒），进度由界面定时读取，不随数据帧刷新
+PROGRESS_INTERVAL = 250
+
+# 主线程处理界面事件的间隔（毫秒）和每次最多处理的事件数
+UI_INTERVAL = 50
+MAX_UI_EVENTS = 1000
+
+# 传输列表中各类传输的说明
+TRANSFER_LABELS = {'upload': '发送', 'download': '接收', 'p2p_send': '直连发送'}
+
+# 聊天记录最多保留的行数，超出后一次删掉最早的 SCROLLBACK_TRIM 行
+MAX_SCROLLBACK_LINES = 5000
+SCROLLBACK_TRIM = 500
+
+
+def format_size(size):
+    """把字节数格式化为便于阅读的形式"""
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+class TransferPanel:
+    """聊天记录下方的文件传输列表，每个传输一行：进度条、速度和取消按钮
+
+    传输在后台线程中进行，面板在主线程中定时读取进度，刷新频率与数据帧的数量无关。
+    所有方法都只能在主线程中调用。
+    """
+
+    def __init__(self, window, parent):
+        self.window = window
+        self.frame = ttk.Frame(parent)
+        self.rows = {}  # {传输ID: 该行的控件和进度}
+        self.polling = False
+
+    def add(self, transfer_id, label, total, get_position, cancel):
+        """添加一个传输，get_position 返回已完成的字节数，cancel 在点击取消时调用"""
+        row = ttk.Frame(self.frame)
+        row.pack(fill=tk.X, pady=1)
+        ttk.Label(row, text=label, width=30, anchor='w').pack(side=tk.LEFT)
+        bar = ttk.Progressbar(row, maximum=max(total, 1), length=240)
+        bar.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        status = ttk.Label(row, width=20, anchor='w')
+        status.pack(side=tk.LEFT)
+        ttk.Button(row, text="取消", command=cancel).pack(side=tk.LEFT)
+        self.rows[transfer_id] = {
+            'frame': row,
+            'bar': bar,
+            'status': status,
+            'total': total,
+            'get_position': get_position,
+            'last': (time.time(), get_position())
+        }
+        if not self.polling:
+            self.polling = True
+            self.window.after(PROGRESS_INTERVAL, self.refresh)
+
+    def remove(self, transfer_id):
+        row = self.rows.pop(transfer_id, None)
+        if row is not None:
+            row['frame'].destroy()
+
+    def refresh(self):
+        """定时刷新所有传输的进度和速度"""
+        now = time.time()
+        for row in self.rows.values():
+            position = row['get_position']()
+            last_time, last_position = row['last']
+            speed = (position - last_position) / max(now - last_time, 0.001)
+            row['last'] = (now, position)
+            row['bar']['value'] = position
+            percent = position / row['total'] * 100 if row['total'] else 100.0
+            row['status']['text'] = f"{percent:.1f}%  {format_size(max(speed, 0))}/s"
+        if self.rows:
+            self.window.after(PROGRESS_INTERVAL, self.refresh)
+        else:
+            self.polling = False
 
 
 class ChatClient:
@@ -24,11 +106,17 @@ class ChatClient:
         self.window.title("牛马聚集地")
         print("设置窗口属性成功")
 
-        # 创建Socket连接
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # 连接、消息收发和文件传输由 ChatSession 完成，这里只负责显示和用户操作
+        self.session = ChatSession(self.handle_session_event)
+        self.history_shown = False  # 是否已显示过登录时补发的历史消息
+        self.servers = []  # 局域网中发现的服务器，按负载从低到高排列
+        self.discovering = False
+        # 网络线程产生的界面事件，由主线程定时批量处理（Tk 控件只能在主线程中操作）
+        self.ui_events = queue.Queue()
 
         # 设置GUI
         self.setup_gui()
+        self.window.after(UI_INTERVAL, self.process_ui_events)
         print("GUI设置完成")
 
     def setup_gui(self):
@@ -58,12 +146,22 @@ class ChatClient:
         # 服务器地址选择
         ttk.Label(frame, text="选择连接方式:", font=('Arial', 10)).pack(anchor='w', pady=(0, 5))
 
-        self.connect_var = tk.StringVar(value="local")
+        self.connect_var = tk.StringVar(value="auto")
+        ttk.Radiobutton(frame, text="自动发现局域网服务器", variable=self.connect_var,
+                        value="auto", command=self.update_server_entry).pack(anchor='w')
         ttk.Radiobutton(frame, text="本机测试 (localhost)", variable=self.connect_var,
                         value="local", command=self.update_server_entry).pack(anchor='w')
         ttk.Radiobutton(frame, text="连接到其他电脑", variable=self.connect_var,
                         value="remote", command=self.update_server_entry).pack(anchor='w')
 
+        # 发现的服务器列表，默认选中负载最低的一个
+        discovery_frame = ttk.Frame(frame)
+        discovery_frame.pack(fill=tk.X, pady=(10, 0))
+        self.server_box = ttk.Combobox(discovery_frame, state='readonly')
+        self.server_box.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.server_box.bind('<<ComboboxSelected>>', self.select_server)
+        ttk.Button(discovery_frame, text="刷新", command=self.refresh_servers).pack(side=tk.LEFT, padx=5)
+
         server_frame = ttk.Frame(frame)
         server_frame.pack(fill=tk.X, pady=10)
         ttk.Label(server_frame, text="服务器地址:").pack(side=tk.LEFT)
@@ -82,7 +180,8 @@ class ChatClient:
                    style='Accent.TButton').pack(pady=20)
 
         # 提示信息
-        help_text = "提示：\n1. 确保已经有人启动了聊天服务器\n2. 如果连接其他电脑，输入对方的IP地址"
+        help_text = ("提示：\n1. 确保已经有人启动了聊天服务器\n"
+                     "2. 自动发现找不到服务器时，选择连接到其他电脑并输入对方的IP地址（可带 :端口）")
         ttk.Label(frame, text=help_text, foreground='gray').pack()
 
         self.update_server_entry()  # 初始化服务器地址
@@ -96,16 +195,74 @@ class ChatClient:
 
     def update_server_entry(self):
         """根据选择更新服务器地址输入框"""
-        if self.connect_var.get() == "local":
-            self.server_entry.delete(0, tk.END)
-            self.server_entry.insert(0, "localhost")
-            self.server_entry.config(state='disabled')
+        mode = self.connect_var.get()
+        if mode == "auto":
+            self.set_server_entry(self.format_address(self.servers[0]) if self.servers else "")
+            self.refresh_servers()
+        elif mode == "local":
+            self.set_server_entry("localhost")
         else:
             self.server_entry.config(state='normal')
             self.server_entry.delete(0, tk.END)
 
+    def set_server_entry(self, address):
+        """填入服务器地址，自动发现和本机测试时不允许修改"""
+        self.server_entry.config(state='normal')
+        self.server_entry.delete(0, tk.END)
+        self.server_entry.insert(0, address)
+        self.server_entry.config(state='disabled')
+
+    def format_address(self, server):
+        return f"{server['address']}:{server['port']}"
+
+    def refresh_servers(self):
+        """在后台广播探测局域网中的服务器，结果交给主线程显示"""
+        if self.discovering:
+            return
+        self.discovering = True
+
+        def run():
+            servers = discover()
+            self.post(self.show_servers, servers)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def show_servers(self, servers):
+        """显示发现的服务器（主线程），自动发现时选中负载最低的一个"""
+        self.discovering = False
+        self.servers = servers
+        self.server_box['values'] = [
+            f"{server['name']} ({self.format_address(server)}) 在线 {server['load']}/{server['capacity']}"
+            for server in servers
+        ] or ["未发现服务器"]
+        self.server_box.current(0)
+        if self.connect_var.get() == "auto":
+            self.set_server_entry(self.format_address(servers[0]) if servers else "")
+
+    def select_server(self, event=None):
+        """在列表中选择了其他服务器"""
+        index = self.server_box.current()
+        if 0 <= index < len(self.servers):
+            self.connect_var.set("auto")
+            self.set_server_entry(self.format_address(self.servers[index]))
+
     def setup_chat_window(self):
         """设置主聊天窗口的控件"""
+        # 房间选择：发送的消息和文件只发给当前房间的成员
+        self.room_frame = ttk.Frame(self.window)
+        self.room_frame.pack(fill=tk.X, padx=5, pady=(5, 0))
+        ttk.Label(self.room_frame, text="当前房间:").pack(side=tk.LEFT)
+        self.room_var = tk.StringVar(value=DEFAULT_ROOM)
+        self.room_box = ttk.Combobox(self.room_frame, textvariable=self.room_var,
+                                     values=self.session.rooms, state='readonly', width=16)
+        self.room_box.pack(side=tk.LEFT, padx=5)
+        ttk.Button(self.room_frame, text="加入房间", command=self.join_room).pack(side=tk.LEFT)
+        ttk.Button(self.room_frame, text="离开房间", command=self.leave_room).pack(side=tk.LEFT, padx=5)
+        # 私聊对象：填写用户名后消息和文件只发给该用户，留空则发到当前房间
+        ttk.Label(self.room_frame, text="私聊对象:").pack(side=tk.LEFT, padx=(15, 0))
+        self.direct_entry = ttk.Entry(self.room_frame, width=16)
+        self.direct_entry.pack(side=tk.LEFT, padx=5)
+
         # 聊天记录区域
         self.chat_frame = ttk.Frame(self.window)
         self.chat_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
@@ -118,9 +275,9 @@ class ChatClient:
         self.chat_text.tag_configure('newest', foreground='red')
         self.chat_text.tag_configure('second_newest', foreground='green')
 
-        # 存储最后两条消息的位置
-        self.last_position = None
-        self.second_last_position = None
+        # 文件传输列表
+        self.transfers = TransferPanel(self.window, self.window)
+        self.transfers.frame.pack(fill=tk.X, padx=5)
 
         # 输入区域
         self.input_frame = ttk.Frame(self.window)
@@ -136,6 +293,10 @@ class ChatClient:
         self.file_button = ttk.Button(self.input_frame, text="发送文件", command=self.send_file)
         self.file_button.pack(side=tk.LEFT)
 
+        # 直连传输：接收方直接从本机下载，文件数据不经过服务器
+        self.p2p_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.input_frame, text="直连", variable=self.p2p_var).pack(side=tk.LEFT, padx=5)
+
     def connect_to_server(self):
         """连接到服务器"""
         try:
@@ -146,57 +307,46 @@ class ChatClient:
                 messagebox.showerror("错误", "请输入用户名")
                 return
 
-            # 创建新的socket连接
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((server_address, 5000))
+            if not server_address and self.connect_var.get() == "auto":
+                # 后台的发现还没有结果，直接探测一次（不到半秒）
+                self.show_servers(discover())
+                if not self.servers:
+                    messagebox.showerror("错误", "未发现局域网中的服务器，请手动输入服务器地址")
+                    return
+                server_address = self.format_address(self.servers[0])
+
+            self.session.connect(parse_address(server_address, DEFAULT_PORT))
 
             # 发送用户名并等待验证
-            while True:
-                self.client_socket.send(self.username.encode())
-                response = self.client_socket.recv(1024).decode()
-
-                if response == "USERNAME_ACCEPTED":
-                    break
-                elif response == "USERNAME_TAKEN":
-                    new_username = self.handle_username_taken()
-                    if not new_username:  # 用户取消了输入
-                        self.client_socket.close()
-                        self.client_socket = None
-                        return
-                    self.username = new_username
-                else:
-                    raise Exception("未知的服务器响应")
+            while not self.session.login(self.username):
+                new_username = self.handle_username_taken()
+                if not new_username:  # 用户取消了输入
+                    self.session.close()
+                    return
+                self.username = new_username
 
-            # 开启接收消息的线程
-            receive_thread = threading.Thread(target=self.receive_messages)
-            receive_thread.daemon = True
-            receive_thread.start()
+            # 开启发送和接收线程
+            self.session.start()
 
             self.login_window.destroy()
             self.window.deiconify()  # 显示主窗口
 
         except Exception as e:
             messagebox.showerror("错误", f"连接失败: {str(e)}")
-            if self.client_socket:
-                try:
-                    self.client_socket.close()
-                    self.client_socket = None
-                except:
-                    pass
+            self.session.close()
 
     def send_message(self):
         """发送文本消息"""
         message = self.message_entry.get()
         if message:
             try:
-                # 添加当前时间
-                current_time = datetime.datetime.now().strftime("%H:%M:%S")
-                data = json.dumps({
-                    'type': 'text',
-                    'content': message,
-                    'time': current_time
-                })
-                self.client_socket.send(data.encode())
+                target = self.direct_entry.get().strip()
+                if target:
+                    # 私聊消息不会发回给自己，直接显示
+                    sent = self.session.send_direct(target, message)
+                    self.append_message(f"[{sent['time']}] [私聊 → {target}] {self.username}: {message}")
+                else:
+                    self.session.send_text(message, self.room_var.get())
                 self.message_entry.delete(0, tk.END)
             except:
                 messagebox.showerror("错误", "发送消息失败")
@@ -207,156 +357,207 @@ class ChatClient:
         if filename:
             try:
                 filesize = os.path.getsize(filename)
-                current_time = datetime.datetime.now().strftime("%H:%M:%S")
 
                 # 修改为1GB限制
                 if filesize > 1024 * 1024 * 1024:  # 1GB限制
                     messagebox.showerror("错误", "文件太大，请选择小于1GB的文件")
                     return
 
-                data = json.dumps({
-                    'type': 'file',
-                    'filename': os.path.basename(filename),
-                    'filesize': filesize,
-                    'time': current_time
-                })
-                self.client_socket.send(data.encode())
-
-                time.sleep(0.1)
-
-                # 添加初始进度显示
-                self.append_message("\n")
-                progress_line = self.chat_text.index('end-2c linestart')
-
-                with open(filename, 'rb') as f:
-                    bytes_sent = 0
-                    while bytes_sent < filesize:
-                        chunk = f.read(min(1024, filesize - bytes_sent))
-                        if not chunk:
-                            break
-                        self.client_socket.send(chunk)
-                        bytes_sent += len(chunk)
-
-                        # 更新进度条
-                        progress = (bytes_sent / filesize) * 100
-                        progress_text = f"\r发送: {self.create_progress_bar(progress)}"
-
-                        # 更新进度显示
-                        self.chat_text.delete(progress_line, f"{progress_line} lineend")
-                        self.chat_text.insert(progress_line, progress_text)
-                        self.chat_text.see(progress_line)
-
-                # 显示100%进度
-                final_progress_text = f"\r发送: {self.create_progress_bar(100.0)}\n"
-                self.chat_text.delete(progress_line, f"{progress_line} lineend")
-                self.chat_text.insert(progress_line, final_progress_text)
-
-                # 直接添加完成消息
-                current_time = datetime.datetime.now().strftime("%H:%M:%S")
-                self.append_message(f"[{current_time}] 文件 {os.path.basename(filename)} 发送成功")
-
-            except ConnectionError:
-                messagebox.showerror("错误", "连接断开，文件发送失败")
+                # 计算哈希和发送都在后台进行，发送期间仍可以聊天
+                self.session.send_file(filename, self.room_var.get(),
+                                       self.direct_entry.get().strip() or None, self.p2p_var.get())
             except Exception as e:
                 messagebox.showerror("错误", f"发送文件失败: {str(e)}")
 
-    def receive_messages(self):
-        """接收消息"""
-        while True:
-            try:
-                data = self.client_socket.recv(1024).decode()
-                if not data:
-                    break
-
-                try:
-                    message = json.loads(data)
-                    if message['type'] == 'file_notification':
-                        self.handle_incoming_file(message)
-                    else:
-                        self.append_message(data)
-                except json.JSONDecodeError:
-                    self.append_message(data)
-
-            except:
-                break
+    def handle_session_event(self, event):
+        """ChatSession 的事件（网络线程），聊天消息直接排队显示，其他事件交给主线程处理"""
+        kind = event['type']
+        if kind in ('text', 'system', 'direct'):
+            self.append_message(self.format_message(event))
+        elif kind == 'notice':
+            self.append_message(event['text'])
+        elif kind == 'history':
+            self.show_history(event)
+        elif kind == 'direct_failed':
+            current_time = datetime.datetime.now().strftime("%H:%M:%S")
+            self.append_message(f"[{current_time}] 私聊发送失败: {event.get('reason', '')}")
+        elif kind == 'file_notification':
+            self.post(self.handle_incoming_file, event)
+        elif kind == 'room_result':
+            self.post(self.handle_room_result, event)
+        elif kind == 'transfer_started':
+            transfer = event['transfer']
+            self.post(self.transfers.add, transfer.id,
+                      f"{TRANSFER_LABELS[transfer.kind]} {transfer.filename}", transfer.total,
+                      lambda: transfer.position, transfer.cancel)
+        elif kind == 'transfer_finished':
+            self.post(self.transfers.remove, event['transfer'].id)
+        elif kind == 'error':
+            self.post(messagebox.showerror, "错误", event['text'])
+        elif kind == 'reconnecting':
+            if event['attempt'] == 1:
+                current_time = datetime.datetime.now().strftime("%H:%M:%S")
+                self.append_message(f"[{current_time}] 与服务器的连接已断开，正在重新连接…")
+        elif kind == 'reconnected':
+            current_time = datetime.datetime.now().strftime("%H:%M:%S")
+            note = "" if event['resumed'] else "（会话已过期，重新加入聊天室）"
+            self.append_message(f"[{current_time}] 已重新连接{note}")
+        elif kind == 'disconnected':
+            self.post(self.handle_disconnect)
 
+    def handle_disconnect(self):
+        """连接断开（主线程）"""
         messagebox.showinfo("提示", "与服务器的连接已断开")
         self.window.quit()
 
+    def post(self, func, *args):
+        """把界面操作交给主线程执行，可以在任何线程中调用"""
+        self.ui_events.put((func, args))
+
+    def process_ui_events(self):
+        """主线程定时批量处理界面事件，连续的聊天消息合并成一次插入"""
+        lines = []
+        try:
+            for _ in range(MAX_UI_EVENTS):
+                func, args = self.ui_events.get_nowait()
+                if func is None:
+                    lines.append(args)
+                    continue
+                # 保持先后顺序：先显示之前的消息再执行其他操作
+                if lines:
+                    self.render_messages(lines)
+                    lines = []
+                try:
+                    func(*args)
+                except Exception as e:
+                    print(f"处理界面事件时出错: {e}")
+        except queue.Empty:
+            pass
+        if lines:
+            self.render_messages(lines)
+        # 还有积压时尽快继续处理
+        self.window.after(1 if not self.ui_events.empty() else UI_INTERVAL, self.process_ui_events)
+
+    def format_message(self, message):
+        """聊天记录的显示文本，公共房间以外的消息带上房间名"""
+        prefix = f"[{message['time']}]"
+        room = message.get('room')
+        if room is not None and room != DEFAULT_ROOM:
+            prefix += f" [{room}]"
+        if message['type'] == 'text':
+            return f"{prefix} {message['sender']}: {message['content']}"
+        if message['type'] == 'direct':
+            return f"{prefix} [私聊] {message['sender']}: {message['content']}"
+        if message['type'] == 'file_notification':
+            return f"{prefix} {message['sender']} 分享了文件 {message['filename']}"
+        return f"{prefix} {message['content']}"
+
+    def show_history(self, message):
+        """显示登录时补发的聊天记录，历史中的文件通知只显示不提示接收"""
+        if message.get('truncated'):
+            self.append_message("—— 更早的消息已省略 ——")
+        for record in message['messages']:
+            self.append_message(self.format_message(record))
+        if self.history_shown:
+            # 重新连接后补发的只是断线期间错过的消息
+            self.append_message("—— 以上为断线期间的消息 ——")
+        else:
+            self.append_message("—— 以上为历史消息 ——")
+        self.history_shown = True
+
+    def join_room(self):
+        """输入房间名称并加入"""
+        room = simpledialog.askstring("加入房间", "房间名称:", parent=self.window)
+        if room and room.strip():
+            self.session.join_room(room.strip())
+
+    def leave_room(self):
+        """离开当前房间（公共房间不能离开）"""
+        room = self.room_var.get()
+        if room == DEFAULT_ROOM:
+            messagebox.showinfo("提示", "公共房间不能离开")
+            return
+        self.session.leave_room(room)
+
+    def handle_room_result(self, message):
+        """服务器对加入或离开房间的回复，在主线程中更新房间列表"""
+        room = message['room']
+        current_time = datetime.datetime.now().strftime("%H:%M:%S")
+        if message['status'] == 'joined':
+            self.room_var.set(room)
+            self.append_message(f"[{current_time}] 已加入房间 {room}")
+        elif message['status'] == 'left':
+            self.room_var.set(DEFAULT_ROOM)
+            self.append_message(f"[{current_time}] 已离开房间 {room}")
+        else:
+            messagebox.showerror("错误", f"无效的房间名称: {room}")
+            return
+        self.room_box['values'] = self.session.rooms
+
     def handle_incoming_file(self, message):
-        """处理接收到的文件"""
+        """处理接收到的文件通知，同意后才从服务器下载"""
         sender = message['sender']
         filename = message['filename']
-        filesize = message['filesize']
 
-        if messagebox.askyesno("文件接收", f"是否接收来自 {sender} 的文件 {filename}?"):
-            try:
-                save_path = filedialog.asksaveasfilename(
-                    defaultextension=".*",
-                    initialfile=filename
-                )
-
-                if not save_path:  # 用户取消了保存对话框
-                    # 丢弃接收到的文件数据
-                    self.discard_file_data(filesize)
-                    current_time = datetime.datetime.now().strftime("%H:%M:%S")
-                    self.append_message(f"[{current_time}] 已取消接收文件 {filename}")
-                    return
+        kind = "私发文件" if message.get('to') else "文件"
+        if messagebox.askyesno("文件接收", f"是否接收来自 {sender} 的{kind} {filename}?"):
+            save_path = filedialog.asksaveasfilename(
+                defaultextension=".*",
+                initialfile=filename
+            )
 
-                self.receive_file_data(save_path, filename, filesize)
+            if not save_path:  # 用户取消了保存对话框
+                current_time = datetime.datetime.now().strftime("%H:%M:%S")
+                self.append_message(f"[{current_time}] 已取消接收文件 {filename}")
+                return
 
-            except Exception as e:
-                messagebox.showerror("错误", f"接收文件失败: {str(e)}")
-                # 出现错误时也需要丢弃剩余的文件数据
-                self.discard_file_data(filesize)
+            # 续传校验等耗时操作在后台进行
+            self.session.download(message, save_path)
         else:
-            # 用户拒绝接收文件
-            self.discard_file_data(filesize)
+            # 用户拒绝接收文件，不会产生任何传输
             current_time = datetime.datetime.now().strftime("%H:%M:%S")
             self.append_message(f"[{current_time}] 已拒绝接收文件 {filename}")
 
     def append_message(self, message):
-        """添加消息到聊天记录"""
-        # 清除之前的颜色标签
-        self.chat_text.tag_remove('newest', '1.0', 'end')
-        self.chat_text.tag_remove('second_newest', '1.0', 'end')
-
-        # 记录新消息的开始位置
-        start_pos = self.chat_text.index('end-1c')
-
-        # 插入新消息
-        self.chat_text.insert('end', message + '\n')
-
-        # 记录新消息的结束位置
-        end_pos = self.chat_text.index('end-1c')
-
-        # 如果存在上一条消息的位置，将其标记为绿色
-        if self.last_position:
-            last_start, last_end = self.last_position
-            self.chat_text.tag_add('second_newest', last_start, last_end)
-
-        # 更新位置记录
-        self.second_last_position = self.last_position if self.last_position else None
-        self.last_position = (start_pos, end_pos)
-
-        # 将新消息标记为红色
-        self.chat_text.tag_add('newest', start_pos, end_pos)
-
+        """添加消息到聊天记录，可以在任何线程中调用，由主线程批量显示"""
+        self.ui_events.put((None, message))
+
+    def render_messages(self, lines):
+        """在主线程中一次插入多条消息，只改动最后两条消息的颜色标签"""
+        text = self.chat_text
+        # 原来的次新消息恢复普通颜色
+        ranges = text.tag_ranges('second_newest')
+        if ranges:
+            text.tag_remove('second_newest', ranges[0], ranges[-1])
+        # 原来的最新消息变为次新（新插入两条以上时恢复普通颜色）
+        ranges = text.tag_ranges('newest')
+        if ranges:
+            text.tag_remove('newest', ranges[0], ranges[-1])
+            if len(lines) == 1:
+                text.tag_add('second_newest', ranges[0], ranges[-1])
+
+        if len(lines) > 2:
+            text.insert('end', '\n'.join(lines[:-2]) + '\n')
+        if len(lines) >= 2:
+            text.insert('end', lines[-2] + '\n', 'second_newest')
+        # 最新消息标记为红色，次新消息为绿色
+        text.insert('end', lines[-1] + '\n', 'newest')
+
+        self.trim_scrollback()
         # 滚动到最新消息
-        self.chat_text.see('end')
+        text.see('end')
+
+    def trim_scrollback(self):
+        """聊天记录超过上限时删掉最早的部分，保持每条消息的显示开销不变"""
+        line_count = int(self.chat_text.index('end-1c').split('.')[0])
+        if line_count > MAX_SCROLLBACK_LINES + SCROLLBACK_TRIM:
+            self.chat_text.delete('1.0', f"{line_count - MAX_SCROLLBACK_LINES}.0")
 
     def handle_return(self, event):
         """处理回车键事件"""
         if self.message_entry.get().strip():  # 确保输入框不为空
             self.send_message()
 
-    def create_progress_bar(self, progress):
-        """创建进度条字符串"""
-        width = 30  # 进度条总长度
-        filled = int(width * progress / 100)  # 已完成的长度
-        bar = '=' * filled + '>' + '-' * (width - filled - 1)
-        return f"[{bar}] {progress:.1f}%"
-
     def handle_username_taken(self):
         """处理用户名被占用的情况"""
         while True:
@@ -375,63 +576,10 @@ class ChatClient:
 
             return new_username.strip()
 
-    def discard_file_data(self, filesize):
-        """丢弃文件数据"""
-        try:
-            received_size = 0
-            while received_size < filesize:
-                chunk_size = min(1024, filesize - received_size)
-                chunk = self.client_socket.recv(chunk_size)
-                if not chunk:
-                    break
-                received_size += len(chunk)
-        except Exception as e:
-            print(f"丢弃文件数据时出错: {e}")
-
-    def receive_file_data(self, save_path, filename, filesize):
-        """接收文件数据并保存"""
-        try:
-            # 添加初始进度显示
-            self.append_message("\n")
-            progress_line = self.chat_text.index('end-2c linestart')
-
-            with open(save_path, 'wb') as f:
-                received_size = 0
-                while received_size < filesize:
-                    chunk = self.client_socket.recv(min(1024, filesize - received_size))
-                    if not chunk:
-                        raise Exception("连接断开")
-                    f.write(chunk)
-                    received_size += len(chunk)
-
-                    # 更新进度条
-                    progress = (received_size / filesize) * 100
-                    progress_text = f"\r接收: {self.create_progress_bar(progress)}"
-
-                    # 更新进度显示
-                    self.chat_text.delete(progress_line, f"{progress_line} lineend")
-                    self.chat_text.insert(progress_line, progress_text)
-                    self.chat_text.see(progress_line)
-
-            # 显示100%进度
-            final_progress_text = f"\r接收: {self.create_progress_bar(100.0)}\n"
-            self.chat_text.delete(progress_line, f"{progress_line} lineend")
-            self.chat_text.insert(progress_line, final_progress_text)
-
-            # 直接添加完成消息
-            current_time = datetime.datetime.now().strftime("%H:%M:%S")
-            self.append_message(f"[{current_time}] 文件 {filename} 接收完成")
-
-        except Exception as e:
-            messagebox.showerror("错误", f"接收文件失败: {str(e)}")
-            try:
-                os.remove(save_path)
-            except:
-                pass
-
     def run(self):
         """运行客户端"""
         self.window.mainloop()
+        self.session.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+import json
+import time
+import uuid
+import socket
+import threading
+
+# 服务器发现使用的 UDP 端口
+DISCOVERY_PORT = 5001
+
+# 客户端发出探测后等待应答的时间（秒）
+DISCOVERY_TIMEOUT = 0.3
+
+# 服务器的设计容量（在线人数），与当前人数一起用于比较负载
+DEFAULT_CAPACITY = 200
+
+# 区分本程序的报文与局域网中其他 UDP 广播
+MAGIC = 'lan-chatroom'
+
+MAX_DATAGRAM = 2048
+
+
+def local_ip():
+    """本机在局域网中的 IP 地址，不需要访问外网
+
+    先查主机名对应的地址，没有非回环地址时再向一个私有地址做一次 UDP 路由查询
+    （connect 只选择出口网卡，不会发出任何数据）。
+    """
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            ip = info[4][0]
+            if not ip.startswith('127.'):
+                return ip
+    except OSError:
+        pass
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect(('10.254.254.254', 1))
+            return s.getsockname()[0]
+        finally:
+            s.close()
+    except OSError:
+        return '127.0.0.1'
+
+
+def parse_address(value, default_port):
+    """把 host 或 host:port 解析为地址元组"""
+    host, sep, port = value.strip().rpartition(':')
+    if not sep:
+        return value.strip(), default_port
+    if not host or not port.isdigit():
+        raise ValueError(f"无效的服务器地址: {value}")
+    return host, int(port)
+
+
+def load_ratio(server):
+    """服务器的负载比例，用于选出最空闲的服务器"""
+    return server['load'] / server['capacity'] if server['capacity'] > 0 else server['load']
+
+
+class Beacon:
+    """服务器一侧的发现应答
+
+    在 DISCOVERY_PORT 上接收客户端广播的探测，立即回复本服务器的端口、当前在线人数和容量。
+    load 为返回当前在线人数的函数。同一台电脑上的多个服务器可以同时监听该端口，
+    广播的探测每个服务器都会收到。
+    """
+
+    def __init__(self, port, load, capacity=DEFAULT_CAPACITY, name=None,
+                 discovery_port=DISCOVERY_PORT):
+        self.port = port
+        self.load = load
+        self.capacity = capacity
+        self.name = name or socket.gethostname()
+        self.discovery_port = discovery_port
+        self.id = uuid.uuid4().hex  # 同一服务器经不同地址应答时，客户端据此去重
+        self.sock = None
+
+    def start(self):
+        """开始应答，端口无法绑定时返回 False（不影响聊天服务本身）"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('', self.discovery_port))
+        except OSError as e:
+            sock.close()
+            print(f"服务器发现端口 {self.discovery_port} 绑定失败: {e}")
+            return False
+        self.sock = sock
+        threading.Thread(target=self._serve, daemon=True).start()
+        return True
+
+    def _serve(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(MAX_DATAGRAM)
+            except OSError:
+                return
+            try:
+                probe = json.loads(data.decode('utf-8'))
+            except ValueError:
+                continue
+            if not isinstance(probe, dict) or probe.get('magic') != MAGIC or probe.get('type') != 'discover':
+                continue
+            try:
+                self.sock.sendto(self.payload(), address)
+            except OSError:
+                pass
+
+    def payload(self):
+        return json.dumps({
+            'magic': MAGIC,
+            'type': 'beacon',
+            'id': self.id,
+            'name': self.name,
+            'port': self.port,
+            'load': self.load(),
+            'capacity': self.capacity
+        }, ensure_ascii=False).encode('utf-8')
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def discover(timeout=DISCOVERY_TIMEOUT, discovery_port=DISCOVERY_PORT):
+    """广播探测并收集应答，返回按负载从低到高排列的服务器列表
+
+    每项为 {'address': IP, 'port': 端口, 'name': 名称, 'load': 在线人数, 'capacity': 容量}。
+    除广播外还探测本机，没有局域网时也能找到本机上的服务器。
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    servers = {}
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        probe = json.dumps({'magic': MAGIC, 'type': 'discover'}).encode('utf-8')
+        for target in ('<broadcast>', '127.0.0.1'):
+            try:
+                sock.sendto(probe, (target, discovery_port))
+            except OSError:
+                pass
+        deadline = time.monotonic() + timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            sock.settimeout(left)
+            try:
+                data, address = sock.recvfrom(MAX_DATAGRAM)
+                beacon = json.loads(data.decode('utf-8'))
+            except socket.timeout:
+                break
+            except (OSError, ValueError):
+                continue
+            if (not isinstance(beacon, dict) or beacon.get('magic') != MAGIC
+                    or beacon.get('type') != 'beacon' or beacon.get('id') in servers):
+                continue
+            try:
+                servers[beacon['id']] = {
+                    'address': address[0],
+                    'port': int(beacon['port']),
+                    'name': str(beacon.get('name', address[0])),
+                    'load': int(beacon.get('load', 0)),
+                    'capacity': int(beacon.get('capacity', 0))
+                }
+            except (KeyError, TypeError, ValueError):
+                continue
+    finally:
+        sock.close()
+    return sorted(servers.values(), key=load_ratio)
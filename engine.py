@@ -0,0 +1,376 @@
+import time
+import queue
+import socket
+import selectors
+import threading
+from collections import deque
+
+from protocol import FrameParser, ProtocolError, DEFAULT_BUFFER_SIZE, LOGIN_FRAME_SIZE
+from outbound import OutboundQueue, QUEUED, OVERFLOW, tune_socket
+from heartbeat import HEARTBEAT_TICK
+
+
+# 事件循环中每个连接每次可写事件最多发送的字节数，保证各连接轮流得到服务
+WRITE_BUDGET = 1024 * 1024
+
+# 写线程被唤醒后等待的时间（秒），让同一时刻的多条消息合并成一次写入
+DEFAULT_COALESCE_DELAY = 0.001
+
+
+class ClientConnection:
+    """单个客户端连接及其协议状态"""
+
+    def __init__(self, sock, address, queue_options=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.sock = sock
+        self.address = address
+        tune_socket(sock)
+        self.username = None  # 登录成功前为 None
+        self.codec = None  # 登录时协商的压缩算法，None 表示不压缩
+        # 增量帧解析器，复用接收缓冲区；登录（或建立服务器间链路）后才允许大帧
+        self.parser = FrameParser(buffer_size, LOGIN_FRAME_SIZE)
+        self.uploads = {}  # 正在上传的文件 {通道号: 上传状态}
+        self.rooms = set()  # 已加入的房间
+        # 有界发送队列，由该连接自己的写线程或事件循环发送
+        self.outbound = OutboundQueue(**(queue_options or {}))
+        self.peer = None  # 服务器间链路对方的节点ID，普通客户端为 None
+        self.writing = False  # 事件循环引擎：是否已注册可写事件
+        self.messages_in = 0  # 收到的帧数
+        self.last_seen = time.monotonic()  # 最后一次收到数据的时间，用于心跳检测
+        self.ping_time = None  # 已发送、尚未得到回应的 ping 的时间
+        self.session = None  # 登录时签发的会话令牌，断线后凭它恢复登录
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class ThreadEngine:
+    """每个连接一个线程的引擎（原有实现）"""
+
+    name = 'thread'
+
+    def __init__(self, server):
+        self.server = server
+        self.lock = threading.Lock()
+        self.callbacks = queue.Queue()  # 其他线程交来的处理，由回调线程按顺序执行
+
+    def serve(self, server_socket):
+        threading.Thread(target=self._timer_loop, daemon=True).start()
+        threading.Thread(target=self._callback_loop, daemon=True).start()
+        while True:
+            client_socket, address = server_socket.accept()
+            print(f"新的连接来自: {address}")
+            self.server.metrics.accepted.inc()
+
+            # 开启新线程处理客户端连接
+            client_thread = threading.Thread(
+                target=self.server.handle_client,
+                args=(client_socket, address)
+            )
+            client_thread.start()
+
+    def _timer_loop(self):
+        """定时线程：每个 tick 处理一次到期的心跳和会话"""
+        while True:
+            time.sleep(HEARTBEAT_TICK)
+            self.server.run_timers()
+
+    def adopt(self, conn):
+        """接管一个已建立的连接（如主动连接其他服务器的链路）"""
+        threading.Thread(target=self.run_connection, args=(conn,), daemon=True).start()
+
+    def run_connection(self, conn):
+        """在当前线程中读取连接数据直到断开，发送由独立的写线程完成"""
+        self.server.metrics.track(conn)
+        if self.server.reaper is not None:
+            self.server.reaper.watch(conn)
+        threading.Thread(target=self._write_loop, args=(conn,), daemon=True).start()
+        try:
+            while True:
+                frames = conn.parser.read_from(conn.sock)
+                if frames is None:
+                    break
+                conn.last_seen = time.monotonic()
+                self.server.handle_frames(conn, frames)
+                if conn.closed:
+                    break
+        except ProtocolError as e:
+            print(f"协议错误，断开连接 {conn.address}: {e}")
+        except Exception as e:
+            print(f"处理客户端时出错: {e}")
+        finally:
+            self.close(conn)
+
+    def _write_loop(self, conn):
+        """写线程：依次发送队列中的数据，慢速连接只阻塞自己"""
+        delay = self.server.coalesce_delay
+        while conn.outbound.wait():
+            if delay:
+                time.sleep(delay)
+            start = time.perf_counter()
+            try:
+                conn.outbound.write_to(conn.sock)
+            except OSError:
+                self.close(conn)
+                return
+            self.server.metrics.write_time.observe(time.perf_counter() - start)
+
+    def send(self, conn, data, force=False):
+        """将数据放入连接的发送队列，返回是否成功入队"""
+        if conn.closed:
+            return False
+        status = conn.outbound.put(data, force)
+        if status == OVERFLOW:
+            print(f"连接 {conn.address} 发送队列超过高水位，断开慢速客户端")
+            self.close(conn)
+        return status == QUEUED
+
+    def call_soon(self, func, *args):
+        """让回调线程执行 func(*args)，可以在任何线程中调用
+
+        消息总线的读线程不直接执行处理：处理中可能要向总线发送（如断开慢速客户端后释放用户名），
+        在读线程中等待写入时就不能再读取总线发来的数据。
+        """
+        self.callbacks.put((func, args))
+
+    def _callback_loop(self):
+        while True:
+            func, args = self.callbacks.get()
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"处理回调时出错: {e}")
+
+    def send_stream(self, conn, stream):
+        """把文件流放入连接的发送队列"""
+        if conn.closed:
+            stream.close()
+            return
+        conn.outbound.put_stream(stream)
+
+    def close(self, conn):
+        with self.lock:
+            if conn.closed:
+                return
+            conn.closed = True
+        conn.outbound.close()
+        self.server.metrics.untrack(conn)
+        if self.server.reaper is not None:
+            self.server.reaper.unwatch(conn)
+        self.server.remove_client(conn)
+        try:
+            # 先 shutdown 以唤醒阻塞在 recv 上的读线程
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            conn.sock.close()
+        except OSError:
+            pass
+
+
+class SelectorEngine:
+    """基于 selectors 的单线程事件循环引擎，适合大量空闲连接"""
+
+    name = 'selector'
+
+    def __init__(self, server):
+        self.server = server
+        self.selector = selectors.DefaultSelector()
+        self.pending = {}  # 本轮事件中有新数据要发送的连接，按加入顺序保存
+        self.callbacks = deque()  # 其他线程交给事件循环执行的函数
+        # 其他线程写入一个字节唤醒阻塞在 select() 上的事件循环
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+
+    def serve(self, server_socket):
+        raise_fd_limit()
+        server_socket.setblocking(False)
+        self.selector.register(server_socket, selectors.EVENT_READ, None)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ, None)
+        next_tick = time.monotonic() + HEARTBEAT_TICK
+
+        while True:
+            # select() 至少每个 tick 返回一次，处理到期的心跳和会话
+            for key, mask in self.selector.select(max(0, next_tick - time.monotonic())):
+                if key.fileobj is self._wakeup_recv:
+                    self._run_callbacks()
+                    continue
+                if key.data is None:
+                    self._accept(key.fileobj)
+                    continue
+                conn = key.data
+                if mask & selectors.EVENT_READ:
+                    self._read(conn)
+                if mask & selectors.EVENT_WRITE and not conn.closed:
+                    self._write(conn)
+            if time.monotonic() >= next_tick:
+                next_tick = time.monotonic() + HEARTBEAT_TICK
+                self.server.run_timers()
+            self._flush()
+
+    def _flush(self):
+        """处理完一轮事件后统一发送，同一轮产生的多条消息合并成一次写入"""
+        pending, self.pending = self.pending, {}
+        for conn in pending:
+            if not conn.closed and not conn.writing:
+                self._write(conn)
+
+    def call_soon(self, func, *args):
+        """让事件循环线程执行 func(*args)，可以在任何线程中调用"""
+        self.callbacks.append((func, args))
+        try:
+            self._wakeup_send.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # 缓冲区已满说明已有未处理的唤醒
+            pass
+
+    def _run_callbacks(self):
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self.callbacks:
+            func, args = self.callbacks.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"执行回调时出错: {e}")
+
+    def adopt(self, conn):
+        """接管一个已建立的连接（如主动连接其他服务器的链路），可以在任何线程中调用"""
+        conn.sock.setblocking(False)
+        self.server.metrics.track(conn)
+        if self.server.reaper is not None:
+            self.server.reaper.watch(conn)
+        self.call_soon(self.selector.register, conn.sock, selectors.EVENT_READ, conn)
+
+    def _accept(self, server_socket):
+        # 一次唤醒尽可能多地接受排队的连接
+        while True:
+            try:
+                client_socket, address = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # 文件描述符耗尽等情况，稍后再试
+                print(f"接受连接失败: {e}")
+                return
+            print(f"新的连接来自: {address}")
+            self.server.metrics.accepted.inc()
+            client_socket.setblocking(False)
+            conn = ClientConnection(client_socket, address, self.server.queue_options,
+                                    self.server.recv_buffer_size)
+            self.server.metrics.track(conn)
+            if self.server.reaper is not None:
+                self.server.reaper.watch(conn)
+            self.selector.register(client_socket, selectors.EVENT_READ, conn)
+
+    def _read(self, conn):
+        try:
+            frames = conn.parser.read_from(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except ProtocolError as e:
+            print(f"协议错误，断开连接 {conn.address}: {e}")
+            self.close(conn)
+            return
+        except OSError:
+            self.close(conn)
+            return
+        if frames is None:
+            self.close(conn)
+            return
+        conn.last_seen = time.monotonic()
+        try:
+            self.server.handle_frames(conn, frames)
+        except Exception as e:
+            print(f"处理客户端时出错: {e}")
+            self.close(conn)
+
+    def _write(self, conn):
+        """套接字可写时尽量多地发送队列中的数据"""
+        start = time.perf_counter()
+        try:
+            conn.outbound.write_to(conn.sock, WRITE_BUDGET)
+        except OSError:
+            self.close(conn)
+            return
+        self.server.metrics.write_time.observe(time.perf_counter() - start)
+
+        want_write = len(conn.outbound) > 0
+        if want_write != conn.writing:
+            conn.writing = want_write
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want_write else 0)
+            self.selector.modify(conn.sock, events, conn)
+
+    def send(self, conn, data, force=False):
+        """将数据放入连接的发送队列，返回是否成功入队"""
+        if conn.closed:
+            return False
+        status = conn.outbound.put(data, force)
+        if status == OVERFLOW:
+            print(f"连接 {conn.address} 发送队列超过高水位，断开慢速客户端")
+            self.close(conn)
+            return False
+        if status == QUEUED and not conn.writing:
+            # 尚未等待可写事件时在本轮事件处理完后发送，剩余部分交给可写事件
+            self.pending[conn] = None
+        return status == QUEUED
+
+    def send_stream(self, conn, stream):
+        """把文件流放入连接的发送队列，由事件循环在可写时发送"""
+        if conn.closed:
+            stream.close()
+            return
+        conn.outbound.put_stream(stream)
+        if not conn.writing:
+            self.pending[conn] = None
+
+    def close(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        conn.outbound.close()
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        self.server.metrics.untrack(conn)
+        if self.server.reaper is not None:
+            self.server.reaper.unwatch(conn)
+        self.server.remove_client(conn)
+        try:
+            conn.sock.close()
+        except OSError:
+            pass
+
+
+ENGINES = {
+    ThreadEngine.name: ThreadEngine,
+    SelectorEngine.name: SelectorEngine,
+}
+
+
+def create_engine(name, server):
+    """根据名称创建服务器引擎"""
+    try:
+        return ENGINES[name](server)
+    except KeyError:
+        raise ValueError(f"未知的服务器引擎: {name}")
+
+
+def raise_fd_limit():
+    """尽量提高进程可打开的文件描述符上限（仅类 Unix 系统）"""
+    try:
+        import resource
+    except ImportError:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
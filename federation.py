@@ -0,0 +1,359 @@
+import hmac
+import time
+import socket
+import secrets
+import itertools
+import threading
+from collections import deque
+
+from bus import PRESENCE_ADD, PRESENCE_REMOVE
+from engine import ClientConnection
+from protocol import (FRAME_JSON, FRAME_DATA, MAX_CHANNEL, MAX_FRAME_SIZE, ProtocolError, negotiate_codec,
+                      decompress_payload, decode_message)
+
+# 主动连接其他服务器失败或断开后重试的间隔（秒）
+RETRY_INTERVAL = 3
+
+# 连接其他服务器的超时（秒）
+CONNECT_TIMEOUT = 5
+
+# 记住最近转发过的消息ID的数量，用于去重
+SEEN_SIZE = 10000
+
+
+def parse_peer(value):
+    """把 host:port 解析为地址元组"""
+    host, sep, port = value.rpartition(':')
+    if not sep or not host or not port.isdigit():
+        raise ValueError(f"无效的服务器地址: {value}")
+    return host, int(port)
+
+
+class Federation:
+    """服务器之间的互联
+
+    其他服务器像客户端一样连接到本服务器的端口，以 peer_hello 代替登录，之后这条连接就是
+    服务器间链路。本地广播的消息和在线状态带上全局唯一的消息ID转发给所有相连的服务器，
+    收到的消息记录到本地聊天记录并发给本地用户，再转发给除来源以外、尚未经过的服务器；
+    已经处理过的消息ID直接丢弃，所以任意拓扑（包括环）中每条消息在每台服务器上只出现一次。
+
+    其他服务器上的文件在本地用户第一次请求时才从通知它的服务器取回存入本地存储，
+    之后的请求直接由本地发送，每个文件只经过服务器间链路一次。
+    """
+
+    def __init__(self, server, node_id, peers=(), secret=None):
+        self.server = server
+        self.node_id = node_id
+        self.peers = list(peers)  # 主动连接的服务器地址 [(host, port)]
+        self.secret = secret  # 服务器间链路的共享密钥，None 表示不校验
+        self.lock = threading.RLock()
+        self.links = {}  # 已建立的链路 {连接: 对方节点ID}
+        self.dialed = {}  # 主动建立的连接 {连接: 断开时设置的事件}
+        self.remote_users = {}  # 其他服务器上的用户 {用户名: (来源链路, 所在节点ID)}
+        self.remote_files = {}  # 其他服务器上的文件 {文件ID: 通知它的链路}
+        self.fetches = {}  # 正在取回的文件 {(链路, 通道号): 取回状态}
+        self._seen = set()
+        self._seen_order = deque()
+        # 消息ID带上每次启动时随机生成的前缀，重启后计数从头开始也不会与其他服务器记住的旧ID重复
+        self._boot = secrets.token_hex(4)
+        self._ids = itertools.count(1)
+        self._channels = itertools.count()
+
+    def start(self):
+        """开始连接配置的其他服务器，断开后自动重连"""
+        for address in self.peers:
+            threading.Thread(target=self._dial_loop, args=(address,), daemon=True).start()
+
+    def _dial_loop(self, address):
+        while True:
+            try:
+                sock = socket.create_connection(address, timeout=CONNECT_TIMEOUT)
+            except OSError as e:
+                print(f"连接服务器 {address[0]}:{address[1]} 失败: {e}")
+                time.sleep(RETRY_INTERVAL)
+                continue
+            sock.settimeout(None)
+            conn = ClientConnection(sock, address, self.server.queue_options,
+                                    self.server.recv_buffer_size)
+            closed = threading.Event()
+            with self.lock:
+                self.dialed[conn] = closed
+            self.server.engine.adopt(conn)
+            self.server.engine.call_soon(self.send_hello, conn)
+            closed.wait()
+            time.sleep(RETRY_INTERVAL)
+
+    def send_hello(self, conn):
+        self.server.send_message(conn, {
+            'type': 'peer_hello',
+            'node': self.node_id,
+            'secret': self.secret,
+            'compression': list(self.server.compression)
+        })
+
+    def accept_link(self, conn, message):
+        """收到 peer_hello：校验后把连接作为服务器间链路"""
+        node = message.get('node')
+        if self.secret is not None and not hmac.compare_digest(str(message.get('secret')),
+                                                               self.secret):
+            print(f"服务器 {conn.address} 的密钥不正确，拒绝互联")
+            self.server.engine.close(conn)
+            return
+        if not isinstance(node, str) or node == self.node_id:
+            # 连接到了自己
+            self.server.engine.close(conn)
+            return
+        with self.lock:
+            if conn not in self.dialed:
+                self.send_hello(conn)
+            conn.peer = node
+            conn.codec = negotiate_codec(message.get('compression'), self.server.compression,
+                                         self.server.compression_level)
+            self.links[conn] = node
+            conn.parser.max_frame = MAX_FRAME_SIZE
+        print(f"已与服务器 {node} 互联")
+        self.sync_presence(conn)
+
+    def sync_presence(self, link):
+        """新链路建立后把本地和已知的其他服务器上的在线用户告诉对方"""
+        for conn in self.server.registry.snapshot():
+            self._send(link, self._envelope(self.node_id, [], presence={
+                'action': PRESENCE_ADD, 'username': conn.username,
+                'info': self.server.registry.info(conn.username)}))
+        with self.lock:
+            remote = [(username, node) for username, (source, node) in
+                      self.remote_users.items() if source is not link]
+        for username, node in remote:
+            self._send(link, self._envelope(node, [self.node_id], presence={
+                'action': PRESENCE_ADD, 'username': username, 'info': {'node': node}}))
+
+    def link_closed(self, link):
+        """链路断开：通过它得知的用户视为离开，正在取回的文件通知等待的客户端
+
+        link 不是服务器间链路时返回 False。
+        """
+        with self.lock:
+            closed = self.dialed.pop(link, None)
+            node = self.links.pop(link, None)
+            if closed is None and node is None:
+                return False
+            users = [username for username, (source, _) in self.remote_users.items()
+                     if source is link]
+            for username in users:
+                del self.remote_users[username]
+            for file_id in [file_id for file_id, source in self.remote_files.items()
+                            if source is link]:
+                del self.remote_files[file_id]
+            fetches = [key for key in self.fetches if key[0] is link]
+        if closed is not None:
+            closed.set()
+        if node is not None:
+            print(f"与服务器 {node} 的链路已断开")
+        for username in users:
+            self.server.notify_presence(PRESENCE_REMOVE, username)
+        for key in fetches:
+            self.fail_fetch(key, f"与服务器 {node} 的链路已断开")
+        return True
+
+    def relay_message(self, message):
+        """把本地广播的消息转发给所有相连的服务器"""
+        self._forward(self._envelope(self.node_id, [], message=message))
+
+    def relay_presence(self, action, username, info=None):
+        self._forward(self._envelope(self.node_id, [], presence={
+            'action': action, 'username': username, 'info': info}))
+
+    def has_user(self, username):
+        return username in self.remote_users
+
+    def send_direct(self, message, path=()):
+        """私聊消息沿着得知接收人的链路转发，接收人未知时返回 False"""
+        with self.lock:
+            entry = self.remote_users.get(message['to'])
+        if entry is None or self.links.get(entry[0]) in path:
+            return False
+        self._send(entry[0], {'type': 'direct', 'message': message,
+                              'path': list(path) + [self.node_id]})
+        return True
+
+    def handle_direct(self, link, relay):
+        """其他服务器转发来的私聊消息：接收人在本地则发送，否则继续转发"""
+        message = relay['message']
+        if message.get('type') in ('file_notification', 'p2p_relay_ready'):
+            with self.lock:
+                self.remote_files[message['file_id']] = link
+        if not self.server.deliver_direct(message):
+            self.send_direct(message, relay.get('path', []))
+
+    def _envelope(self, origin, path, **content):
+        relay_id = f"{self.node_id}:{self._boot}:{next(self._ids)}"
+        self._mark_seen(relay_id)
+        return dict(content, type='relay', id=relay_id, origin=origin, path=path)
+
+    def _mark_seen(self, relay_id):
+        """记录消息ID，已经见过时返回 False"""
+        with self.lock:
+            if relay_id in self._seen:
+                return False
+            self._seen.add(relay_id)
+            self._seen_order.append(relay_id)
+            if len(self._seen_order) > SEEN_SIZE:
+                self._seen.discard(self._seen_order.popleft())
+            return True
+
+    def _forward(self, relay, source=None):
+        """转发给除来源以外、不在已经过路径中的所有服务器"""
+        path = relay['path'] + [self.node_id]
+        relay = dict(relay, path=path)
+        with self.lock:
+            links = [link for link, node in self.links.items()
+                     if link is not source and node not in path and node != relay['origin']]
+        for link in links:
+            self._send(link, relay)
+
+    def _send(self, link, message):
+        self.server.send_message(link, message)
+
+    def handle_frame(self, link, frame):
+        """处理链路上收到的帧"""
+        if frame.type == FRAME_DATA:
+            self.handle_fetch_data(link, frame)
+            return
+        if frame.type != FRAME_JSON:
+            print(f"未知的帧类型: {frame.type}")
+            return
+        try:
+            message = decode_message(frame.payload, frame.flags)
+        except ProtocolError as e:
+            print(e)
+            return
+        if message['type'] == 'relay':
+            self.handle_relay(link, message)
+        elif message['type'] == 'direct':
+            self.handle_direct(link, message)
+        elif message['type'] == 'file_request':
+            # 对方服务器向本地取文件，与客户端下载相同
+            self.server.handle_file_request(link, message)
+        elif message['type'] == 'file_cancel':
+            self.server.cancel_transfer(link, message['channel'])
+        elif message['type'] == 'file_meta':
+            self.handle_fetch_meta(link, message)
+        elif message['type'] == 'file_aborted':
+            self.fail_fetch((link, message['channel']), message.get('reason', ''))
+        elif message['type'] == 'ping':
+            # 对方服务器的心跳检测，空闲的链路也要回应
+            self.server.send_message(link, {'type': 'pong'})
+
+    def handle_relay(self, link, relay):
+        # 去重、记录和转发在发送顺序锁内完成，同一来源的消息在每台服务器上保持原有顺序
+        with self.server.delivery_lock:
+            if not self._mark_seen(relay['id']):
+                return
+            message = relay.get('message')
+            presence = relay.get('presence')
+            if message is not None:
+                if message.get('type') == 'file_notification':
+                    with self.lock:
+                        self.remote_files[message['file_id']] = link
+                self.server.record_and_deliver(message)
+            elif presence is not None:
+                self.handle_presence(link, relay['origin'], presence)
+            self._forward(relay, link)
+
+    def handle_presence(self, link, origin, presence):
+        username = presence['username']
+        with self.lock:
+            if presence['action'] == PRESENCE_ADD:
+                self.remote_users[username] = (link, origin)
+            elif self.remote_users.get(username, (None,))[0] is link:
+                del self.remote_users[username]
+        info = dict(presence.get('info') or {}, node=origin)
+        self.server.notify_presence(presence['action'], username,
+                                    info if presence['action'] == PRESENCE_ADD else None)
+
+    def fetch(self, conn, message):
+        """从其他服务器取回本地没有的文件，完成后再处理 conn 的下载请求
+
+        同一文件正在取回时只加入等待列表。文件不是来自其他服务器时返回 False。
+        """
+        file_id = message['file_id']
+        with self.lock:
+            for key, fetch in self.fetches.items():
+                if fetch['file_id'] == file_id:
+                    fetch['waiting'].append((conn, message))
+                    return True
+            link = self.remote_files.get(file_id)
+            if link is None or link.closed:
+                return False
+            key = (link, next(self._channels) % MAX_CHANNEL + 1)
+            self.fetches[key] = {'file_id': file_id, 'upload': None, 'waiting': [(conn, message)]}
+        # 先只取分块清单，确定本地可以续传的位置后再请求数据
+        self._send(link, {'type': 'file_request', 'channel': key[1], 'file_id': file_id,
+                          'length': 0})
+        return True
+
+    def handle_fetch_meta(self, link, message):
+        key = (link, message['channel'])
+        with self.lock:
+            fetch = self.fetches.get(key)
+        if fetch is None or fetch['upload'] is not None:
+            return
+        try:
+            upload = self.server.file_store.begin_upload(fetch['file_id'], message['filesize'],
+                                                         message['chunk_hashes'])
+        except (OSError, ValueError) as e:
+            self.fail_fetch(key, str(e))
+            return
+        fetch['upload'] = upload
+        if upload.complete:
+            self.finish_fetch(key)
+            return
+        self._send(link, {'type': 'file_request', 'channel': key[1], 'file_id': fetch['file_id'],
+                          'offset': upload.offset})
+
+    def handle_fetch_data(self, link, frame):
+        key = (link, frame.channel)
+        with self.lock:
+            fetch = self.fetches.get(key)
+        if fetch is None or fetch['upload'] is None:
+            print(f"丢弃不属于任何传输的数据帧 (通道 {frame.channel})")
+            return
+        try:
+            data = decompress_payload(frame.payload, frame.flags)
+            fetch['upload'].write(data)
+            self.server.metrics.file_bytes_in.inc(len(data))
+        except (OSError, ValueError) as e:
+            self.server.send_message(link, {'type': 'file_cancel', 'channel': frame.channel})
+            self.fail_fetch(key, str(e))
+            return
+        if fetch['upload'].complete:
+            self.finish_fetch(key)
+
+    def finish_fetch(self, key):
+        with self.lock:
+            fetch = self.fetches.pop(key, None)
+        if fetch is None:
+            return
+        try:
+            fetch['upload'].commit()
+        except (OSError, ValueError) as e:
+            self._abort_waiting(fetch, str(e))
+            return
+        # 文件已在本地存储中，按原请求发送给等待的客户端
+        for conn, message in fetch['waiting']:
+            if not conn.closed:
+                self.server.handle_file_request(conn, message)
+
+    def fail_fetch(self, key, reason):
+        with self.lock:
+            fetch = self.fetches.pop(key, None)
+        if fetch is None:
+            return
+        if fetch['upload'] is not None:
+            fetch['upload'].abort()
+        self._abort_waiting(fetch, reason)
+
+    def _abort_waiting(self, fetch, reason):
+        for conn, message in fetch['waiting']:
+            self.server.send_message(conn, {'type': 'file_aborted', 'channel': message['channel'],
+                                            'reason': reason})
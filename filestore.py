@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 只能单进程运行，不需要跨进程的文件锁
+    fcntl = None
+
+from transfer import (ChunkVerifier, ChecksumError, hash_file_chunks, resume_offset,
+                      validate_manifest)
+
+# 默认存储目录
+DEFAULT_STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'file_store')
+
+HASH_HEX_LENGTH = 64
+MANIFEST_SUFFIX = '.json'
+
+# 未完成的上传保留时间（秒）
+PARTIAL_MAX_AGE = 7 * 24 * 3600
+
+
+def is_valid_file_id(file_id):
+    """文件ID为由分块哈希计算出的 sha256 十六进制摘要"""
+    if not isinstance(file_id, str) or len(file_id) != HASH_HEX_LENGTH:
+        return False
+    try:
+        int(file_id, 16)
+    except ValueError:
+        return False
+    return file_id == file_id.lower()
+
+
+class FileStore:
+    """服务器端按内容哈希寻址的文件存储，相同内容只保存一份
+
+    未完成的上传按文件ID保存在 partial 目录中，断线后再次上传同一文件时从
+    最后校验通过的位置继续。
+    """
+
+    def __init__(self, root=DEFAULT_STORE_DIR):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.partial_dir = os.path.join(root, 'partial')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self.active_uploads = set()  # 正在上传的文件ID，同一文件同时只有一个可续传的上传
+        self.lock = threading.Lock()
+        self.remove_stale_partials()
+
+    def object_path(self, file_id):
+        """文件在存储中的位置（不检查是否存在）"""
+        if not is_valid_file_id(file_id):
+            raise ValueError(f"无效的文件ID: {file_id}")
+        return os.path.join(self.objects_dir, file_id[:2], file_id)
+
+    def path(self, file_id):
+        """返回已存储文件的路径，不存在时返回 None"""
+        try:
+            path = self.object_path(file_id)
+        except ValueError:
+            return None
+        return path if os.path.isfile(path) else None
+
+    def has(self, file_id, size=None):
+        """存储中是否已有该文件（可同时校验大小）"""
+        path = self.path(file_id)
+        if path is None:
+            return False
+        return size is None or os.path.getsize(path) == size
+
+    def manifest(self, file_id):
+        """返回文件的分块清单 {'size': 大小, 'chunk_hashes': [...]}"""
+        path = self.path(file_id)
+        if path is None:
+            return None
+        manifest_path = path + MANIFEST_SUFFIX
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+        # 清单丢失时重新计算
+        _, chunk_hashes = hash_file_chunks(path)
+        manifest = {'size': os.path.getsize(path), 'chunk_hashes': chunk_hashes}
+        write_json(manifest_path, manifest)
+        return manifest
+
+    def begin_upload(self, file_id, size, chunk_hashes):
+        """开始（或继续）接收一个文件，校验通过的数据最终移入存储"""
+        final_path = self.object_path(file_id)
+        if size < 0:
+            raise ValueError(f"无效的文件大小: {size}")
+        validate_manifest(file_id, size, chunk_hashes)
+
+        with self.lock:
+            resumable = file_id not in self.active_uploads
+            if resumable:
+                self.active_uploads.add(file_id)
+
+        if resumable:
+            part_path = os.path.join(self.partial_dir, file_id + '.part')
+            # 多进程模式下同一文件可能正由其他工作进程上传
+            file = open_locked(part_path)
+            if file is None:
+                self.release_id(file_id)
+                resumable = False
+        if resumable:
+            offset = resume_offset(part_path, chunk_hashes)
+            file.seek(offset)
+        else:
+            # 同一文件正被其他人上传，使用独立的临时文件
+            fd, part_path = tempfile.mkstemp(dir=self.partial_dir, suffix='.tmp')
+            file = os.fdopen(fd, 'wb')
+            offset = 0
+        return Upload(self, file_id, size, chunk_hashes, file, part_path, final_path,
+                      offset, resumable)
+
+    def release(self, upload):
+        if upload.resumable:
+            self.release_id(upload.file_id)
+
+    def release_id(self, file_id):
+        with self.lock:
+            self.active_uploads.discard(file_id)
+
+    def remove_stale_partials(self):
+        """清理长时间没有继续的未完成上传"""
+        now = time.time()
+        for name in os.listdir(self.partial_dir):
+            path = os.path.join(self.partial_dir, name)
+            try:
+                if name.endswith('.tmp') or now - os.path.getmtime(path) > PARTIAL_MAX_AGE:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+class Upload:
+    """一次正在进行的上传，边写入边按分块校验"""
+
+    def __init__(self, store, file_id, size, chunk_hashes, file, part_path, final_path,
+                 offset, resumable):
+        self.store = store
+        self.file_id = file_id
+        self.size = size
+        self.chunk_hashes = chunk_hashes
+        self.offset = offset  # 本次上传开始的位置
+        self.file = file
+        self.part_path = part_path
+        self.final_path = final_path
+        self.resumable = resumable
+        self.verifier = ChunkVerifier(chunk_hashes, size, offset)
+
+    @property
+    def complete(self):
+        return self.verifier.complete
+
+    def write(self, data):
+        self.file.write(data)
+        try:
+            self.verifier.update(data)
+        except ChecksumError as e:
+            # 丢弃未通过校验的分块，下次从最后校验通过的位置继续
+            self.file.truncate(self.verifier.verified)
+            self.file.seek(self.verifier.verified)
+            raise ValueError(str(e))
+
+    def commit(self):
+        """把校验完成的文件移入存储
+
+        移动完成后才关闭文件（释放文件锁），期间其他进程无法接手同一个部分文件。
+        """
+        if fcntl is None:
+            # Windows 不能移动已打开的文件
+            self.file.close()
+        else:
+            self.file.flush()
+        try:
+            os.makedirs(os.path.dirname(self.final_path), exist_ok=True)
+            if os.path.exists(self.final_path):
+                # 同一文件被同时上传，已有一份即可
+                os.remove(self.part_path)
+            else:
+                write_json(self.final_path + MANIFEST_SUFFIX,
+                           {'size': self.size, 'chunk_hashes': self.chunk_hashes})
+                os.replace(self.part_path, self.final_path)
+        finally:
+            self.file.close()
+            self.store.release(self)
+
+    def abort(self):
+        """中止上传，可续传的部分文件保留到下次上传"""
+        try:
+            if self.resumable:
+                self.file.truncate(self.verifier.verified)
+            self.file.close()
+        except (OSError, ValueError):
+            pass
+        if not self.resumable:
+            try:
+                os.remove(self.part_path)
+            except OSError:
+                pass
+        self.store.release(self)
+
+
+def open_locked(path):
+    """打开（必要时创建）文件并加独占锁，已被其他进程锁定时返回 None"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    if fcntl is not None:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+    return os.fdopen(fd, 'r+b')
+
+
+def write_json(path, data):
+    """先写临时文件再替换，避免留下写了一半的文件"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,125 @@
+import math
+import time
+import threading
+
+# 空闲多久（秒）后发送 ping，发送 ping 后多久（秒）仍没有任何数据则断开
+DEFAULT_PING_INTERVAL = 30
+DEFAULT_PING_TIMEOUT = 15
+
+# 时间轮每格的时长（秒），也是检查空闲连接的间隔
+HEARTBEAT_TICK = 1.0
+
+# 时间轮的格数，一圈的时长足够覆盖常用的心跳间隔，超过一圈的定时器按圈数计数
+DEFAULT_SLOTS = 64
+
+
+class TimerWheel:
+    """哈希时间轮：大量定时器的添加、取消和到期检查都是 O(1)
+
+    时间按 tick 划分成格子，slots 个格子循环使用，定时器按到期时间放入对应的格子，
+    超过一圈的定时器记下还要转过的圈数。每推进一格只检查这一格中的定时器，
+    不需要为每个定时器单独计时，也不需要维护按到期时间排序的堆。
+    定时器以键区分，同一个键只有一个定时器，精度为一个 tick（只会晚到期，不会早到期）。
+    """
+
+    def __init__(self, tick=HEARTBEAT_TICK, slots=DEFAULT_SLOTS):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]  # 每格 {键: 剩余圈数}
+        self.position = 0  # 当前格子
+        self.last_tick = time.monotonic()  # 推进到当前格子的时间
+        self._where = {}  # {键: 所在格子}
+        self._lock = threading.Lock()
+
+    def schedule(self, key, delay, now=None):
+        """从 now 起 delay 秒后到期，key 已有定时器时替换"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            ticks = max(1, math.ceil((now - self.last_tick + delay) / self.tick))
+            self._remove(key)
+            index = (self.position + ticks) % len(self.slots)
+            self.slots[index][key] = (ticks - 1) // len(self.slots)
+            self._where[key] = index
+
+    def cancel(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        index = self._where.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def advance(self, now=None):
+        """推进到 now，返回这期间到期的键"""
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self._lock:
+            while now - self.last_tick >= self.tick:
+                self.last_tick += self.tick
+                self.position = (self.position + 1) % len(self.slots)
+                slot = self.slots[self.position]
+                for key, rounds in list(slot.items()):
+                    if rounds:
+                        slot[key] = rounds - 1
+                    else:
+                        del slot[key]
+                        del self._where[key]
+                        expired.append(key)
+        return expired
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def __len__(self):
+        return len(self._where)
+
+
+class IdleReaper:
+    """用心跳找出失联的连接并断开
+
+    收到任何数据时连接只更新自己的 last_seen（一次赋值，不改动时间轮）。
+    定时器到期时再检查：期间有数据则按剩余时间重新计时；空闲超过 interval 秒发送 ping；
+    ping 之后 timeout 秒内仍没有收到任何数据则断开。失联的连接最迟 interval + timeout
+    再加两个 tick 后被移除，每个 tick 的检查量只与到期的连接数有关。
+    """
+
+    def __init__(self, server, interval=DEFAULT_PING_INTERVAL, timeout=DEFAULT_PING_TIMEOUT,
+                 tick=HEARTBEAT_TICK):
+        self.server = server
+        self.interval = interval
+        self.timeout = timeout
+        # 让一圈覆盖最长的等待时间，通常不需要计圈数
+        slots = max(DEFAULT_SLOTS, math.ceil(max(interval, timeout) / tick) + 1)
+        self.wheel = TimerWheel(tick, slots)
+
+    def watch(self, conn, now=None):
+        """开始检查一个连接"""
+        conn.last_seen = time.monotonic() if now is None else now
+        conn.ping_time = None
+        self.wheel.schedule(conn, self.interval, conn.last_seen)
+
+    def unwatch(self, conn):
+        self.wheel.cancel(conn)
+
+    def run(self, now=None):
+        """处理到期的连接，由引擎定时调用"""
+        now = time.monotonic() if now is None else now
+        for conn in self.wheel.advance(now):
+            if not conn.closed:
+                self.check(conn, now)
+
+    def check(self, conn, now):
+        if conn.ping_time is not None and conn.last_seen > conn.ping_time:
+            conn.ping_time = None  # ping 之后收到过数据
+        if conn.ping_time is None:
+            idle = now - conn.last_seen
+            if idle < self.interval:
+                self.wheel.schedule(conn, self.interval - idle, now)
+                return
+            conn.ping_time = now
+            self.wheel.schedule(conn, self.timeout, now)
+            self.server.send_ping(conn)
+            return
+        print(f"连接 {conn.username or conn.address} 超过 {self.interval + self.timeout} 秒没有响应，断开")
+        self.server.metrics.evicted.inc()
+        self.server.engine.close(conn)
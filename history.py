@@ -0,0 +1,134 @@
+import os
+import json
+import struct
+import threading
+from collections import deque
+
+# 默认存储目录
+DEFAULT_HISTORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history')
+
+# 内存中缓存的最近消息条数
+DEFAULT_CACHE_SIZE = 1000
+
+# 新用户（没有已读序号）加入时补发的消息条数
+RECENT_COUNT = 100
+
+# 一次补发的上限，超过时只补发最新的部分
+MAX_BATCH_MESSAGES = 1000
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+
+# 索引文件每条记录为对应消息在日志中的字节偏移，定长便于按序号直接定位
+INDEX_ENTRY = struct.Struct('!Q')
+
+LOG_NAME = 'messages.log'
+INDEX_NAME = 'messages.idx'
+
+
+class MessageHistory:
+    """聊天记录：每条广播分配递增的序号，追加写入磁盘日志
+
+    日志每行一条 JSON 消息，索引文件按序号保存每行的起始偏移；
+    最近的若干条同时缓存在内存中，内存占用与运行时间无关。
+    """
+
+    def __init__(self, root=DEFAULT_HISTORY_DIR, cache_size=DEFAULT_CACHE_SIZE):
+        os.makedirs(root, exist_ok=True)
+        self.log_path = os.path.join(root, LOG_NAME)
+        self.index_path = os.path.join(root, INDEX_NAME)
+        self.lock = threading.RLock()
+        self.cache = deque(maxlen=cache_size)  # 最近的消息 (序号, JSON 文本)
+        self._log = open(self.log_path, 'ab+')
+        self._index = open(self.index_path, 'ab+')
+        self.last_seq = self._recover()
+        self._load_cache()
+
+    def _recover(self):
+        """丢弃上次异常退出时写了一半的记录，返回最后一条消息的序号"""
+        self._index.seek(0, os.SEEK_END)
+        count = self._index.tell() // INDEX_ENTRY.size
+        end = 0
+        while count:
+            offset = self._offset(count)
+            self._log.seek(offset)
+            line = self._log.readline()
+            if line.endswith(b'\n'):
+                end = offset + len(line)
+                break
+            count -= 1
+        self._index.truncate(count * INDEX_ENTRY.size)
+        self._log.truncate(end)
+        return count
+
+    def _offset(self, seq):
+        """序号对应消息在日志中的偏移"""
+        self._index.seek((seq - 1) * INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack(self._index.read(INDEX_ENTRY.size))[0]
+
+    def _read(self, first_seq):
+        """从磁盘读取 first_seq 及之后的所有消息"""
+        self._log.seek(self._offset(first_seq))
+        return [line.decode('utf-8').rstrip('\n') for line in self._log.readlines()]
+
+    def _read_lines(self, offset, count):
+        """用单独的文件句柄从 offset 读取 count 条消息，与追加写入互不影响"""
+        with open(self.log_path, 'rb') as f:
+            f.seek(offset)
+            return [f.readline().decode('utf-8').rstrip('\n') for _ in range(count)]
+
+    def _load_cache(self):
+        first_seq = max(1, self.last_seq - self.cache.maxlen + 1)
+        if self.last_seq:
+            for seq, line in enumerate(self._read(first_seq), first_seq):
+                self.cache.append((seq, line))
+
+    def append(self, message):
+        """记录一条消息，返回带有序号的新消息"""
+        with self.lock:
+            seq = self.last_seq + 1
+            message = dict(message, seq=seq)
+            line = json.dumps(message, ensure_ascii=False)
+            self._log.seek(0, os.SEEK_END)
+            offset = self._log.tell()
+            self._log.write(line.encode('utf-8') + b'\n')
+            self._log.flush()
+            self._index.seek(0, os.SEEK_END)
+            self._index.write(INDEX_ENTRY.pack(offset))
+            self._index.flush()
+            self.cache.append((seq, line))
+            self.last_seq = seq
+            return message
+
+    def since(self, seq=None):
+        """返回序号大于 seq 的消息（JSON 文本列表）以及是否省略了更早的消息
+
+        seq 为 None 时返回最近的 RECENT_COUNT 条。
+        """
+        with self.lock:
+            if seq is None:
+                seq = max(0, self.last_seq - RECENT_COUNT)
+            first_seq = max(seq + 1, self.last_seq - MAX_BATCH_MESSAGES + 1, 1)
+            truncated = first_seq > seq + 1
+            if first_seq > self.last_seq:
+                return [], False
+            if self.cache and first_seq >= self.cache[0][0]:
+                lines = [line for s, line in self.cache if s >= first_seq]
+            else:
+                # 较早的记录在锁内只确定位置，读取磁盘在锁外进行，不妨碍写入新消息
+                lines = None
+                offset = self._offset(first_seq)
+                count = self.last_seq - first_seq + 1
+        if lines is None:
+            lines = self._read_lines(offset, count)
+
+        # 总大小超过上限时只保留最新的部分
+        total = 0
+        for i in range(len(lines) - 1, -1, -1):
+            total += len(lines[i])
+            if total > MAX_BATCH_BYTES:
+                return lines[i + 1:], True
+        return lines, truncated
+
+    def close(self):
+        with self.lock:
+            self._log.close()
+            self._index.close()
@@ -1,26 +1,44 @@
 import tkinter as tk
 from tkinter import ttk
-import socket
 import threading
 import sys
 import os
-from server import ChatServer
+from server import ChatServer, PRESENCE_ADD
+from engine import ENGINES
+from discovery import local_ip
+from metrics import DEFAULT_METRICS_PORT
+
+# 合并在线用户变化并刷新列表的间隔（毫秒）
+PRESENCE_INTERVAL = 100
+
+# 刷新运行指标面板的间隔（毫秒），速率按相邻两次的差值计算
+METRICS_INTERVAL = 1000
 
 
 class ServerLauncher:
     def __init__(self):
         self.window = tk.Tk()
         self.window.title("聊天服务器启动器")
-        self.window.geometry("800x650")
+        self.window.geometry("800x780")
 
         # 居中显示
         screen_width = self.window.winfo_screenwidth()
         screen_height = self.window.winfo_screenheight()
         x = (screen_width - 800) // 2
-        y = (screen_height - 650) // 2
-        self.window.geometry(f"800x650+{x}+{y}")
+        y = (screen_height - 780) // 2
+        self.window.geometry(f"800x780+{x}+{y}")
+
+        # 服务器线程产生的在线用户变化 {用户名: (动作, 用户信息)}，由主线程定时合并处理
+        self.pending_presence = {}
+        self.pending_rooms = {}  # 房间人数变化 {房间名: 人数}
+        self.presence_lock = threading.Lock()
+        self.user_count = 0
+        self.server = None  # 启动后由服务器线程设置
+        self.last_metrics = None  # 上一次读取的指标，用于计算速率
 
         self.setup_gui()
+        self.window.after(PRESENCE_INTERVAL, self.flush_presence)
+        self.window.after(METRICS_INTERVAL, self.refresh_metrics)
 
     def setup_gui(self):
         frame = ttk.Frame(self.window, padding="20")
@@ -35,10 +53,18 @@ class ServerLauncher:
         self.info_frame.pack(fill=tk.X, pady=10)
 
         # 获取本机IP
-        local_ip = self.get_local_ip()
-        ttk.Label(self.info_frame, text=f"本机IP: {local_ip}").pack(anchor='w')
+        ttk.Label(self.info_frame, text=f"本机IP: {local_ip()}").pack(anchor='w')
         ttk.Label(self.info_frame, text="端口: 5000").pack(anchor='w')
 
+        # 服务器引擎选择
+        engine_frame = ttk.Frame(self.info_frame)
+        engine_frame.pack(anchor='w', pady=(5, 0))
+        ttk.Label(engine_frame, text="连接引擎: ").pack(side=tk.LEFT)
+        self.engine_var = tk.StringVar(value='selector')
+        self.engine_box = ttk.Combobox(engine_frame, textvariable=self.engine_var,
+                                       values=sorted(ENGINES), state='readonly', width=10)
+        self.engine_box.pack(side=tk.LEFT)
+
         # 状态显示
         self.status_var = tk.StringVar(value="未启动")
         ttk.Label(frame, text="状态: ").pack(anchor='w', pady=(20, 0))
@@ -83,6 +109,25 @@ class ServerLauncher:
         self.user_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 
+        # 各房间的人数（以房间名作为行ID）
+        rooms_frame = ttk.LabelFrame(frame, text="房间", padding="10")
+        rooms_frame.pack(fill=tk.X, pady=(0, 10))
+        self.room_tree = ttk.Treeview(rooms_frame, columns=('room', 'count'), show='headings',
+                                      height=3)
+        self.room_tree.heading('room', text='房间名称')
+        self.room_tree.heading('count', text='人数')
+        self.room_tree.column('room', width=200)
+        self.room_tree.column('count', width=80)
+        self.room_tree.pack(fill=tk.X)
+
+        # 运行指标，同样可以通过 HTTP 指标接口获取
+        metrics_frame = ttk.LabelFrame(frame, text=f"运行指标（http://127.0.0.1:{DEFAULT_METRICS_PORT}/metrics）",
+                                       padding="10")
+        metrics_frame.pack(fill=tk.X, pady=(0, 10))
+        self.metrics_var = tk.StringVar(value="服务器未启动")
+        ttk.Label(metrics_frame, textvariable=self.metrics_var, justify=tk.LEFT,
+                  font=('Courier', 9)).pack(anchor='w')
+
         # 启动按钮
         self.start_button = ttk.Button(frame, text="启动服务器",
                                        command=self.start_server)
@@ -91,59 +136,100 @@ class ServerLauncher:
         # 提示信息
         help_text = ("使用说明：\n"
                      "1. 点击'启动服务器'按钮启动\n"
-                     "2. 将本机IP告诉其他用户\n"
-                     "3. 其他用户在客户端输入此IP即可连接")
+                     "2. 同一局域网中的客户端会自动发现本服务器\n"
+                     "3. 发现不了时（如跨网段），将本机IP告诉其他用户手动输入")
         ttk.Label(frame, text=help_text, foreground='gray').pack()
 
-    def get_local_ip(self):
-        """获取本机IP地址"""
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
-            s.close()
-            return ip
-        except:
-            return "127.0.0.1"
-
-    def update_user_info(self, user_count, user_list):
-        """更新用户信息显示"""
-
-        # 在主线程中更新UI
-        def update():
+    def queue_presence(self, action, username, info):
+        """记录服务器线程通知的在线用户变化，同一用户只保留最后一次变化"""
+        with self.presence_lock:
+            self.pending_presence[username] = (action, info)
+
+    def queue_room(self, room, count):
+        """记录房间人数变化，同一房间只保留最新的人数"""
+        with self.presence_lock:
+            self.pending_rooms[room] = count
+
+    def flush_presence(self):
+        """在主线程中定时把积累的变化逐行应用到用户列表（以用户名作为行ID）和房间列表"""
+        with self.presence_lock:
+            pending, self.pending_presence = self.pending_presence, {}
+            rooms, self.pending_rooms = self.pending_rooms, {}
+
+        for room, count in rooms.items():
+            if count == 0:
+                if self.room_tree.exists(room):
+                    self.room_tree.delete(room)
+            elif self.room_tree.exists(room):
+                self.room_tree.item(room, values=(room, count))
+            else:
+                self.room_tree.insert('', 'end', iid=room, values=(room, count))
+
+        for username, (action, info) in pending.items():
+            exists = self.user_tree.exists(username)
+            if action == PRESENCE_ADD:
+                values = (username, info['ip'], info['port'], info['join_time'])
+                if exists:
+                    self.user_tree.item(username, values=values)
+                else:
+                    self.user_tree.insert('', 'end', iid=username, values=values)
+                    self.user_count += 1
+            elif exists:
+                self.user_tree.delete(username)
+                self.user_count -= 1
+
+        if pending:
             # 更新在线人数
-            self.online_count_var.set(f"当前在线人数: {user_count}")
-
-            # 清空现有显示
-            for item in self.user_tree.get_children():
-                self.user_tree.delete(item)
-
-            # 添加用户信息
-            for user in user_list:
-                self.user_tree.insert('', 'end',
-                                      values=(user['username'],
-                                              user['ip'],
-                                              user['port'],
-                                              user['join_time']))
-
-        # 确保在主线程中更新UI
-        self.window.after(0, update)
+            self.online_count_var.set(f"当前在线人数: {self.user_count}")
+        self.window.after(PRESENCE_INTERVAL, self.flush_presence)
+
+    def refresh_metrics(self):
+        """主线程每秒读取一次运行指标，显示各项速率和耗时分位数"""
+        if self.server is not None:
+            current = self.server.metrics.snapshot()
+            previous = self.last_metrics or current
+            elapsed = max(current['uptime'] - previous['uptime'], 1e-9)
+
+            def rate(key):
+                return (current[key] - previous[key]) / elapsed if previous is not current else 0
+
+            def ms(value):
+                return "-" if value is None else f"{value * 1000:.2f}ms"
+
+            self.metrics_var.set("\n".join([
+                f"连接 {current['connections']}  线程 {current['threads']}  "
+                f"接受 {rate('accepted'):.1f}/s",
+                f"消息 入 {rate('messages_in'):.0f}/s  出 {rate('messages_out'):.0f}/s  "
+                f"字节 入 {rate('bytes_in') / 1024:.1f}KB/s  出 {rate('bytes_out') / 1024:.1f}KB/s",
+                f"文件中转 入 {rate('file_bytes_in') / 1048576:.2f}MB/s  "
+                f"出 {rate('file_bytes_out') / 1048576:.2f}MB/s",
+                f"广播扇出 p50 {ms(current['fanout_p50'])}  p99 {ms(current['fanout_p99'])}  "
+                f"写入 p99 {ms(current['write_p99'])}",
+                f"发送阻塞 {current['stalls']}  拥塞丢弃 {current['dropped']}"
+            ]))
+            self.last_metrics = current
+        self.window.after(METRICS_INTERVAL, self.refresh_metrics)
 
     def start_server(self):
         """启动服务器"""
         self.start_button.config(state='disabled')
+        self.engine_box.config(state='disabled')
         self.status_var.set("正在启动...")
+        engine = self.engine_var.get()
 
         # 在新线程中启动服务器
         def run_server():
             try:
-                server = ChatServer()
-                server.set_info_callback(self.update_user_info)
+                server = ChatServer(engine=engine, metrics_port=DEFAULT_METRICS_PORT)
+                server.set_presence_callback(self.queue_presence)
+                server.set_room_callback(self.queue_room)
+                self.server = server
                 self.window.after(100, lambda: self.status_var.set("运行中"))
                 server.start()
             except Exception as e:
                 self.window.after(100, lambda: self.status_var.set(f"启动失败: {e}"))
                 self.window.after(100, lambda: self.start_button.config(state='normal'))
+                self.window.after(100, lambda: self.engine_box.config(state='readonly'))
 
         threading.Thread(target=run_server, daemon=True).start()
 
@@ -0,0 +1,236 @@
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 指标接口默认只监听本机
+DEFAULT_METRICS_HOST = '127.0.0.1'
+
+# 启动器默认开启的指标端口
+DEFAULT_METRICS_PORT = 9100
+
+# 耗时直方图的桶上界（秒）
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0)
+
+
+class Counter:
+    """只增不减的计数器"""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    """按固定的桶统计耗时分布，内存占用与观测次数无关"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个桶为超过最大上界的观测
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """由桶估算分位数（返回所在桶的上界），还没有观测时返回 None"""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+class Metrics:
+    """服务器运行指标
+
+    热路径上只做整数累加：每个连接收发的字节数和消息数记录在连接自己的解析器和发送队列上，
+    读取指标时再汇总当前连接与已关闭连接的合计，不需要在每次收发时加锁。
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.accepted = Counter()  # 接受的连接数
+        self.file_bytes_in = Counter()  # 上传到服务器的文件字节数
+        self.broadcasts = Counter()  # 广播次数
+        self.evicted = Counter()  # 因心跳超时断开的连接数
+        self.fanout = Histogram()  # 一次广播放入所有接收者发送队列的耗时
+        self.write_time = Histogram()  # 一次把发送队列写入套接字的耗时，反映发送阻塞
+        self._lock = threading.Lock()
+        self._connections = set()  # 当前的连接
+        # 已关闭连接的合计
+        self._closed = {'bytes_in': 0, 'bytes_out': 0, 'messages_in': 0, 'messages_out': 0,
+                        'file_bytes_out': 0, 'stalls': 0, 'dropped': 0}
+
+    def track(self, conn):
+        """开始统计一个连接"""
+        with self._lock:
+            self._connections.add(conn)
+
+    def untrack(self, conn):
+        """连接关闭，把它的计数并入合计"""
+        with self._lock:
+            if conn not in self._connections:
+                return
+            self._connections.discard(conn)
+            for key, value in connection_stats(conn).items():
+                self._closed[key] += value
+
+    def connections(self):
+        with self._lock:
+            return list(self._connections)
+
+    def snapshot(self):
+        """当前所有指标的合计 {名称: 数值}"""
+        with self._lock:
+            connections = list(self._connections)
+            totals = dict(self._closed)
+        for conn in connections:
+            for key, value in connection_stats(conn).items():
+                totals[key] += value
+        totals.update({
+            'connections': len(connections),
+            'threads': threading.active_count(),
+            'accepted': self.accepted.value,
+            'file_bytes_in': self.file_bytes_in.value,
+            'broadcasts': self.broadcasts.value,
+            'evicted': self.evicted.value,
+            'fanout_p50': self.fanout.quantile(0.5),
+            'fanout_p99': self.fanout.quantile(0.99),
+            'write_p99': self.write_time.quantile(0.99),
+            'uptime': time.time() - self.started
+        })
+        return totals
+
+    def render(self):
+        """纯文本格式（与 Prometheus 的文本格式兼容），每个连接单独一行并带上用户名"""
+        totals = self.snapshot()
+        lines = []
+
+        def metric(name, kind, value, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+
+        metric('chat_connections', 'gauge', totals['connections'], "当前连接数")
+        metric('chat_threads', 'gauge', totals['threads'], "服务器进程的线程数")
+        metric('chat_uptime_seconds', 'gauge', round(totals['uptime'], 3), "运行时间")
+        metric('chat_accepted_total', 'counter', totals['accepted'], "接受的连接数")
+        metric('chat_bytes_in_total', 'counter', totals['bytes_in'], "收到的字节数")
+        metric('chat_bytes_out_total', 'counter', totals['bytes_out'], "发出的字节数")
+        metric('chat_messages_in_total', 'counter', totals['messages_in'], "收到的帧数")
+        metric('chat_messages_out_total', 'counter', totals['messages_out'], "放入发送队列的消息数")
+        metric('chat_file_bytes_in_total', 'counter', totals['file_bytes_in'], "上传的文件字节数")
+        metric('chat_file_bytes_out_total', 'counter', totals['file_bytes_out'], "发出的文件字节数")
+        metric('chat_send_stalls_total', 'counter', totals['stalls'], "套接字写满、发送被推迟的次数")
+        metric('chat_dropped_total', 'counter', totals['dropped'], "因发送队列拥塞丢弃的消息数")
+        metric('chat_broadcasts_total', 'counter', totals['broadcasts'], "广播次数")
+        metric('chat_evicted_total', 'counter', totals['evicted'], "因心跳超时断开的连接数")
+        render_histogram(lines, 'chat_broadcast_fanout_seconds', self.fanout, "一次广播的扇出耗时")
+        render_histogram(lines, 'chat_write_seconds', self.write_time, "一次写入套接字的耗时")
+
+        for name, key, help_text in (('chat_connection_bytes_in', 'bytes_in', "每个连接收到的字节数"),
+                                     ('chat_connection_bytes_out', 'bytes_out', "每个连接发出的字节数"),
+                                     ('chat_connection_messages_in', 'messages_in', "每个连接收到的帧数"),
+                                     ('chat_connection_messages_out', 'messages_out', "每个连接发出的消息数")):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for conn in self.connections():
+                lines.append(f'{name}{{conn="{connection_label(conn)}"}} {connection_stats(conn)[key]}')
+        return '\n'.join(lines) + '\n'
+
+
+def connection_stats(conn):
+    """单个连接的计数，由它的解析器和发送队列累加"""
+    return {
+        'bytes_in': conn.parser.bytes_read,
+        'bytes_out': conn.outbound.bytes_sent,
+        'messages_in': conn.messages_in,
+        'messages_out': conn.outbound.messages,
+        'file_bytes_out': conn.outbound.file_bytes_sent,
+        'stalls': conn.outbound.stalls,
+        'dropped': conn.outbound.dropped
+    }
+
+
+def connection_label(conn):
+    if conn.peer is not None:
+        name = f"peer:{conn.peer}"
+    elif conn.username is not None:
+        name = conn.username
+    else:
+        name = f"{conn.address[0]}:{conn.address[1]}"
+    return name.replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def render_histogram(lines, name, histogram, help_text):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    with histogram._lock:
+        counts = list(histogram.counts)
+        total, total_sum = histogram.count, histogram.sum
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{le="+Inf"}} {total}')
+    lines.append(f"{name}_sum {total_sum:.6f}")
+    lines.append(f"{name}_count {total}")
+
+
+class MetricsServer:
+    """通过 HTTP 提供指标：GET /metrics 返回纯文本"""
+
+    def __init__(self, metrics, host=DEFAULT_METRICS_HOST, port=DEFAULT_METRICS_PORT):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.httpd = None
+
+    def start(self):
+        """在后台线程中开始服务，端口无法绑定时返回 False（不影响聊天服务本身）"""
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            print(f"指标接口 {self.host}:{self.port} 绑定失败: {e}")
+            return False
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        print(f"指标接口: http://{self.host}:{self.port}/metrics")
+        return True
@@ -0,0 +1,354 @@
+import os
+import socket
+import threading
+from itertools import islice
+from collections import deque
+
+from protocol import DEFAULT_CHUNK_SIZE, encode_data, encode_data_header
+
+# 默认水位线（字节）：超过高水位视为慢速消费者，回落到低水位以下后恢复
+DEFAULT_HIGH_WATERMARK = 8 * 1024 * 1024
+DEFAULT_LOW_WATERMARK = 2 * 1024 * 1024
+
+# 慢速消费者处理策略
+POLICY_DROP = 'drop'  # 拥塞期间丢弃新消息
+POLICY_DISCONNECT = 'disconnect'  # 超过高水位直接断开连接
+POLICIES = (POLICY_DROP, POLICY_DISCONNECT)
+
+# 一次 sendmsg 最多合并发送的消息数
+MAX_IOV = 64
+
+# 发送帧头时提示内核还有后续数据，避免关闭 Nagle 后帧头单独成包
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+# TCP 保活：连接空闲 KEEPALIVE_IDLE 秒后开始探测，每 KEEPALIVE_INTERVAL 秒一次，
+# 连续 KEEPALIVE_COUNT 次没有应答即断开（系统默认要空闲两小时才开始探测）
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+
+# put() 的返回值
+QUEUED = 'queued'
+DROPPED = 'dropped'
+OVERFLOW = 'overflow'
+
+
+def send_buffers(sock, buffers):
+    """用一次系统调用发送多个缓冲区（writev），返回发送的字节数"""
+    if len(buffers) == 1:
+        return sock.send(buffers[0])
+    if hasattr(sock, 'sendmsg'):
+        return sock.sendmsg(buffers)
+    # 不支持 sendmsg 的平台（如 Windows）先拼接再发送
+    return sock.send(b''.join(buffers))
+
+
+def tune_socket(sock):
+    """设置连接的 TCP 选项
+
+    发送队列已经把同一时刻的多条消息合并成一次写入，所以关闭 Nagle 算法，
+    避免小消息因等待 ACK 而延迟几十毫秒。同时开启 TCP 保活，及时发现失联的对方。
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+    limit_unsent(sock)
+    enable_keepalive(sock)
+
+
+def enable_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """开启 TCP 保活并缩短探测时间，作为应用层心跳之外的兜底
+
+    Linux 上同时设置 TCP_USER_TIMEOUT：已发出的数据超过同样的时间仍未被确认就断开，
+    向已经失联的对方发送数据不会按系统默认重传十几分钟。
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    except OSError:
+        return
+    options = []
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        options.append((socket.TCP_KEEPIDLE, idle))
+    elif hasattr(socket, 'TCP_KEEPALIVE'):
+        options.append((socket.TCP_KEEPALIVE, idle))  # macOS 上的同一选项
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        options.append((socket.TCP_KEEPINTVL, interval))
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        options.append((socket.TCP_KEEPCNT, count))
+    if hasattr(socket, 'TCP_USER_TIMEOUT'):
+        options.append((socket.TCP_USER_TIMEOUT, (idle + interval * count) * 1000))
+    for option, value in options:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, option, value)
+        except OSError:
+            pass
+    if not options and hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+        # Windows 只能用 ioctl 设置空闲时间和探测间隔（毫秒）
+        try:
+            sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+        except OSError:
+            pass
+
+
+def limit_unsent(sock, lowat=DEFAULT_CHUNK_SIZE):
+    """限制内核中排队未发出的数据量（Linux 的 TCP_NOTSENT_LOWAT）
+
+    否则大量文件数据会先堆积在内核发送缓冲区里，队列中优先的聊天消息仍要排在它们后面。
+    """
+    option = getattr(socket, 'TCP_NOTSENT_LOWAT', None)
+    if option is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, option, lowat)
+    except OSError:
+        pass
+
+
+class OutboundQueue:
+    """单个连接的有界发送队列，由该连接自己的写线程或事件循环负责发送
+
+    连接上的数据分为两类：控制/聊天消息优先发送；文件流按数据帧轮流发送，
+    多个同时进行的传输公平地分享带宽，聊天消息最多只需等待当前数据帧发完。
+    """
+
+    def __init__(self, high_watermark=DEFAULT_HIGH_WATERMARK,
+                 low_watermark=DEFAULT_LOW_WATERMARK, policy=POLICY_DROP):
+        if low_watermark > high_watermark:
+            raise ValueError("低水位不能高于高水位")
+        if policy not in POLICIES:
+            raise ValueError(f"未知的慢速消费者策略: {policy}")
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = policy
+        self.queued_bytes = 0  # 队列中尚未发送的消息字节数
+        self.congested = False  # 是否处于拥塞状态
+        self.dropped = 0  # 因拥塞丢弃的消息数
+        self.messages = 0  # 放入队列的消息数
+        self.bytes_sent = 0  # 写入套接字的字节数（含文件数据）
+        self.file_bytes_sent = 0  # 其中文件流的字节数
+        self.stalls = 0  # 套接字写满、剩余数据需等待下次可写的次数
+        self.closed = False
+        self._items = deque()  # 控制/聊天消息，优先发送
+        self._offset = 0  # 队首消息已发送的字节数
+        self._streams = deque()  # 文件流，按数据帧轮转
+        self._current = None  # 正在发送某个数据帧中途的文件流，必须先把这一帧发完
+        self._cond = threading.Condition()
+
+    def put(self, data, force=False):
+        """放入待发送数据，force 为 True 时即使拥塞也放入（用于少量关键通知）"""
+        with self._cond:
+            if self.closed:
+                return DROPPED
+            if not force:
+                if self.queued_bytes + len(data) > self.high_watermark:
+                    if self.policy == POLICY_DISCONNECT:
+                        return OVERFLOW
+                    self.congested = True
+                if self.congested:
+                    self.dropped += 1
+                    return DROPPED
+            self._items.append(data)
+            self.queued_bytes += len(data)
+            self.messages += 1
+            self._cond.notify()
+            return QUEUED
+
+    def put_stream(self, stream):
+        """放入文件流；文件内容留在磁盘上，不计入水位，也不会因拥塞被丢弃"""
+        with self._cond:
+            if self.closed:
+                stream.close()
+                return DROPPED
+            self._streams.append(stream)
+            self._cond.notify()
+            return QUEUED
+
+    def cancel_stream(self, channel):
+        """取消该通道上尚未发送完的文件流（已开始的数据帧会发送完整）"""
+        with self._cond:
+            for stream in self._streams:
+                if stream.channel == channel:
+                    stream.cancel()
+
+    def _next(self):
+        """选出下一个要发送的内容，队列为空时返回 None"""
+        with self._cond:
+            if self._current is not None:
+                return self._current
+            if self._items:
+                # 把排队的多条消息合并成一次写入
+                buffers = list(islice(self._items, MAX_IOV))
+                if self._offset:
+                    buffers[0] = memoryview(buffers[0])[self._offset:]
+                return buffers
+            while self._streams:
+                stream = self._streams[0]
+                if not stream.done:
+                    return stream
+                self._streams.popleft()
+                stream.close()
+            return None
+
+    def _consume(self, count):
+        """标记队首的消息已发送 count 字节（可能跨越多条消息）"""
+        with self._cond:
+            if self.closed:
+                # 发送期间队列被关闭并清空
+                return
+            self.queued_bytes -= count
+            while count:
+                left = len(self._items[0]) - self._offset
+                if count < left:
+                    self._offset += count
+                    break
+                count -= left
+                self._items.popleft()
+                self._offset = 0
+            if self.congested and self.queued_bytes <= self.low_watermark:
+                self.congested = False
+
+    def _stream_sent(self, stream):
+        """文件流发送了一部分：帧未发完时继续发送它，帧发完后轮到下一个"""
+        with self._cond:
+            if stream.in_frame:
+                self._current = stream
+                return
+            self._current = None
+            if not self._streams or self._streams[0] is not stream:
+                return
+            if stream.done:
+                self._streams.popleft()
+                stream.close()
+            else:
+                self._streams.rotate(-1)
+
+    def write_to(self, sock, limit=None):
+        """把队列中的数据尽量多地写入套接字，返回写入的字节数
+
+        阻塞套接字会一直写到队列为空；非阻塞套接字写满时返回。
+        limit 限制单次调用最多写入的字节数，避免一个连接长时间占用事件循环。
+        """
+        total = 0
+        while limit is None or total < limit:
+            item = self._next()
+            if item is None:
+                return total
+            try:
+                if isinstance(item, FileStream):
+                    sent = item.write_to(sock)
+                    self._stream_sent(item)
+                    self.file_bytes_sent += sent
+                else:
+                    sent = send_buffers(sock, item)
+                    self._consume(sent)
+            except (BlockingIOError, InterruptedError):
+                self.stalls += 1
+                return total
+            total += sent
+            self.bytes_sent += sent
+        return total
+
+    def wait(self):
+        """阻塞直到队列中有数据或队列关闭，队列关闭时返回 False"""
+        with self._cond:
+            while not self._items and not self._streams and not self.closed:
+                self._cond.wait()
+            return not self.closed
+
+    def close(self):
+        """关闭队列并唤醒等待中的写线程"""
+        with self._cond:
+            self.closed = True
+            streams = list(self._streams)
+            self._items.clear()
+            self._streams.clear()
+            self._current = None
+            self.queued_bytes = 0
+            self._cond.notify_all()
+        for stream in streams:
+            stream.close()
+
+    def __len__(self):
+        return len(self._items) + len(self._streams)
+
+
+class FileStream:
+    """按数据帧发送磁盘文件的一段内容，负载尽量用 os.sendfile 由内核直接发送
+
+    指定 codec 时每个数据帧单独压缩，此时读入内存后整帧发送，不再使用 sendfile。
+    """
+
+    def __init__(self, path, channel, size, offset=0, chunk_size=DEFAULT_CHUNK_SIZE, codec=None):
+        self.path = path
+        self.channel = channel
+        self.position = offset  # 下一个要发送的文件偏移
+        self.end = offset + size
+        self.chunk_size = chunk_size
+        self.codec = codec
+        self.file = None
+        self._header = None  # 当前帧尚未发送的帧头（压缩时为整个帧）
+        self._frame_left = 0  # 当前帧尚未发送的负载字节数
+
+    @property
+    def done(self):
+        return self.position >= self.end and not self._header
+
+    @property
+    def in_frame(self):
+        """是否正处于某个数据帧的中途"""
+        return self._header is not None or self._frame_left > 0
+
+    def write_to(self, sock):
+        """发送一部分数据（一次系统调用），返回发送的字节数"""
+        if self.done:
+            return 0
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+
+        if self._header is None and self._frame_left == 0:
+            count = min(self.chunk_size, self.end - self.position)
+            if self.codec is not None:
+                self._header = memoryview(self._compressed_frame(count))
+                self.position += count
+            else:
+                self._header = memoryview(encode_data_header(self.channel, count))
+                self._frame_left = count
+
+        if self._header is not None:
+            sent = sock.send(self._header, MSG_MORE if self._frame_left else 0)
+            self._header = self._header[sent:] if sent < len(self._header) else None
+            return sent
+
+        sent = self._send_body(sock)
+        if sent == 0:
+            raise OSError(f"文件 {self.path} 意外结束")
+        self.position += sent
+        self._frame_left -= sent
+        return sent
+
+    def cancel(self):
+        """发送完当前数据帧后结束"""
+        self.end = self.position + self._frame_left
+
+    def _compressed_frame(self, count):
+        self.file.seek(self.position)
+        data = self.file.read(count)
+        if len(data) < count:
+            raise OSError(f"文件 {self.path} 意外结束")
+        return encode_data(self.channel, data, self.codec)
+
+    def _send_body(self, sock):
+        if hasattr(os, 'sendfile'):
+            return os.sendfile(sock.fileno(), self.file.fileno(), self.position, self._frame_left)
+        # 不支持 sendfile 的平台（如 Windows）退回到读取后发送
+        self.file.seek(self.position)
+        data = self.file.read(min(self._frame_left, 256 * 1024))
+        if not data:
+            return 0
+        return sock.send(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
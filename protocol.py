@@ -0,0 +1,251 @@
+import json
+import zlib
+import struct
+from collections import namedtuple
+
+try:
+    import lzma
+except ImportError:  # 部分 Python 发行版没有编译 lzma 模块
+    lzma = None
+
+# 帧头格式：类型(1字节) 标志(1字节) 通道号(2字节) 负载长度(4字节)，网络字节序
+HEADER = struct.Struct('!BBHI')
+HEADER_SIZE = HEADER.size
+
+# 帧类型
+FRAME_JSON = 1  # 控制/聊天消息，负载为 UTF-8 编码的 JSON
+FRAME_DATA = 2  # 文件数据，按通道号区分属于哪个传输
+
+# 帧标志：负载经过压缩，不同的位表示不同的压缩算法
+FLAG_ZLIB = 0x01
+FLAG_LZMA = 0x02
+
+# 本机支持的压缩算法，按优先顺序排列
+CODECS = ('zlib', 'lzma') if lzma is not None else ('zlib',)
+DECOMPRESS_ERRORS = (zlib.error, lzma.LZMAError) if lzma is not None else (zlib.error,)
+
+# 默认压缩级别：局域网带宽较高，较低的级别压缩更快
+DEFAULT_COMPRESSION_LEVEL = 1
+
+# 小于该长度的负载不压缩
+COMPRESS_MIN_SIZE = 256
+
+# 通道 0 保留给控制消息
+CONTROL_CHANNEL = 0
+
+# 登录后自动加入的公共房间，以及房间名的最大长度
+DEFAULT_ROOM = '大厅'
+MAX_ROOM_NAME = 32
+MAX_CHANNEL = 0xFFFF
+
+# 单帧负载上限，防止异常长度耗尽内存
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# 登录前的单帧负载上限，未登录的连接不能让服务器为它准备大缓冲区
+LOGIN_FRAME_SIZE = 64 * 1024
+
+# 接收缓冲区的初始大小，大量空闲连接只占用很少的内存；遇到更大的帧时随数据到达逐步扩大
+DEFAULT_BUFFER_SIZE = 4 * 1024
+
+# 文件数据帧的默认大小。同一连接上的聊天消息最多等待一个数据帧发完，
+# 帧太大会增加聊天延迟，太小会增加系统调用次数
+DEFAULT_CHUNK_SIZE = 128 * 1024
+
+Frame = namedtuple('Frame', ['type', 'flags', 'channel', 'payload'])
+
+
+class ProtocolError(Exception):
+    """收到不符合协议的数据"""
+
+
+class Codec:
+    """登录时协商出的压缩算法和级别，逐帧压缩负载"""
+
+    def __init__(self, name, level=DEFAULT_COMPRESSION_LEVEL):
+        if name not in CODECS:
+            raise ValueError(f"不支持的压缩算法: {name}")
+        self.name = name
+        self.level = level
+
+    def compress(self, payload):
+        """压缩负载，返回 (负载, 标志)；压缩后没有变小时原样返回"""
+        if len(payload) < COMPRESS_MIN_SIZE:
+            return payload, 0
+        if self.name == 'zlib':
+            data, flag = zlib.compress(payload, self.level), FLAG_ZLIB
+        else:
+            data, flag = lzma.compress(payload, preset=self.level), FLAG_LZMA
+        if len(data) >= len(payload):
+            return payload, 0
+        return data, flag
+
+
+def negotiate_codec(offered, supported=CODECS, level=DEFAULT_COMPRESSION_LEVEL):
+    """从对方提供的算法中选出本机优先使用的一个，都不支持时返回 None"""
+    if not isinstance(offered, list):
+        return None
+    for name in supported:
+        if name in offered:
+            return Codec(name, level)
+    return None
+
+
+def decompress_payload(payload, flags):
+    """按帧标志解压负载，未压缩的负载原样返回"""
+    if flags & FLAG_ZLIB:
+        decompressor = zlib.decompressobj()
+    elif flags & FLAG_LZMA:
+        if lzma is None:
+            raise ProtocolError("不支持 lzma 压缩")
+        decompressor = lzma.LZMADecompressor()
+    else:
+        return payload
+    try:
+        # 限制解压后的大小，防止压缩炸弹
+        data = decompressor.decompress(payload, MAX_FRAME_SIZE)
+    except DECOMPRESS_ERRORS as e:
+        raise ProtocolError(f"无法解压的负载: {e}")
+    if not decompressor.eof:
+        raise ProtocolError("压缩负载不完整或解压后过大")
+    return data
+
+
+def encode_frame(frame_type, payload, channel=CONTROL_CHANNEL, flags=0, codec=None):
+    """编码一个完整的帧，指定 codec 时压缩负载"""
+    if codec is not None:
+        payload, flag = codec.compress(payload)
+        flags |= flag
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"帧负载过大: {len(payload)}")
+    return HEADER.pack(frame_type, flags, channel, len(payload)) + payload
+
+
+def encode_message(message, channel=CONTROL_CHANNEL, codec=None):
+    """将消息字典编码为 JSON 帧"""
+    payload = json.dumps(message, ensure_ascii=False).encode('utf-8')
+    return encode_frame(FRAME_JSON, payload, channel, codec=codec)
+
+
+def encode_data(channel, data, codec=None):
+    """将文件数据编码为数据帧"""
+    return encode_frame(FRAME_DATA, data, channel, codec=codec)
+
+
+def encode_data_header(channel, length):
+    """只编码数据帧的帧头，负载随后由调用方直接发送（例如 sendfile）"""
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"帧负载过大: {length}")
+    return HEADER.pack(FRAME_DATA, 0, channel, length)
+
+
+def decode_message(payload, flags=0):
+    """解析 JSON 帧的负载"""
+    payload = decompress_payload(payload, flags)
+    try:
+        message = json.loads(bytes(payload).decode('utf-8'))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ProtocolError(f"无法解析的消息格式: {e}")
+    if not isinstance(message, dict) or 'type' not in message:
+        raise ProtocolError("消息缺少 type 字段")
+    return message
+
+
+class FrameParser:
+    """增量帧解析器，可以处理被拆分或合并的 TCP 数据段
+
+    数据通过 recv_into 直接读入可复用的缓冲区，返回的帧负载是指向该缓冲区的
+    memoryview，只在下一次读取之前有效，需要保留时应自行复制。
+    缓冲区只在已收到的数据装满时才扩大一倍（不超过帧的大小），占用的内存与实际收到的数据成正比，
+    只声明了长度的帧不会让解析器预先分配大块内存；大帧处理完后恢复到初始大小。
+    """
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, max_frame=MAX_FRAME_SIZE):
+        self.buffer_size = buffer_size
+        self.max_frame = max_frame  # 允许的最大帧负载
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # 尚未解析数据的起始位置
+        self._end = 0  # 已读入数据的结束位置
+        self.bytes_read = 0  # 从套接字读入的总字节数
+
+    def read_from(self, sock):
+        """从套接字读取一次并返回其中所有完整的帧，对端关闭时返回 None"""
+        self._make_room()
+        count = sock.recv_into(self._view[self._end:])
+        if not count:
+            return None
+        self._end += count
+        self.bytes_read += count
+        frames = self._parse()
+        # 已有的帧负载仍引用原来的缓冲区，替换缓冲区不影响它们
+        self.shrink()
+        return frames
+
+    def feed(self, data):
+        """追加收到的数据，返回其中所有完整的帧"""
+        data = memoryview(data)
+        while len(data):
+            self._make_room()
+            count = min(len(data), len(self._buffer) - self._end)
+            self._view[self._end:self._end + count] = data[:count]
+            self._end += count
+            data = data[count:]
+            if len(data):
+                # 缓冲区已满，先解析出完整帧再继续追加
+                frames = [Frame(f.type, f.flags, f.channel, bytes(f.payload)) for f in self._parse()]
+                return frames + self.feed(data)
+        return self._parse()
+
+    def _parse(self):
+        frames = []
+        buffer_end = self._end
+        offset = self._start
+        while buffer_end - offset >= HEADER_SIZE:
+            frame_type, flags, channel, length = HEADER.unpack_from(self._buffer, offset)
+            if length > self.max_frame:
+                raise ProtocolError(f"帧负载过大: {length}")
+            end = offset + HEADER_SIZE + length
+            if end > buffer_end:
+                break
+            payload = self._view[offset + HEADER_SIZE:end]
+            frames.append(Frame(frame_type, flags, channel, payload))
+            offset = end
+        self._start = offset
+        return frames
+
+    def _make_room(self):
+        """保证缓冲区末尾有空间继续读入下一个不完整的帧"""
+        pending = self._end - self._start
+        if pending == 0:
+            self._start = self._end = 0
+            return
+
+        needed = HEADER_SIZE
+        if pending >= HEADER_SIZE:
+            needed += HEADER.unpack_from(self._buffer, self._start)[3]
+        if self._start + needed <= len(self._buffer):
+            return
+        if self._start:
+            # 把不完整的帧移到缓冲区开头（源和目标可能重叠，先复制出来）
+            self._buffer[:pending] = bytes(self._view[self._start:self._end])
+        elif self._end == len(self._buffer):
+            # 已收到的数据装满了缓冲区：扩大一倍，但不超过帧的大小
+            buffer = bytearray(min(needed, max(2 * len(self._buffer), HEADER_SIZE)))
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        else:
+            return
+        self._start = 0
+        self._end = pending
+
+    def shrink(self):
+        """没有未处理的数据时把扩大过的缓冲区恢复到初始大小"""
+        if len(self._buffer) > self.buffer_size and self._end == self._start:
+            self._buffer = bytearray(self.buffer_size)
+            self._view = memoryview(self._buffer)
+            self._start = self._end = 0
+
+    def buffered(self):
+        """尚未组成完整帧的字节数"""
+        return self._end - self._start
@@ -0,0 +1,152 @@
+import hmac
+import threading
+
+from heartbeat import TimerWheel
+
+# 断线后为用户保留用户名的时间（秒），期间凭会话令牌重新登录不会被当作新用户
+DEFAULT_SESSION_GRACE = 60
+
+
+class ConnectionRegistry:
+    """在线用户登记表
+
+    用户名的占用和释放在锁内原子完成，同一个用户名不会被登记两次。
+    广播使用的连接列表是不可变的元组，加入或离开时复制出新的元组再替换（写时复制），
+    广播时直接遍历当前的元组，不需要加锁，也不会因为有人加入或离开而出错。
+    每个房间的成员同样保存为写时复制的元组，房间内的消息只遍历该房间的成员。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}  # {用户名: 连接}
+        self._info = {}  # {用户名: {'ip': ip, 'port': port, 'join_time': time}}
+        self._snapshot = ()  # 接收广播的连接
+        self._rooms = {}  # {房间名: 成员连接元组}
+
+    def claim(self, username, conn, info):
+        """为连接占用用户名（同时设置 conn.username），已被占用时返回 False"""
+        with self._lock:
+            if username in self._connections:
+                return False
+            conn.username = username
+            self._connections[username] = conn
+            self._info[username] = info
+            return True
+
+    def publish(self, conn):
+        """让已占用用户名的连接开始接收广播"""
+        with self._lock:
+            if self._connections.get(conn.username) is conn and conn not in self._snapshot:
+                self._snapshot = self._snapshot + (conn,)
+
+    def release(self, conn):
+        """释放连接占用的用户名，返回该用户名；连接没有登记时返回 None"""
+        with self._lock:
+            username = conn.username
+            if username is None or self._connections.get(username) is not conn:
+                return None
+            del self._connections[username]
+            del self._info[username]
+            self._snapshot = tuple(c for c in self._snapshot if c is not conn)
+            for room in conn.rooms:
+                self._remove_member(room, conn)
+            return username
+
+    def join(self, conn, room):
+        """让已登记的连接加入房间，已在房间中或连接未登记时返回 False"""
+        with self._lock:
+            if room in conn.rooms or self._connections.get(conn.username) is not conn:
+                return False
+            conn.rooms.add(room)
+            self._rooms[room] = self._rooms.get(room, ()) + (conn,)
+            return True
+
+    def leave(self, conn, room):
+        """让连接离开房间，不在房间中时返回 False"""
+        with self._lock:
+            if room not in conn.rooms:
+                return False
+            conn.rooms.discard(room)
+            self._remove_member(room, conn)
+            return True
+
+    def _remove_member(self, room, conn):
+        members = tuple(c for c in self._rooms.get(room, ()) if c is not conn)
+        if members:
+            self._rooms[room] = members
+        else:
+            self._rooms.pop(room, None)
+
+    def members(self, room):
+        """房间当前的成员（不可变元组，遍历时无需加锁）"""
+        return self._rooms.get(room, ())
+
+    def room_size(self, room):
+        return len(self._rooms.get(room, ()))
+
+    def snapshot(self):
+        """当前接收广播的所有连接（不可变元组，遍历时无需加锁）"""
+        return self._snapshot
+
+    def get(self, username):
+        """用户名对应的连接，不在线时返回 None"""
+        return self._connections.get(username)
+
+    def info(self, username):
+        return self._info.get(username)
+
+    def __contains__(self, username):
+        return username in self._connections
+
+    def __len__(self):
+        return len(self._connections)
+
+
+class SessionTable:
+    """断线用户的会话保留表
+
+    登录时为连接签发会话令牌（conn.session）。连接意外断开后用户名连同令牌保留 grace 秒，
+    期间其他人不能使用该用户名，出示令牌的重新登录直接恢复，不产生离开和加入提示。
+    到期时间放在时间轮中，由 expire() 定时取出。
+    """
+
+    def __init__(self, grace=DEFAULT_SESSION_GRACE):
+        self.grace = grace
+        self._lock = threading.Lock()
+        self._reserved = {}  # {用户名: 令牌}
+        self._wheel = TimerWheel()
+
+    def reserve(self, username, token):
+        """保留断线用户的用户名，宽限期为 0 或没有令牌时返回 False"""
+        if self.grace <= 0 or not token:
+            return False
+        with self._lock:
+            self._reserved[username] = token
+            self._wheel.schedule(username, self.grace)
+        return True
+
+    def resume(self, username, token):
+        """令牌正确时取消保留并返回 True"""
+        if not isinstance(token, str):
+            return False
+        with self._lock:
+            reserved = self._reserved.get(username)
+            if reserved is None or not hmac.compare_digest(reserved, token):
+                return False
+            del self._reserved[username]
+            self._wheel.cancel(username)
+        return True
+
+    def expire(self):
+        """返回宽限期已过的用户名，这些用户此时才算真正离开"""
+        with self._lock:
+            expired = self._wheel.advance()
+            for username in expired:
+                del self._reserved[username]
+        return expired
+
+    def __contains__(self, username):
+        return username in self._reserved
+
+    def __len__(self):
+        return len(self._reserved)
@@ -1,202 +1,869 @@
+import hmac
 import socket
 import threading
-import json
 import os
 import datetime
+import time
+import argparse
+import json
+import secrets
+import tempfile
+import multiprocessing
+from bus import BusHub, BusClient, PRESENCE_ADD, PRESENCE_REMOVE
+from discovery import Beacon, DISCOVERY_PORT, DEFAULT_CAPACITY
+from metrics import Metrics, MetricsServer, DEFAULT_METRICS_HOST
+from heartbeat import IdleReaper, DEFAULT_PING_INTERVAL, DEFAULT_PING_TIMEOUT
+from federation import Federation, parse_peer
+from engine import ClientConnection, create_engine, ENGINES, DEFAULT_COALESCE_DELAY
+from filestore import FileStore, DEFAULT_STORE_DIR
+from history import MessageHistory, DEFAULT_HISTORY_DIR, DEFAULT_CACHE_SIZE
+from registry import ConnectionRegistry, SessionTable, DEFAULT_SESSION_GRACE
+from transfer import CHUNK_SIZE, is_compressible
+from outbound import (DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK, POLICY_DROP, POLICIES,
+                      FileStream)
+from protocol import (FRAME_JSON, FRAME_DATA, DEFAULT_BUFFER_SIZE, MAX_FRAME_SIZE, CODECS, DEFAULT_ROOM,
+                      MAX_ROOM_NAME,
+                      DEFAULT_COMPRESSION_LEVEL, ProtocolError, negotiate_codec,
+                      decompress_payload, encode_frame, encode_message, decode_message)
+
+# listen() 的默认等待队列长度，集中加入时避免连接被拒绝
+DEFAULT_BACKLOG = 128
+
+# 登录时最多恢复加入的房间数
+MAX_LOGIN_ROOMS = 50
 
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=5000):
+    def __init__(self, host='0.0.0.0', port=5000, engine='thread', backlog=DEFAULT_BACKLOG,
+                 high_watermark=DEFAULT_HIGH_WATERMARK, low_watermark=DEFAULT_LOW_WATERMARK,
+                 slow_consumer_policy=POLICY_DROP, recv_buffer_size=DEFAULT_BUFFER_SIZE,
+                 store_dir=DEFAULT_STORE_DIR, coalesce_delay=DEFAULT_COALESCE_DELAY,
+                 history_dir=DEFAULT_HISTORY_DIR, history_cache=DEFAULT_CACHE_SIZE,
+                 compression=CODECS, compression_level=DEFAULT_COMPRESSION_LEVEL,
+                 reuse_port=False, bus_path=None, node_id=None, peers=(), accept_peers=False,
+                 peer_secret=None, discovery_port=DISCOVERY_PORT, capacity=DEFAULT_CAPACITY,
+                 metrics_port=0, metrics_host=DEFAULT_METRICS_HOST,
+                 ping_interval=DEFAULT_PING_INTERVAL, ping_timeout=DEFAULT_PING_TIMEOUT,
+                 session_grace=DEFAULT_SESSION_GRACE):
         self.host = host
         self.port = port
+        self.backlog = backlog
+        self.reuse_port = reuse_port  # 多进程模式下各工作进程监听同一端口
+        self.recv_buffer_size = recv_buffer_size  # 每个连接可复用接收缓冲区的初始大小
+        self.coalesce_delay = coalesce_delay  # 线程引擎写线程合并消息的等待时间（秒）
+        self.compression = tuple(compression)  # 允许使用的压缩算法，按优先顺序排列
+        self.compression_level = compression_level
+        # 每个连接发送队列的水位线与慢速消费者策略
+        self.queue_options = {
+            'high_watermark': high_watermark,
+            'low_watermark': low_watermark,
+            'policy': slow_consumer_policy
+        }
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.clients = {}  # 存储客户端连接 {client_socket: username}
-        self.usernames = set()  # 存储当前在线的用户名
-        self.user_info = {}  # 存储用户详细信息 {username: {'ip': ip, 'port': port, 'join_time': time}}
-        self.info_callback = None  # 用于更新UI的回调函数
+        self.metrics = Metrics()  # 运行指标，启动器面板和指标接口读取
+        # metrics_port 为 0 时不开启 HTTP 指标接口
+        self.metrics_server = MetricsServer(self.metrics, metrics_host, metrics_port) if metrics_port else None
+        self.engine = create_engine(engine, self)  # 处理连接的引擎（线程或事件循环）
+        # 心跳：断开长时间没有响应的连接，ping_interval 为 0 时不检查
+        self.reaper = IdleReaper(self, ping_interval, ping_timeout) if ping_interval > 0 else None
+        self.registry = ConnectionRegistry()  # 在线用户、连接及用户详细信息
+        # 断线用户在宽限期内保留的用户名，多进程模式下由消息总线统一保留
+        self.sessions = SessionTable(session_grace) if bus_path is None else None
+        self.presence_callback = None  # 在线用户变化时通知界面的回调函数
+        self.room_callback = None  # 房间人数变化时通知界面的回调函数
+        self.file_store = FileStore(store_dir)  # 按内容哈希寻址的文件存储
+        # 分配序号与放入发送队列按同样的顺序进行，线程引擎下各连接收到的消息也按序号排列
+        self.delivery_lock = threading.RLock()
+        if bus_path is None:
+            self.bus = None
+            self.history = MessageHistory(history_dir, history_cache)  # 带序号的聊天记录
+        else:
+            # 多进程模式：聊天记录和用户名由主进程中的消息总线统一管理
+            self.bus = BusClient(bus_path, self.handle_bus_message, self.handle_bus_closed)
+            self.history = None
+        self.beacon = None  # 应答局域网中客户端的服务器发现探测，多进程模式下由主进程应答
+        if discovery_port and bus_path is None:
+            self.beacon = Beacon(port, lambda: len(self.registry), capacity, node_id, discovery_port)
+        self.federation = None  # 与其他服务器的互联
+        if peers or accept_peers:
+            if bus_path is not None:
+                raise ValueError("多进程模式不支持服务器互联")
+            self.federation = Federation(self, node_id or f"{socket.gethostname()}:{port}",
+                                         peers, peer_secret)
 
     def start(self):
+        if self.bus is not None:
+            self.bus.connect()
         # 添加 socket 重用选项
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # 由内核把新连接分配给监听同一端口的各个工作进程
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
-        print(f"服务器启动成功，监听地址: {self.host}:{self.port}")
-
-        while True:
-            client_socket, address = self.server_socket.accept()
-            print(f"新的连接来自: {address}")
-
-            # 开启新线程处理客户端连接
-            client_thread = threading.Thread(
-                target=self.handle_client,
-                args=(client_socket, address)
-            )
-            client_thread.start()
+        self.server_socket.listen(self.backlog)
+        print(f"服务器启动成功，监听地址: {self.host}:{self.port} (引擎: {self.engine.name})")
+        if self.beacon is not None:
+            self.beacon.start()
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.federation is not None:
+            self.federation.start()
+
+        self.engine.serve(self.server_socket)
+
+    def run_timers(self):
+        """由引擎每个 tick 调用：检查空闲连接，通知宽限期已过的断线用户离开"""
+        if self.reaper is not None:
+            self.reaper.run()
+        if self.sessions is not None:
+            for username in self.sessions.expire():
+                self.announce_leave(username)
 
     def check_username(self, username):
-        """检查用户名是否可用"""
+        """检查用户名是否可用（真正占用由 registry.claim 原子完成）"""
         if not username or not username.strip():
             return False
-        return username not in self.usernames
+        if self.sessions is not None and username in self.sessions:
+            return False  # 断线用户的保留期内
+        if self.federation is not None and self.federation.has_user(username):
+            return False
+        return username not in self.registry
 
     def handle_client(self, client_socket, client_address):
-        try:
-            # 接收并验证用户名
-            while True:
+        """线程引擎下处理单个客户端连接"""
+        conn = ClientConnection(client_socket, client_address, self.queue_options,
+                                self.recv_buffer_size)
+        self.engine.run_connection(conn)
+
+    def handle_frames(self, conn, frames):
+        """处理从客户端收到的帧，两种引擎共用"""
+        conn.messages_in += len(frames)
+        for frame in frames:
+            if conn.closed:
+                break  # 已退出登录或被断开，同一批中剩下的帧不再处理
+            if conn.peer is not None:
+                self.federation.handle_frame(conn, frame)
+            elif frame.type == FRAME_DATA:
+                self.handle_file_data(conn, frame)
+            elif frame.type == FRAME_JSON:
                 try:
-                    username = client_socket.recv(1024).decode()
-                    if not username:  # 连接已关闭
-                        return
-
-                    if self.check_username(username):
-                        # 用户名可用
-                        client_socket.send("USERNAME_ACCEPTED".encode())
-                        self.clients[client_socket] = username
-                        self.usernames.add(username)
-                        # 记录用户信息
-                        self.user_info[username] = {
-                            'ip': client_address[0],
-                            'port': client_address[1],
-                            'join_time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        }
-                        self.update_user_info()  # 更新UI显示
-                        break
-                    else:
-                        # 用户名已被使用或无效
-                        client_socket.send("USERNAME_TAKEN".encode())
-                except Exception as e:
-                    print(f"用户名验证过程出错: {e}")
-                    return
-
-            current_time = datetime.datetime.now().strftime("%H:%M:%S")
-            self.broadcast(f"[{current_time}] {username} 加入了聊天室")
-
-            # 添加文件传输状态标志
-            is_receiving_file = False
-            remaining_bytes = 0
-
-            while True:
-                data = client_socket.recv(1024)
-                if not data:
-                    break
-
-                if is_receiving_file:
-                    # 正在接收文件内容
-                    try:
-                        remaining_bytes -= len(data)
-                        # 转发文件数据给接收方
-                        for client in self.clients:
-                            if client != client_socket:
-                                try:
-                                    client.send(data)
-                                except:
-                                    continue
-
-                        if remaining_bytes <= 0:
-                            is_receiving_file = False
-                    except Exception as e:
-                        print(f"文件传输错误: {e}")
-                        is_receiving_file = False
-                else:
-                    # 尝试解析普通消息
-                    try:
-                        message = json.loads(data.decode())
-                        if message['type'] == 'text':
-                            self.broadcast(f"[{message['time']}] {username}: {message['content']}")
-                        elif message['type'] == 'file':
-                            # 设置文件传输状态
-                            is_receiving_file = True
-                            remaining_bytes = message['filesize']
-                            self.handle_file_transfer(client_socket, username, message)
-                    except json.JSONDecodeError:
-                        print("无法解析的消息格式")
-                        continue
-
-
-        except Exception as e:
-
-            print(f"处理客户端时出错: {e}")
-
-        finally:
-
-            if client_socket in self.clients:
-                username = self.clients[client_socket]
-
-                self.usernames.remove(username)
-
-                del self.user_info[username]  # 移除用户信息
-
-                current_time = datetime.datetime.now().strftime("%H:%M:%S")
-
-                del self.clients[client_socket]
-
-                self.broadcast(f"[{current_time}] {username} 离开了聊天室")
-
-                self.update_user_info()  # 更新UI显示
-
-                client_socket.close()
-
-    def handle_file_transfer(self, sender_socket, username, message):
-        """处理文件传输"""
-        filename = message['filename']
+                    message = decode_message(frame.payload, frame.flags)
+                except ProtocolError as e:
+                    print(e)
+                    continue
+                self.handle_message(conn, message)
+            else:
+                print(f"未知的帧类型: {frame.type}")
+
+    def handle_message(self, conn, message):
+        """处理一条控制/聊天消息"""
+        if message['type'] == 'ping':
+            self.send_message(conn, {'type': 'pong'})
+            return
+        if message['type'] == 'pong':
+            return  # 收到数据时已经更新了 last_seen
+        if conn.username is None:
+            if message['type'] == 'login':
+                self.handle_login(conn, message.get('username', ''), message.get('since'),
+                                  message.get('compression'), message.get('rooms'),
+                                  message.get('resume'))
+            elif message['type'] == 'peer_hello' and self.federation is not None:
+                self.federation.accept_link(conn, message)
+            return
+
+        if message['type'] == 'text':
+            room = message.get('room', DEFAULT_ROOM)
+            if room not in conn.rooms:
+                return
+            self.broadcast_recorded({
+                'type': 'text',
+                'room': room,
+                'sender': conn.username,
+                'content': message['content'],
+                'time': message['time']
+            })
+        elif message['type'] == 'direct':
+            self.send_direct(conn, {
+                'type': 'direct',
+                'sender': conn.username,
+                'to': message['to'],
+                'content': message['content'],
+                'time': message['time']
+            })
+        elif message['type'] == 'file':
+            self.handle_file_transfer(conn, conn.username, message)
+        elif message['type'] == 'file_request':
+            self.handle_file_request(conn, message)
+        elif message['type'] == 'file_cancel':
+            self.cancel_transfer(conn, message['channel'])
+        elif message['type'] == 'p2p_request':
+            self.handle_p2p_request(conn, message)
+        elif message['type'] == 'p2p_relay':
+            self.handle_p2p_relay(conn, message)
+        elif message['type'] == 'history_request':
+            self.send_history(conn, message.get('since'))
+        elif message['type'] == 'join_room':
+            self.handle_join_room(conn, message.get('room'))
+        elif message['type'] == 'leave_room':
+            self.handle_leave_room(conn, message.get('room'))
+        elif message['type'] == 'logout':
+            # 主动退出，不保留用户名
+            conn.session = None
+            self.engine.close(conn)
+
+    def cancel_transfer(self, conn, channel):
+        """取消该通道上的下载或上传，中止的上传保留已校验的部分供下次续传"""
+        conn.outbound.cancel_stream(channel)
+        entry = conn.uploads.pop(channel, None)
+        if entry is not None:
+            entry['upload'].abort()
+
+    def handle_login(self, conn, username, since=None, compression=None, rooms=None, resume=None):
+        """验证并占用用户名，resume 为上次登录的会话令牌"""
+        info = {
+            'ip': conn.address[0],
+            'port': conn.address[1],
+            'join_time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        valid = isinstance(username, str)
+        if valid and isinstance(resume, str):
+            self.take_over(username, resume)
+        # 保留期内出示令牌：恢复原来的会话，不再检查用户名
+        resumed = valid and self.sessions is not None and self.sessions.resume(username, resume)
+        if (not valid or not (resumed or self.check_username(username))
+                or not self.registry.claim(username, conn, info)):
+            # 用户名已被使用或无效
+            self.send_message(conn, {'type': 'login_result', 'status': 'USERNAME_TAKEN'})
+            return
+
+        if self.bus is not None:
+            # 其他工作进程上可能有同名用户，由总线确认后再完成登录；
+            # 令牌先交给总线登记，其他进程上的新连接出示它时由总线通知这里关闭旧连接
+            conn.session = secrets.token_hex(16)
+            self.bus.request({'type': 'claim', 'username': username, 'info': info, 'since': since,
+                              'resume': resume, 'session': conn.session},
+                             lambda reply: self.engine.call_soon(self.finish_bus_login, conn,
+                                                                 reply, compression, rooms))
+            return
+
+        self.accept_login(conn, compression, resumed)
+        # 先开始接收广播再读取补发的记录，之后的消息都会实时收到，不会遗漏；
+        # 这期间的消息可能既在补发中又实时收到，由客户端按序号去掉重复的
+        self.registry.publish(conn)
+        self.join_rooms(conn, rooms)
+        self.send_history(conn, since)
+        if resumed:
+            # 其他人看来该用户一直在线，只补发断线期间错过的消息
+            return
+        self.notify_presence(PRESENCE_ADD, username, info)  # 更新UI显示
+        if self.federation is not None:
+            self.federation.relay_presence(PRESENCE_ADD, username, info)
+
+        self.broadcast_system(f"{username} 加入了聊天室")
+
+    def take_over(self, username, token):
+        """旧连接还没有被心跳断开（如休眠后换了网络）时，出示其会话令牌的新连接接替它"""
+        old = self.registry.get(username)
+        if old is not None and old.session and hmac.compare_digest(old.session, token):
+            print(f"{username} 重新连接，关闭旧的连接 {old.address}")
+            # 旧连接关闭时用户名进入保留期，随后由新连接恢复
+            self.engine.close(old)
+
+    def accept_login(self, conn, compression, resumed=False):
+        """回复登录成功并签发新的会话令牌，同时从客户端支持的算法中选出压缩算法，之后双方发送的帧都按它压缩"""
+        codec = negotiate_codec(compression, self.compression, self.compression_level)
+        if conn.session is None:
+            conn.session = secrets.token_hex(16)
+        self.send_message(conn, {
+            'type': 'login_result',
+            'status': 'USERNAME_ACCEPTED',
+            'session': conn.session,
+            'resumed': resumed,
+            'compression': {'codec': codec.name, 'level': codec.level} if codec else None,
+            # 客户端按同样的间隔检测服务器是否失联
+            'heartbeat': {'interval': self.reaper.interval, 'timeout': self.reaper.timeout}
+                         if self.reaper else None
+        })
+        conn.codec = codec
+        conn.parser.max_frame = MAX_FRAME_SIZE  # 登录后才允许文件数据等大帧
+
+    def finish_bus_login(self, conn, reply, compression, rooms=None):
+        """多进程模式：总线确认用户名后完成登录（加入提示与在线状态由总线广播）"""
+        if conn.closed:
+            # 等待期间连接已断开，remove_client 已经通知总线释放用户名
+            return
+        if not reply['ok']:
+            self.registry.release(conn)
+            conn.username = None
+            conn.session = None
+            self.send_message(conn, {'type': 'login_result', 'status': 'USERNAME_TAKEN'})
+            return
+        self.accept_login(conn, compression, reply.get('resumed', False))
+        # 总线先回复补发的记录再转发之后的广播，两者按顺序在这里处理
+        self.registry.publish(conn)
+        self.join_rooms(conn, rooms)
+        self.send_history_records(conn, reply['messages'], reply['truncated'])
+
+    def join_rooms(self, conn, rooms):
+        """登录时加入公共房间，以及客户端断线前所在的房间"""
+        names = [DEFAULT_ROOM]
+        if isinstance(rooms, list):
+            names += [room for room in rooms[:MAX_LOGIN_ROOMS] if is_valid_room(room)]
+        for room in names:
+            if self.registry.join(conn, room):
+                self.notify_room(room)
+
+    def handle_join_room(self, conn, room):
+        if not is_valid_room(room):
+            self.send_message(conn, {'type': 'room_result', 'room': room, 'status': 'invalid'})
+            return
+        if not self.registry.join(conn, room):
+            return
+        self.send_message(conn, {'type': 'room_result', 'room': room, 'status': 'joined'})
+        self.notify_room(room)
+        self.broadcast_system(f"{conn.username} 加入了房间", room)
+
+    def handle_leave_room(self, conn, room):
+        """离开房间，公共房间不能离开"""
+        if room == DEFAULT_ROOM or not self.registry.leave(conn, room):
+            return
+        self.send_message(conn, {'type': 'room_result', 'room': room, 'status': 'left'})
+        self.notify_room(room)
+        self.broadcast_system(f"{conn.username} 离开了房间", room)
+
+    def remove_client(self, conn):
+        """连接断开后清理用户信息"""
+        if self.federation is not None and self.federation.link_closed(conn):
+            return
+        # 放弃未完成的上传
+        for entry in conn.uploads.values():
+            entry['upload'].abort()
+        conn.uploads.clear()
+
+        username = self.registry.release(conn)  # 同时移除用户信息
+        if username is None:
+            return
+        for room in conn.rooms:
+            self.notify_room(room)
+        if self.bus is not None:
+            self.bus.send({'type': 'release', 'username': username, 'session': conn.session})
+            return
+        if self.sessions.reserve(username, conn.session):
+            # 意外断线：宽限期内保留用户名，到期后才通知离开
+            return
+        self.announce_leave(username)
+
+    def announce_leave(self, username):
+        """通知所有人该用户离开"""
+        self.broadcast_system(f"{username} 离开了聊天室")
+
+        self.notify_presence(PRESENCE_REMOVE, username)  # 更新UI显示
+        if self.federation is not None:
+            self.federation.relay_presence(PRESENCE_REMOVE, username)
+
+    def handle_file_transfer(self, sender, username, message):
+        """处理文件上传请求：已有相同内容时直接通知，否则准备接收"""
+        channel = message['channel']
+        file_id = message['file_id']
         filesize = message['filesize']
-        time = message['time']
 
-        # 通知其他客户端有新文件可以接收
-        notification = json.dumps({
+        if message.get('p2p'):
+            # 直连传输：文件留在发送者本机，服务器只转发通知，接收方同意后再交换地址
+            self.send_message(sender, {'type': 'upload_result', 'channel': channel, 'status': 'ok',
+                                       'p2p': True})
+            self.announce_file(sender, username, message)
+            return
+
+        try:
+            if self.file_store.has(file_id, filesize):
+                # 相同内容已经存储过，无需再次上传
+                self.send_message(sender, {'type': 'upload_ready', 'channel': channel, 'exists': True})
+                self.announce_file(sender, username, message)
+                return
+            upload = self.file_store.begin_upload(file_id, filesize, message.get('chunk_hashes'))
+        except (OSError, ValueError) as e:
+            self.send_message(sender, {'type': 'upload_result', 'channel': channel,
+                                       'status': 'error', 'reason': str(e)})
+            return
+
+        sender.uploads[channel] = {'upload': upload, 'message': message}
+        # 之前中断过的上传从最后校验通过的位置继续
+        self.send_message(sender, {'type': 'upload_ready', 'channel': channel, 'exists': False,
+                                   'offset': upload.offset})
+        if upload.complete:
+            self.finish_upload(sender, channel)
+
+    def handle_file_data(self, conn, frame):
+        """把上传的文件数据写入存储"""
+        entry = conn.uploads.get(frame.channel)
+        if entry is None:
+            print(f"丢弃不属于任何传输的数据帧 (通道 {frame.channel})")
+            return
+
+        try:
+            data = decompress_payload(frame.payload, frame.flags)
+            entry['upload'].write(data)
+            self.metrics.file_bytes_in.inc(len(data))
+        except (OSError, ValueError) as e:
+            del conn.uploads[frame.channel]
+            entry['upload'].abort()
+            self.send_message(conn, {'type': 'upload_result', 'channel': frame.channel,
+                                     'status': 'error', 'reason': str(e)})
+            return
+
+        if entry['upload'].complete:
+            self.finish_upload(conn, frame.channel)
+
+    def finish_upload(self, conn, channel):
+        """上传完成：校验并存储文件，然后通知其他人"""
+        entry = conn.uploads.pop(channel)
+        if not conn.uploads:
+            conn.parser.shrink()
+        try:
+            entry['upload'].commit()
+        except (OSError, ValueError) as e:
+            self.send_message(conn, {'type': 'upload_result', 'channel': channel,
+                                     'status': 'error', 'reason': str(e)})
+            return
+        self.send_message(conn, {'type': 'upload_result', 'channel': channel, 'status': 'ok'})
+        self.announce_file(conn, conn.username, entry['message'])
+
+    def announce_file(self, sender, username, message):
+        """通知其他客户端有新文件可以下载，私发的文件只通知接收人
+
+        直连失败后补传到服务器的文件不再通知，只告诉等待中的接收方可以从服务器下载。
+        """
+        if message.get('relay_for') is not None:
+            self.send_direct(sender, {
+                'type': 'p2p_relay_ready',
+                'sender': username,
+                'to': message['relay_for'],
+                'file_id': message['file_id']
+            })
+            return
+        if message.get('to') is not None:
+            notification = {
+                'type': 'file_notification',
+                'sender': username,
+                'to': message['to'],
+                'file_id': message['file_id'],
+                'filename': message['filename'],
+                'filesize': message['filesize'],
+                'time': message['time']
+            }
+            if message.get('p2p'):
+                notification['p2p'] = True
+            self.send_direct(sender, notification)
+            return
+        room = message.get('room', DEFAULT_ROOM)
+        if room not in sender.rooms:
+            return
+        notification = {
             'type': 'file_notification',
+            'room': room,
             'sender': username,
-            'filename': filename,
-            'filesize': filesize,
-            'time': time
+            'file_id': message['file_id'],
+            'filename': message['filename'],
+            'filesize': message['filesize'],
+            'time': message['time']
+        }
+        if message.get('p2p'):
+            notification['p2p'] = True
+
+        # 向其他客户端广播文件通知，接收方同意后再下载
+        self.broadcast_recorded(notification, sender)
+
+    def send_direct(self, sender, message):
+        """把私聊消息或私发文件的通知只发给 message['to']，不写入聊天记录
+
+        接收人在本服务器上时按用户名直接找到连接，只发送一次；否则交给总线或互联的服务器转发，
+        都找不到时告诉发送者对方不在线。
+        """
+        target = self.registry.get(message['to'])
+        if target is not None:
+            self.send_message(target, message)
+            return
+        if self.bus is not None:
+            self.bus.send({'type': 'direct', 'message': message})
+            return
+        if self.federation is not None and self.federation.send_direct(message):
+            return
+        self.direct_failed(sender, message)
+
+    def deliver_direct(self, message):
+        """把其他进程或服务器转发来的私聊消息发给本地的接收人，不在线时返回 False"""
+        target = self.registry.get(message['to'])
+        if target is None:
+            return False
+        self.send_message(target, message)
+        return True
+
+    def direct_failed(self, sender, message):
+        """告诉发送者接收人不在线，request 和 file_id 用于区分失败的是哪一个直连请求"""
+        if sender is not None:
+            self.send_message(sender, {'type': 'direct_failed', 'to': message['to'],
+                                       'reason': f"{message['to']} 不在线",
+                                       'request': message['type'],
+                                       'file_id': message.get('file_id')})
+
+    def handle_p2p_request(self, conn, message):
+        """接收方请求直连下载：生成一次性令牌，把接收方的地址和令牌转给文件的发送者
+
+        接收方的 IP 取自登录时记录的用户信息，端口是它为这次下载临时监听的端口。
+        发送者连接后先出示令牌，接收方核对一致才接收数据，令牌用过即作废。
+        """
+        port = message.get('port')
+        if not isinstance(port, int) or not 0 < port < 65536:
+            return
+        token = secrets.token_hex(16)
+        self.send_message(conn, {'type': 'p2p_token', 'channel': message['channel'],
+                                 'token': token})
+        self.send_direct(conn, {
+            'type': 'p2p_connect',
+            'sender': conn.username,  # 发起请求的接收方，对方不在线时据此回复
+            'to': message['to'],
+            'file_id': message['file_id'],
+            'channel': message['channel'],
+            'offset': message.get('offset', 0),
+            'address': [self.registry.info(conn.username)['ip'], port],
+            'token': token
         })
 
-        # 向其他客户端广播文件通知
-        for client in self.clients:
-            if client != sender_socket:
-                try:
-                    client.send(notification.encode())
-                except:
-                    continue
+    def handle_p2p_relay(self, conn, message):
+        """直连失败，改由服务器中转：服务器已有该文件时直接通知接收方，否则请发送者上传"""
+        file_id = message['file_id']
+        if self.file_store.has(file_id):
+            self.send_message(conn, {'type': 'p2p_relay_ready', 'sender': message['to'],
+                                     'file_id': file_id})
+            return
+        self.send_direct(conn, {'type': 'p2p_relay', 'sender': conn.username, 'to': message['to'],
+                                'file_id': file_id})
+
+    def handle_file_request(self, conn, message):
+        """接收方请求下载文件（可指定范围），先发送分块清单再从存储中直接发送数据"""
+        channel = message['channel']
+        file_id = message['file_id']
+        path = self.file_store.path(file_id)
+        manifest = self.file_store.manifest(file_id) if path else None
+        if manifest is None:
+            if self.federation is not None and self.federation.fetch(conn, message):
+                # 文件在其他服务器上，取回后再发送
+                return
+            self.send_message(conn, {'type': 'file_aborted', 'channel': channel,
+                                     'reason': '服务器上没有该文件'})
+            return
+
+        size = manifest['size']
+        offset = message.get('offset', 0)
+        length = message.get('length', size - offset if isinstance(offset, int) else None)
+        if (not isinstance(offset, int) or not isinstance(length, int)
+                or not (0 <= offset <= size and 0 <= length <= size - offset)):
+            self.send_message(conn, {'type': 'file_aborted', 'channel': channel,
+                                     'reason': '请求的范围无效'})
+            return
+
+        self.send_message(conn, {
+            'type': 'file_meta',
+            'channel': channel,
+            'file_id': file_id,
+            'filesize': size,
+            'chunk_size': CHUNK_SIZE,
+            'chunk_hashes': manifest['chunk_hashes'],
+            'offset': offset,
+            'length': length
+        })
+        # 已经压缩过的内容不再压缩，直接用 sendfile 发送
+        codec = conn.codec if conn.codec and is_compressible(path) else None
+        self.engine.send_stream(conn, FileStream(path, channel, length, offset, codec=codec))
+
+    def send_message(self, conn, message):
+        """向单个客户端发送消息"""
+        self.engine.send(conn, encode_message(message, codec=conn.codec))
+
+    def send_ping(self, conn):
+        """心跳检测：请对方回应，发送队列拥塞时也放入"""
+        self.engine.send(conn, encode_message({'type': 'ping'}, codec=conn.codec), force=True)
+
+    def encode_for(self, conn, message, encoded):
+        """按连接协商的压缩算法编码消息
+
+        encoded 缓存已经编码的结果，每种编码只做一次，使用相同算法的连接共享同一个
+        不可变的 bytes 对象。
+        """
+        key = conn.codec.name if conn.codec else None
+        data = encoded.get(key)
+        if data is None:
+            data = encoded[key] = encode_message(message, codec=conn.codec)
+        return data
 
     def broadcast(self, message):
         """广播消息给所有客户端"""
-        for client in self.clients:
-            try:
-                client.send(message.encode())
-            except:
-                continue
-
-    def broadcast_except_sender(self, message, sender_socket):
+        if self.bus is not None:
+            self.bus.send({'type': 'publish', 'message': message, 'record': False})
+            return
+        self.deliver(message)
+
+    def broadcast_recorded(self, message, sender=None):
+        """为消息分配序号、写入聊天记录后广播（不发给 sender）
+
+        记录锁只在分配序号和写入时持有，广播在锁外进行；发送顺序锁保证每个连接收到的消息按序号排列，
+        登录时读取补发记录不会占用这两把锁。多进程模式下由总线分配序号并转发给所有工作进程；互联时同时转发给其他服务器。
+        """
+        exclude = sender.username if sender is not None else None
+        if self.bus is not None:
+            self.bus.send({'type': 'publish', 'message': message, 'exclude': exclude})
+            return
+        with self.delivery_lock:
+            if self.federation is not None:
+                self.federation.relay_message(message)
+            self.record_and_deliver(message, exclude)
+
+    def record_and_deliver(self, message, exclude=None):
+        """写入本地聊天记录后发给本地客户端（也用于其他服务器转发来的消息）"""
+        with self.delivery_lock:
+            record = self.history.append(message)
+            # 放入各连接的发送队列不会阻塞，按序号依次完成
+            self.deliver(record, exclude)
+
+    def deliver(self, message, exclude=None):
+        """把消息发给本进程上除 exclude（用户名）以外的所有客户端，房间消息只发给房间成员"""
+        start = time.perf_counter()
+        room = message.get('room')
+        clients = self.registry.members(room) if room is not None else self.registry.snapshot()
+        encoded = {}
+        for client in clients:
+            if client.username != exclude:
+                self.engine.send(client, self.encode_for(client, message, encoded))
+        self.metrics.broadcasts.inc()
+        self.metrics.fanout.observe(time.perf_counter() - start)
+
+    def send_history(self, conn, since=None):
+        """一次性补发序号大于 since 的聊天记录，since 为空时补发最近的消息"""
+        if not isinstance(since, int) or isinstance(since, bool):
+            since = None
+        if self.bus is not None:
+            self.bus.request({'type': 'history', 'since': since},
+                             lambda reply: self.engine.call_soon(
+                                 self.send_history_records, conn, reply['messages'],
+                                 reply['truncated']))
+            return
+        records, truncated = self.history.since(since)
+        # 只补发公共消息和所在房间的消息
+        records = [line for line in records if can_see(conn, json.loads(line))]
+        # 记录已经是编码好的 JSON，直接拼接成一个帧，无需重新序列化
+        payload = '{"type": "history", "truncated": %s, "messages": [%s]}' % (
+            json.dumps(truncated), ', '.join(records))
+        self.engine.send(conn, encode_frame(FRAME_JSON, payload.encode('utf-8'), codec=conn.codec),
+                         force=True)
+
+    def send_history_records(self, conn, messages, truncated):
+        """多进程模式：补发总线回复的聊天记录"""
+        messages = [message for message in messages if can_see(conn, message)]
+        self.engine.send(conn, encode_message({'type': 'history', 'truncated': truncated,
+                                               'messages': messages}, codec=conn.codec),
+                         force=True)
+
+    def handle_bus_message(self, message):
+        """总线转发来的消息（在总线读线程中调用），交给引擎线程处理"""
+        self.engine.call_soon(self.handle_bus_event, message)
+
+    def handle_bus_event(self, message):
+        if message['type'] == 'deliver':
+            self.deliver(message['message'], message.get('exclude'))
+        elif message['type'] == 'presence':
+            self.notify_presence(message['action'], message['username'], message.get('info'))
+        elif message['type'] == 'direct':
+            self.deliver_direct(message['message'])
+        elif message['type'] == 'direct_failed':
+            self.direct_failed(self.registry.get(message['message']['sender']), message['message'])
+        elif message['type'] == 'take_over':
+            self.take_over(message['username'], message['session'])
+
+    def handle_bus_closed(self):
+        """与主进程的总线断开后无法再与其他进程同步，结束工作进程"""
+        print("消息总线已断开，工作进程退出")
+        os._exit(1)
+
+    def broadcast_except_sender(self, message, sender):
         """广播消息给除了发送者以外的所有客户端"""
-        for client in self.clients:
-            if client != sender_socket:
-                try:
-                    client.send(message.encode())
-                except:
-                    continue
-
-    def set_info_callback(self, callback):
-        """设置信息更新回调函数"""
-        self.info_callback = callback
-
-    def update_user_info(self):
-        """更新用户信息"""
-        if self.info_callback:
-            user_list = []
-            for username, info in self.user_info.items():
-                user_list.append({
-                    'username': username,
-                    'ip': info['ip'],
-                    'port': info['port'],
-                    'join_time': info['join_time']
-                })
-            self.info_callback(len(self.clients), user_list)
+        if self.bus is not None:
+            self.bus.send({'type': 'publish', 'message': message, 'exclude': sender.username,
+                           'record': False})
+            return
+        self.deliver(message, sender.username)
+
+    def broadcast_system(self, content, room=None):
+        """广播系统提示（加入、离开等），指定 room 时只发给该房间的成员"""
+        message = {
+            'type': 'system',
+            'content': content,
+            'time': datetime.datetime.now().strftime("%H:%M:%S")
+        }
+        if room is not None:
+            message['room'] = room
+        self.broadcast_recorded(message)
+
+    def set_presence_callback(self, callback):
+        """设置在线用户变化的回调函数 callback(action, username, info)
+
+        每次加入或离开只通知变化的那一个用户，action 为 PRESENCE_ADD 或 PRESENCE_REMOVE，
+        离开时 info 为 None。回调在处理连接的线程中调用。
+        """
+        self.presence_callback = callback
+
+    def notify_presence(self, action, username, info=None):
+        """通知界面某个用户加入或离开"""
+        if self.presence_callback:
+            self.presence_callback(action, username, info)
+
+    def set_room_callback(self, callback):
+        """设置房间人数变化的回调函数 callback(room, count)，count 为 0 表示房间已没有人"""
+        self.room_callback = callback
+
+    def notify_room(self, room):
+        if self.room_callback:
+            self.room_callback(room, self.registry.room_size(room))
+
+
+def is_valid_room(room):
+    return isinstance(room, str) and 0 < len(room) <= MAX_ROOM_NAME and room == room.strip()
+
+
+def can_see(conn, message):
+    """消息是否应该发给该连接：公共消息所有人可见，房间消息只有成员可见"""
+    room = message.get('room')
+    return room is None or room in conn.rooms
+
+
+def parse_compression(value):
+    """解析 --compression 参数"""
+    if value == 'none':
+        return ()
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    for name in names:
+        if name not in CODECS:
+            raise argparse.ArgumentTypeError(f"不支持的压缩算法: {name}")
+    return names
+
+
+def parse_peer_arg(value):
+    """解析 --peer 参数"""
+    try:
+        return parse_peer(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="局域网聊天室服务器")
+    parser.add_argument('--host', default='0.0.0.0', help="监听地址")
+    parser.add_argument('--port', type=int, default=5000, help="监听端口")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='thread',
+                        help="连接处理引擎：thread 为每连接一个线程，selector 为单线程事件循环")
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG, help="listen() 等待队列长度")
+    parser.add_argument('--high-watermark', type=int, default=DEFAULT_HIGH_WATERMARK,
+                        help="单个连接发送队列的高水位（字节），超过后视为慢速客户端")
+    parser.add_argument('--low-watermark', type=int, default=DEFAULT_LOW_WATERMARK,
+                        help="发送队列回落到该值以下后恢复正常发送（字节）")
+    parser.add_argument('--slow-consumer-policy', choices=POLICIES, default=POLICY_DROP,
+                        help="慢速客户端处理策略：drop 丢弃拥塞期间的消息，disconnect 直接断开")
+    parser.add_argument('--recv-buffer', type=int, default=DEFAULT_BUFFER_SIZE,
+                        help="每个连接接收缓冲区的初始大小（字节），遇到更大的帧时自动扩大")
+    parser.add_argument('--store-dir', default=DEFAULT_STORE_DIR, help="上传文件的存储目录")
+    parser.add_argument('--history-dir', default=DEFAULT_HISTORY_DIR, help="聊天记录的存储目录")
+    parser.add_argument('--history-cache', type=int, default=DEFAULT_CACHE_SIZE,
+                        help="内存中缓存的最近消息条数")
+    parser.add_argument('--compression', type=parse_compression, default=','.join(CODECS),
+                        help="允许与客户端协商的压缩算法，逗号分隔并按优先顺序排列，none 表示不压缩")
+    parser.add_argument('--compression-level', type=int, default=DEFAULT_COMPRESSION_LEVEL,
+                        help="压缩级别（zlib 为 1-9，lzma 为 0-9）")
+    parser.add_argument('--coalesce-delay', type=float, default=DEFAULT_COALESCE_DELAY,
+                        help="线程引擎写线程被唤醒后等待多久再发送（秒），用于合并消息，0 表示立即发送")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="工作进程数，大于 1 时多个进程共同监听同一端口（需要 SO_REUSEPORT）")
+    parser.add_argument('--bus-path', default=None,
+                        help="多进程模式下消息总线的 Unix 套接字路径，默认在临时目录中创建")
+    parser.add_argument('--peer', action='append', default=[], type=parse_peer_arg,
+                        help="互联的其他服务器地址 host:port，可以指定多次")
+    parser.add_argument('--accept-peers', action='store_true',
+                        help="接受其他服务器主动发起的互联（指定 --peer 时自动开启）")
+    parser.add_argument('--node-id', default=None,
+                        help="互联时本服务器的节点ID，默认为 主机名:端口")
+    parser.add_argument('--peer-secret', default=None,
+                        help="服务器间互联的共享密钥，所有互联的服务器必须一致")
+    parser.add_argument('--discovery-port', type=int, default=DISCOVERY_PORT,
+                        help="应答客户端发现探测的 UDP 端口，0 表示不应答")
+    parser.add_argument('--capacity', type=int, default=DEFAULT_CAPACITY,
+                        help="服务器的设计容量（在线人数），客户端据此选择负载最低的服务器")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="HTTP 指标接口端口（GET /metrics），0 表示不开启；"
+                             "多进程模式下第 i 个工作进程使用 端口+i")
+    parser.add_argument('--metrics-host', default=DEFAULT_METRICS_HOST, help="指标接口的监听地址")
+    parser.add_argument('--ping-interval', type=float, default=DEFAULT_PING_INTERVAL,
+                        help="连接空闲多久（秒）后发送心跳，0 表示不检测失联的连接")
+    parser.add_argument('--ping-timeout', type=float, default=DEFAULT_PING_TIMEOUT,
+                        help="发送心跳后多久（秒）仍没有回应则断开连接")
+    parser.add_argument('--session-grace', type=float, default=DEFAULT_SESSION_GRACE,
+                        help="意外断线后为用户保留用户名的时间（秒），期间重新连接可恢复会话，0 表示不保留")
+    return parser.parse_args(argv)
+
+
+def create_server(args, **options):
+    return ChatServer(args.host, args.port, engine=args.engine, backlog=args.backlog,
+                      high_watermark=args.high_watermark, low_watermark=args.low_watermark,
+                      slow_consumer_policy=args.slow_consumer_policy,
+                      recv_buffer_size=args.recv_buffer, store_dir=args.store_dir,
+                      coalesce_delay=args.coalesce_delay, history_dir=args.history_dir,
+                      history_cache=args.history_cache,
+                      compression=args.compression,
+                      compression_level=args.compression_level,
+                      discovery_port=args.discovery_port, capacity=args.capacity,
+                      metrics_host=args.metrics_host, ping_interval=args.ping_interval,
+                      ping_timeout=args.ping_timeout, session_grace=args.session_grace, **options)
+
+
+def create_node(args):
+    """单进程运行的服务器，可与其他服务器互联"""
+    return create_server(args, node_id=args.node_id, peers=args.peer,
+                         accept_peers=args.accept_peers, peer_secret=args.peer_secret,
+                         metrics_port=args.metrics_port)
+
+
+def run_worker(args, bus_path, metrics_port=0):
+    try:
+        create_server(args, reuse_port=True, bus_path=bus_path, metrics_port=metrics_port).start()
+    except Exception as e:
+        print(f"工作进程启动失败: {e}")
+
+
+def run_workers(args):
+    """多进程模式：主进程运行消息总线，args.workers 个工作进程共同监听同一端口"""
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+        raise RuntimeError("当前系统不支持多进程模式（需要 SO_REUSEPORT 和 Unix 套接字）")
+    if args.peer or args.accept_peers:
+        raise RuntimeError("多进程模式不支持服务器互联")
+    bus_path = args.bus_path or os.path.join(tempfile.mkdtemp(prefix='chat-bus-'), 'bus.sock')
+    hub = BusHub(bus_path, MessageHistory(args.history_dir, args.history_cache), args.session_grace)
+    # 先绑定总线地址再启动工作进程，工作进程的连接在 serve() 之前排队等待
+    hub.listen()
+    if args.discovery_port:
+        # 各工作进程共用一个端口，由主进程按总线上登记的用户数统一应答
+        Beacon(args.port, lambda: len(hub.names), args.capacity,
+               discovery_port=args.discovery_port).start()
+    for index in range(args.workers):
+        metrics_port = args.metrics_port + index if args.metrics_port else 0
+        multiprocessing.Process(target=run_worker, args=(args, bus_path, metrics_port),
+                                daemon=True).start()
+    print(f"已启动 {args.workers} 个工作进程，消息总线: {bus_path}")
+    hub.serve()
 
 
 if __name__ == "__main__":
-    server = ChatServer()
+    args = parse_args()
     try:
-        server.start()
+        if args.workers > 1:
+            run_workers(args)
+        else:
+            create_node(args).start()
     except Exception as e:
         print(f"服务器启动失败: {e}")
\ No newline at end of file
@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+import subprocess
+
+from chat_core import ChatSession
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+# 等待服务器启动、互联和消息到达的最长时间（秒）
+WAIT_TIMEOUT = 10
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Node:
+    """在子进程中运行的一台服务器，重启时沿用同样的节点ID、端口和数据目录"""
+
+    def __init__(self, node_id, peers=()):
+        self.node_id = node_id
+        self.port = free_port()
+        self.peers = peers
+        self.data_dir = tempfile.mkdtemp()
+        self.process = None
+
+    def start(self):
+        args = [sys.executable, SERVER, '--host', '127.0.0.1', '--port', str(self.port),
+                '--node-id', self.node_id, '--accept-peers', '--discovery-port', '0',
+                '--store-dir', os.path.join(self.data_dir, 'store'),
+                '--history-dir', os.path.join(self.data_dir, 'history')]
+        for peer in self.peers:
+            args += ['--peer', f"127.0.0.1:{peer.port}"]
+        self.process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + WAIT_TIMEOUT
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f"服务器 {self.node_id} 没有启动")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def remove(self):
+        self.stop()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+def wait_for(session, match, timeout=WAIT_TIMEOUT):
+    """等待 match(event) 为真的事件，超时返回 False"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        event = session.next_event(0.2)
+        if event is not None and match(event):
+            return True
+    return False
+
+
+def is_text(content):
+    return lambda event: event['type'] == 'text' and event.get('content') == content
+
+
+class FederationRestartTest(unittest.TestCase):
+    """互联的服务器重启后，它发出的消息和在线状态仍能到达其他服务器"""
+
+    def setUp(self):
+        self.sessions = []
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.a = Node('a')
+        self.b = Node('b', peers=[self.a])
+        self.a.start()
+        self.b.start()
+
+    def tearDown(self):
+        for session in self.sessions:
+            session.close()
+        self.b.remove()
+        self.a.remove()
+        self.state_dir.cleanup()
+
+    def login(self, node, username):
+        state_file = os.path.join(self.state_dir.name, f"{username}.json")
+        session = ChatSession(state_file=state_file, auto_reconnect=False)
+        self.sessions.append(session)
+        session.open(('127.0.0.1', node.port), username)
+        return session
+
+    def wait_linked(self, receiver, sender):
+        """链路建立前发出的消息不会转发，反复发送直到对方收到"""
+        deadline = time.time() + WAIT_TIMEOUT
+        while time.time() < deadline:
+            sender.send_text('ready?')
+            if wait_for(receiver, is_text('ready?'), 0.5):
+                return
+        self.fail("服务器没有互联")
+
+    def test_messages_after_restart(self):
+        alice = self.login(self.a, 'alice')
+        bob = self.login(self.b, 'bob')
+        self.wait_linked(alice, bob)
+        # 重启前让 b 用掉一批消息ID
+        for i in range(20):
+            bob.send_text(f"before {i}")
+        self.assertTrue(wait_for(alice, is_text('before 19')))
+
+        self.b.stop()
+        self.b.start()
+        # a 的消息ID没有变化，用它确认链路已经重新建立
+        carol = self.login(self.b, 'carol')
+        self.wait_linked(carol, alice)
+        dave = self.login(self.b, 'dave')
+        self.assertTrue(wait_for(alice, lambda event: event['type'] == 'system'
+                                 and event.get('content') == "dave 加入了聊天室"))
+        dave.send_text('after restart')
+        self.assertTrue(wait_for(alice, is_text('after restart')))
+
+
+if __name__ == '__main__':
+    unittest.main()
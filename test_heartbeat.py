@@ -0,0 +1,152 @@
+import unittest
+
+from heartbeat import TimerWheel, IdleReaper
+from metrics import Metrics
+
+
+class FakeConnection:
+
+    def __init__(self, username):
+        self.username = username
+        self.address = ('127.0.0.1', 0)
+        self.closed = False
+        self.last_seen = None
+        self.ping_time = None
+
+
+class FakeEngine:
+
+    def __init__(self):
+        self.closed = []
+
+    def close(self, conn):
+        conn.closed = True
+        self.closed.append(conn)
+
+
+class FakeServer:
+    """只记录 IdleReaper 发出的 ping 和断开的连接"""
+
+    def __init__(self):
+        self.metrics = Metrics()
+        self.engine = FakeEngine()
+        self.pings = []
+
+    def send_ping(self, conn):
+        self.pings.append(conn)
+
+
+class TimerWheelTest(unittest.TestCase):
+    """所有时间都由测试传入，不依赖真实时钟"""
+
+    def setUp(self):
+        self.wheel = TimerWheel(tick=1.0, slots=8)
+        self.wheel.last_tick = self.start = 1000.0
+
+    def at(self, seconds):
+        return self.start + seconds
+
+    def test_expires_after_delay(self):
+        self.wheel.schedule('a', 2.5, self.at(0))
+        self.assertEqual(self.wheel.advance(self.at(2.9)), [])
+        self.assertIn('a', self.wheel)
+        self.assertEqual(self.wheel.advance(self.at(3)), ['a'])
+        self.assertNotIn('a', self.wheel)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_never_expires_early(self):
+        # 不足一个 tick 的延迟也要等到下一格
+        self.wheel.schedule('a', 0.1, self.at(0.5))
+        self.assertEqual(self.wheel.advance(self.at(0.9)), [])
+        self.assertEqual(self.wheel.advance(self.at(1)), ['a'])
+
+    def test_reschedule_replaces_timer(self):
+        self.wheel.schedule('a', 2, self.at(0))
+        self.wheel.schedule('a', 5, self.at(1))
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(self.wheel.advance(self.at(5)), [])
+        self.assertEqual(self.wheel.advance(self.at(6)), ['a'])
+
+    def test_cancel(self):
+        self.wheel.schedule('a', 2, self.at(0))
+        self.wheel.schedule('b', 2, self.at(0))
+        self.wheel.cancel('a')
+        self.wheel.cancel('missing')
+        self.assertEqual(self.wheel.advance(self.at(3)), ['b'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_timer_longer_than_one_round(self):
+        # 8 格的时间轮，20 秒后到期的定时器要经过两圈多
+        self.wheel.schedule('a', 20, self.at(0))
+        self.wheel.schedule('b', 4, self.at(0))
+        self.assertEqual(self.wheel.advance(self.at(4)), ['b'])
+        self.assertEqual(self.wheel.advance(self.at(19)), [])
+        self.assertEqual(self.wheel.advance(self.at(20)), ['a'])
+
+    def test_advance_over_several_ticks(self):
+        self.wheel.schedule('a', 1, self.at(0))
+        self.wheel.schedule('b', 3, self.at(0))
+        self.wheel.schedule('c', 7, self.at(0))
+        self.assertEqual(sorted(self.wheel.advance(self.at(5))), ['a', 'b'])
+        self.assertEqual(self.wheel.advance(self.at(7.5)), ['c'])
+
+
+class IdleReaperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer()
+        self.reaper = IdleReaper(self.server, interval=10, timeout=5, tick=1.0)
+        self.reaper.wheel.last_tick = self.start = 1000.0
+        self.conn = FakeConnection('alice')
+        self.reaper.watch(self.conn, self.at(0))
+
+    def at(self, seconds):
+        return self.start + seconds
+
+    def test_ping_then_evict(self):
+        self.reaper.run(self.at(9))
+        self.assertEqual(self.server.pings, [])
+        self.reaper.run(self.at(10))
+        self.assertEqual(self.server.pings, [self.conn])
+        self.reaper.run(self.at(14))
+        self.assertEqual(self.server.engine.closed, [])
+        # ping 之后 timeout 秒仍没有数据，断开
+        self.reaper.run(self.at(15))
+        self.assertEqual(self.server.engine.closed, [self.conn])
+        self.assertEqual(self.server.metrics.evicted.value, 1)
+        self.assertNotIn(self.conn, self.reaper.wheel)
+
+    def test_activity_postpones_ping(self):
+        self.conn.last_seen = self.at(6)
+        self.reaper.run(self.at(10))
+        self.assertEqual(self.server.pings, [])
+        self.reaper.run(self.at(15))
+        self.assertEqual(self.server.pings, [])
+        self.reaper.run(self.at(16))
+        self.assertEqual(self.server.pings, [self.conn])
+
+    def test_data_after_ping_keeps_connection(self):
+        self.reaper.run(self.at(10))
+        self.conn.last_seen = self.at(12)
+        self.reaper.run(self.at(15))
+        self.assertEqual(self.server.engine.closed, [])
+        self.assertIsNone(self.conn.ping_time)
+        # 从最后一次收到数据算起再空闲 interval 秒才再次 ping
+        self.reaper.run(self.at(21))
+        self.assertEqual(self.server.pings, [self.conn])
+        self.reaper.run(self.at(22))
+        self.assertEqual(self.server.pings, [self.conn, self.conn])
+
+    def test_unwatch_and_closed_connections(self):
+        other = FakeConnection('bob')
+        self.reaper.watch(other, self.at(0))
+        self.reaper.unwatch(self.conn)
+        other.closed = True
+        self.reaper.run(self.at(30))
+        self.assertEqual(self.server.pings, [])
+        self.assertEqual(self.server.engine.closed, [])
+        self.assertEqual(len(self.reaper.wheel), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
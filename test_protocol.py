@@ -0,0 +1,115 @@
+import unittest
+
+from protocol import (FRAME_JSON, FRAME_DATA, HEADER, MAX_FRAME_SIZE, LOGIN_FRAME_SIZE, FrameParser,
+                      ProtocolError, encode_frame, encode_message, decode_message)
+
+
+class FakeSocket:
+    """按给定的分段依次返回数据的套接字，分段用完后表示对端关闭"""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        count = min(len(chunk), len(view))
+        view[:count] = chunk[:count]
+        if count < len(chunk):
+            self.chunks.insert(0, chunk[count:])
+        return count
+
+
+def read_all(parser, sock):
+    """读到对端关闭为止，返回 (帧类型, 通道号, 负载) 列表"""
+    frames = []
+    while True:
+        result = parser.read_from(sock)
+        if result is None:
+            return frames
+        # 负载只在下一次读取前有效，先复制出来
+        frames += [(f.type, f.channel, bytes(f.payload)) for f in result]
+
+
+class FrameParserTest(unittest.TestCase):
+
+    def test_frame_split_across_reads(self):
+        data = encode_frame(FRAME_DATA, b'x' * 1000, channel=3)
+        sock = FakeSocket([data[:100], data[100:700], data[700:]])
+        self.assertEqual(read_all(FrameParser(), sock), [(FRAME_DATA, 3, b'x' * 1000)])
+
+    def test_several_frames_in_one_read(self):
+        messages = [{'type': 'text', 'content': str(i)} for i in range(5)]
+        sock = FakeSocket([b''.join(encode_message(m) for m in messages)])
+        parser = FrameParser()
+        frames = parser.read_from(sock)
+        self.assertEqual([decode_message(f.payload, f.flags) for f in frames], messages)
+        self.assertEqual(parser.buffered(), 0)
+
+    def test_header_split_across_reads(self):
+        data = encode_message({'type': 'ping'}) + encode_frame(FRAME_DATA, b'abc', channel=7)
+        # 第二个帧的头部被拆成三段
+        split = len(encode_message({'type': 'ping'}))
+        sock = FakeSocket([data[:split + 2], data[split + 2:split + 5], data[split + 5:]])
+        frames = read_all(FrameParser(), sock)
+        self.assertEqual([f[0] for f in frames], [FRAME_JSON, FRAME_DATA])
+        self.assertEqual(frames[1], (FRAME_DATA, 7, b'abc'))
+
+    def test_frame_larger_than_buffer(self):
+        payload = bytes(range(256)) * 100
+        data = encode_frame(FRAME_DATA, payload, channel=1)
+        sock = FakeSocket([data[i:i + 1000] for i in range(0, len(data), 1000)])
+        self.assertEqual(read_all(FrameParser(1024), sock), [(FRAME_DATA, 1, payload)])
+
+    def test_oversize_frame_rejected(self):
+        header = HEADER.pack(FRAME_DATA, 0, 1, MAX_FRAME_SIZE + 1)
+        with self.assertRaises(ProtocolError):
+            FrameParser().read_from(FakeSocket([header]))
+
+    def test_declared_length_not_allocated(self):
+        # 只声明了很大的长度、实际只发来一个字节时不应该分配整帧的内存
+        parser = FrameParser(1024)
+        parser.read_from(FakeSocket([HEADER.pack(FRAME_DATA, 0, 1, MAX_FRAME_SIZE) + b'x']))
+        parser.read_from(FakeSocket([b'y']))
+        self.assertEqual(len(parser._buffer), 1024)
+
+    def test_buffer_grows_in_steps_and_shrinks(self):
+        payload = b'z' * 100000
+        data = encode_frame(FRAME_DATA, payload, channel=1)
+        parser = FrameParser(1024)
+        sock = FakeSocket([data[i:i + 1000] for i in range(0, len(data), 1000)])
+        sizes, frames = [], []
+        while True:
+            result = parser.read_from(sock)
+            if result is None:
+                break
+            frames += [bytes(f.payload) for f in result]
+            sizes.append(len(parser._buffer))
+        self.assertEqual(frames, [payload])
+        # 每次最多扩大一倍，处理完后恢复到初始大小
+        grown = [size for size in sizes if size > 1024]
+        self.assertTrue(all(b <= 2 * a for a, b in zip(grown, grown[1:])))
+        self.assertEqual(sizes[-1], 1024)
+
+    def test_login_frame_limit(self):
+        header = HEADER.pack(FRAME_DATA, 0, 1, LOGIN_FRAME_SIZE + 1)
+        with self.assertRaises(ProtocolError):
+            FrameParser(max_frame=LOGIN_FRAME_SIZE).read_from(FakeSocket([header]))
+        # 登录后放开限制
+        parser = FrameParser(max_frame=LOGIN_FRAME_SIZE)
+        parser.max_frame = MAX_FRAME_SIZE
+        self.assertEqual(parser.read_from(FakeSocket([header])), [])
+
+    def test_feed(self):
+        data = encode_message({'type': 'text', 'content': 'a' * 5000}) * 3
+        parser = FrameParser(1024)
+        frames = []
+        for i in range(0, len(data), 700):
+            frames += [decode_message(bytes(f.payload), f.flags) for f in parser.feed(data[i:i + 700])]
+        self.assertEqual(len(frames), 3)
+        self.assertEqual(parser.buffered(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import socket
+import tempfile
+import unittest
+import subprocess
+
+from chat_core import ChatSession
+from test_federation import SERVER, WAIT_TIMEOUT, free_port, wait_for, is_text
+
+# 接替的次数，两个工作进程时新旧连接多半会有几次落在不同的进程上
+TAKE_OVERS = 6
+
+
+class WorkersTakeOverTest(unittest.TestCase):
+    """多进程模式下，出示会话令牌的新连接接替还没断开的旧连接，无论两者在哪个工作进程上"""
+
+    def setUp(self):
+        self.sessions = []
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.port = free_port()
+        self.process = subprocess.Popen(
+            [sys.executable, SERVER, '--host', '127.0.0.1', '--port', str(self.port),
+             '--workers', '2', '--discovery-port', '0',
+             '--bus-path', os.path.join(self.data_dir.name, 'bus.sock'),
+             '--store-dir', os.path.join(self.data_dir.name, 'store'),
+             '--history-dir', os.path.join(self.data_dir.name, 'history')],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + WAIT_TIMEOUT
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            self.fail("服务器没有启动")
+        time.sleep(0.5)  # 等另一个工作进程也开始监听
+
+    def tearDown(self):
+        for session in self.sessions:
+            session.close()
+        # 总线断开后工作进程自行退出
+        self.process.kill()
+        self.process.wait()
+        self.data_dir.cleanup()
+
+    def session(self):
+        state_file = os.path.join(self.data_dir.name, f"state{len(self.sessions)}.json")
+        session = ChatSession(state_file=state_file, auto_reconnect=False)
+        self.sessions.append(session)
+        return session
+
+    def test_take_over_across_workers(self):
+        bob = self.session()
+        bob.open(('127.0.0.1', self.port), 'bob')
+        alice = self.session()
+        alice.open(('127.0.0.1', self.port), 'alice')
+        for i in range(TAKE_OVERS):
+            new = self.session()
+            new.username, new.session_token = alice.username, alice.session_token
+            new.open(('127.0.0.1', self.port), 'alice')
+            self.assertTrue(new.resumed)
+            self.assertTrue(wait_for(alice, lambda event: event['type'] == 'disconnected'))
+            alice = new
+
+        bob.send_text('still here?')
+        self.assertTrue(wait_for(alice, is_text('still here?')))
+        # 其他人看来 alice 一直在线
+        self.assertFalse(wait_for(bob, lambda event: event['type'] == 'system'
+                                  and event.get('content') == "alice 离开了聊天室", 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import os
+import zlib
+import hashlib
+
+# 校验分块大小，属于协议的一部分，发送方和接收方必须一致
+CHUNK_SIZE = 1024 * 1024
+
+# 本身已经压缩过的文件类型，传输时不再压缩
+COMPRESSED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.lz4',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.aac', '.ogg', '.flac', '.m4a', '.mp4', '.mkv', '.avi', '.mov', '.webm',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.apk', '.jar', '.whl',
+}
+
+# 判断是否值得压缩时取样的大小，以及取样至少要压缩到的比例
+COMPRESS_SAMPLE_SIZE = 64 * 1024
+COMPRESS_SAMPLE_RATIO = 0.9
+
+
+class ChecksumError(Exception):
+    """某个分块的哈希与清单不一致"""
+
+    def __init__(self, index):
+        super().__init__(f"第 {index} 个分块校验失败")
+        self.index = index
+
+
+def hash_chunk(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def compute_file_id(chunk_hashes):
+    """整个文件的摘要：由所有分块哈希计算得出，同时作为文件ID"""
+    digest = hashlib.sha256()
+    for chunk_hash in chunk_hashes:
+        digest.update(bytes.fromhex(chunk_hash))
+    return digest.hexdigest()
+
+
+def hash_file_chunks(path):
+    """计算文件每个分块的哈希，返回 (文件ID, 分块哈希列表)"""
+    chunk_hashes = []
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunk_hashes.append(hash_chunk(chunk))
+    return compute_file_id(chunk_hashes), chunk_hashes
+
+
+def is_compressible(path, filename=None):
+    """根据扩展名和开头一段内容的压缩率判断文件是否值得压缩传输"""
+    name = filename if filename is not None else path
+    if os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+    with open(path, 'rb') as f:
+        sample = f.read(COMPRESS_SAMPLE_SIZE)
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * COMPRESS_SAMPLE_RATIO
+
+
+def chunk_count(size):
+    return (size + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+
+def validate_manifest(file_id, size, chunk_hashes):
+    """检查分块清单与文件ID、文件大小是否一致"""
+    if not isinstance(chunk_hashes, list) or len(chunk_hashes) != chunk_count(size):
+        raise ValueError("分块清单与文件大小不符")
+    try:
+        expected = compute_file_id(chunk_hashes)
+    except (TypeError, ValueError):
+        raise ValueError("分块清单格式错误")
+    if expected != file_id:
+        raise ValueError("分块清单与文件ID不符")
+
+
+def resume_offset(path, chunk_hashes):
+    """根据已有的部分文件计算可以续传的位置，并截掉未校验的尾部
+
+    数据在每个分块写满后立即校验，所以只有最后一个完整分块可能未经校验，
+    这里重新校验它，不通过则再退回一个分块。
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 0
+    offset = min(size // CHUNK_SIZE, len(chunk_hashes)) * CHUNK_SIZE
+    with open(path, 'r+b') as f:
+        if offset:
+            f.seek(offset - CHUNK_SIZE)
+            if hash_chunk(f.read(CHUNK_SIZE)) != chunk_hashes[offset // CHUNK_SIZE - 1]:
+                offset -= CHUNK_SIZE
+        f.truncate(offset)
+    return offset
+
+
+class ChunkVerifier:
+    """按分块增量校验顺序到达的数据"""
+
+    def __init__(self, chunk_hashes, size, offset=0):
+        if offset % CHUNK_SIZE and offset != size:
+            raise ValueError("续传位置必须对齐到分块边界")
+        self.chunk_hashes = chunk_hashes
+        self.size = size
+        self.position = offset  # 已收到的数据末尾
+        self.verified = offset  # 已校验通过的数据末尾
+        self._hash = hashlib.sha256()
+
+    @property
+    def complete(self):
+        return self.verified >= self.size
+
+    def update(self, data):
+        """校验一段数据，分块不一致时抛出 ChecksumError"""
+        data = memoryview(data)
+        while len(data):
+            index = self.position // CHUNK_SIZE
+            chunk_end = min((index + 1) * CHUNK_SIZE, self.size)
+            take = min(len(data), chunk_end - self.position)
+            if take <= 0:
+                raise ValueError("收到的数据超过声明的文件大小")
+            self._hash.update(data[:take])
+            self.position += take
+            data = data[take:]
+            if self.position == chunk_end:
+                if self._hash.hexdigest() != self.chunk_hashes[index]:
+                    self.position = self.verified
+                    self._hash = hashlib.sha256()
+                    raise ChecksumError(index)
+                self.verified = chunk_end
+                self._hash = hashlib.sha256()